@@ -17,8 +17,31 @@ DeBaCl is available under the 3-clause BSD license. Some useful links:
 
 __version__ = '1.1'
 
+## DeBaCl logs progress and warnings to the 'debacl' logger, but leaves the
+## logging configuration to the application.
+import logging as _logging
+_logging.getLogger(__name__).addHandler(_logging.NullHandler())
+
 from debacl.level_set_tree import construct_tree
+from debacl.level_set_tree import construct_tree_binned
 from debacl.level_set_tree import construct_tree_from_graph
+from debacl.level_set_tree import construct_tree_from_lattice
+from debacl.level_set_tree import construct_tree_sampled
 from debacl.level_set_tree import load_tree
+from debacl.level_set_tree import resume_tree
 
 from debacl.level_set_tree import LevelSetTree
+
+from debacl.cache import NeighborCache
+
+from debacl.estimator import DeBaClClustering
+
+from debacl.serving import attach_tree
+from debacl.serving import benchmark
+from debacl.serving import build_async
+from debacl.serving import publish_tree
+from debacl.serving import serve_stream
+from debacl.serving import socket_server
+from debacl.serving import MicroBatcher
+from debacl.serving import TreeAssigner
+from debacl.serving import TreeHolder
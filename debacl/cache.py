@@ -0,0 +1,252 @@
+"""
+On-disk cache for the expensive intermediate results of level set tree
+construction (similarity graphs, neighbor radii, and density estimates), for
+the DEnsity-BAsed CLustering (DeBaCl) toolbox.
+"""
+
+## Built-in packages
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import os as _os
+import shutil as _shutil
+import hashlib as _hashlib
+import tempfile as _tempfile
+
+import debacl.utils as _utl
+
+## Required packages
+try:
+    import numpy as _np
+except:
+    raise ImportError("DeBaCl requires the numpy, networkx, and " +
+                      "prettytable packages.")
+
+
+class NeighborCache(object):
+    """
+    Content-addressed cache of numpy arrays in a directory. Each entry is a
+    set of named arrays, keyed by a hash of the data and parameters that
+    produced them. Arrays are stored as '.npy' files and loaded as read-only
+    memory maps. When the total size exceeds 'max_bytes', the least recently
+    used entries are removed.
+
+    Parameters
+    ----------
+    directory : str
+        Cache directory. Created if it does not exist.
+
+    max_bytes : int, optional
+        Size budget for the cache, in bytes. If None (default), the cache is
+        not limited.
+
+    See Also
+    --------
+    debacl.construct_tree
+
+    Examples
+    --------
+    >>> cache = debacl.NeighborCache('my_cache', max_bytes=2**30)
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5, cache=cache)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=10, cache=cache)
+    """
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+        if not _os.path.isdir(directory):
+            _os.makedirs(directory)
+
+    def __repr__(self):
+        return "NeighborCache({!r}, max_bytes={})".format(self.directory,
+                                                        self.max_bytes)
+
+    def key(self, *args, **kwargs):
+        """
+        Compute the cache key for a set of inputs, by hashing the contents of
+        numpy arrays and scipy sparse matrices, and the values of other
+        arguments. Functions can't be hashed by their contents, so inputs
+        that contain functions raise a TypeError; replace them with a name.
+
+        Returns
+        -------
+        key : str
+            Hexadecimal digest of the inputs.
+        """
+        digest = _hashlib.sha1()
+        _hash_update(digest, args)
+        _hash_update(digest, kwargs)
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Retrieve an entry from the cache, and mark it as recently used.
+
+        Parameters
+        ----------
+        key : str
+            Cache key, from `key`.
+
+        Returns
+        -------
+        arrays : dict [str, numpy.memmap]
+            Named arrays of the entry, or None if the key is not in the cache.
+        """
+        path = _os.path.join(self.directory, key)
+
+        if not _os.path.isdir(path):
+            return None
+
+        arrays = {}
+
+        try:
+            for filename in _os.listdir(path):
+                name, ext = _os.path.splitext(filename)
+                if ext == '.npy':
+                    arrays[name] = _np.load(_os.path.join(path, filename),
+                                            mmap_mode='r')
+
+            _os.utime(path, None)
+
+        except (IOError, OSError, ValueError):
+            ## The entry was evicted or is incomplete; treat it as a miss.
+            return None
+
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Store named arrays in the cache, then evict the least recently used
+        entries if the cache is over its size budget. The entry is written to
+        a temporary directory and then renamed, so readers never see a
+        partial entry.
+
+        Parameters
+        ----------
+        key : str
+            Cache key, from `key`.
+
+        arrays : numpy arrays
+            Arrays to store, by name.
+        """
+        path = _os.path.join(self.directory, key)
+        staging = _tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+
+        for name, value in arrays.items():
+            _np.save(_os.path.join(staging, name + '.npy'),
+                     _np.asarray(value))
+
+        try:
+            _os.rename(staging, path)
+        except OSError:
+            ## Another process stored the same entry first.
+            _shutil.rmtree(staging, ignore_errors=True)
+
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used entries until the cache is within its
+        size budget.
+
+        Parameters
+        ----------
+        keep : str, optional
+            Key of an entry that should not be removed.
+        """
+        if self.max_bytes is None:
+            return
+
+        entries = []
+
+        for key in _os.listdir(self.directory):
+            path = _os.path.join(self.directory, key)
+            if key.startswith('.') or not _os.path.isdir(path):
+                continue
+
+            try:
+                size = sum(_os.path.getsize(_os.path.join(path, f))
+                           for f in _os.listdir(path))
+                entries.append((_os.path.getmtime(path), size, key))
+            except OSError:
+                continue
+
+        total = sum(size for _, size, _ in entries)
+
+        for _, size, key in sorted(entries):
+            if total <= self.max_bytes:
+                break
+
+            if key != keep:
+                _shutil.rmtree(_os.path.join(self.directory, key),
+                               ignore_errors=True)
+                total -= size
+
+    def clear(self):
+        """
+        Remove every entry from the cache.
+        """
+        for key in _os.listdir(self.directory):
+            path = _os.path.join(self.directory, key)
+            if _os.path.isdir(path):
+                _shutil.rmtree(path, ignore_errors=True)
+
+
+def _hash_update(digest, obj):
+    """
+    Feed an object into a hash, including the contents of numpy arrays and
+    scipy sparse matrices. This function is not meant to be called by the
+    user; it is a helper function for `NeighborCache.key`.
+    """
+
+    if _utl._issparse(obj):
+        obj = _utl._sps.csr_matrix(obj)
+        digest.update(b'sparse')
+        _hash_update(digest, obj.shape)
+        for part in (obj.indptr, obj.indices, obj.data):
+            _hash_update(digest, part)
+
+    elif isinstance(obj, _np.ndarray):
+        digest.update(str((obj.dtype.str, obj.shape)).encode('utf-8'))
+        digest.update(_np.ascontiguousarray(obj).view(_np.uint8))
+
+    elif isinstance(obj, dict):
+        digest.update(b'dict')
+        for name in sorted(obj):
+            _hash_update(digest, name)
+            _hash_update(digest, obj[name])
+
+    elif isinstance(obj, (list, tuple)):
+        digest.update(str((type(obj).__name__, len(obj))).encode('utf-8'))
+        for item in obj:
+            _hash_update(digest, item)
+
+    ## The repr of a function is its memory address, which is neither stable
+    #  across processes nor unique over time.
+    elif callable(obj) and not isinstance(obj, type):
+        raise TypeError("Functions can't be hashed by their contents; " +
+                        "use a name for {!r} in the cache key.".format(obj))
+
+    else:
+        digest.update(repr(obj).encode('utf-8'))
+
+
+def _has_callable(obj):
+    """
+    Check whether an object, or a list, tuple, or dict inside it, is a
+    function, which `_hash_update` can't hash. Types, such as numpy dtypes,
+    are hashed by name and don't count. This function is not meant to be
+    called by the user.
+    """
+
+    if isinstance(obj, dict):
+        return any(_has_callable(value) for value in obj.values())
+
+    elif isinstance(obj, (list, tuple)):
+        return any(_has_callable(item) for item in obj)
+
+    else:
+        return callable(obj) and not isinstance(obj, type)
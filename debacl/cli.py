@@ -0,0 +1,457 @@
+"""
+Command line interface for the DEnsity-BAsed CLustering (DeBaCl) toolbox.
+
+Build a level set tree from a numpy or CSV file, prune it, and write cluster
+labels::
+
+    $ debacl build data.csv tree.pkl --k 10 --prune-threshold 5
+    $ debacl prune tree.pkl pruned.pkl --threshold 20
+    $ debacl labels pruned.pkl labels.npy --method first-k --k 3
+"""
+
+## Built-in packages
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import os as _os
+import sys as _sys
+import time as _time
+import logging as _logging
+import argparse as _argparse
+import subprocess as _subprocess
+import tempfile as _tempfile
+import itertools as _itertools
+import contextlib as _contextlib
+
+import debacl.level_set_tree as _lst
+
+## Required packages
+try:
+    import numpy as _np
+except:
+    raise ImportError("DeBaCl requires the numpy, networkx, and " +
+                      "prettytable packages.")
+
+## Soft dependencies
+try:
+    import tracemalloc as _tracemalloc
+    _HAS_TRACEMALLOC = True
+except:
+    _HAS_TRACEMALLOC = False
+
+try:
+    import resource as _resource
+    _HAS_RESOURCE = True
+except:
+    _HAS_RESOURCE = False
+
+## Dependencies to look for when measuring import time.
+_HEAVY_MODULES = ('numpy', 'scipy', 'sklearn', 'matplotlib', 'networkx',
+                  'prettytable')
+
+_IMPORT_SCRIPT = """
+import sys, time, importlib
+start = time.time()
+importlib.import_module(sys.argv[1])
+print(time.time() - start)
+print(' '.join(name for name in sys.argv[2:] if name in sys.modules))
+"""
+
+def main(argv=None):
+    """
+    Run the DeBaCl command line interface.
+
+    Parameters
+    ----------
+    argv : list [str], optional
+        Command line arguments, without the program name. If None (default),
+        the arguments of the current process.
+
+    Returns
+    -------
+    status : int
+        Exit status.
+    """
+    parser = _make_parser()
+    args = parser.parse_args(argv)
+    profiler = _Profiler(args.profile)
+
+    _logging.basicConfig(level=_logging.WARNING, datefmt='%Y-%m-%d %I:%M:%S',
+                         format='%(levelname)s (%(asctime)s): %(message)s')
+
+    try:
+        args.command(args, profiler)
+    except (IOError, OSError, ValueError, MemoryError) as error:
+        print("debacl: error: {}".format(error), file=_sys.stderr)
+        return 1
+
+    profiler.report(_sys.stderr)
+
+    return 0
+
+
+def _make_parser():
+    """
+    Define the command line arguments. This function is not meant to be
+    called by the user.
+    """
+    parser = _argparse.ArgumentParser(
+        prog='debacl', description="Build level set trees and retrieve " +
+        "density-based clusters.")
+
+    common = _argparse.ArgumentParser(add_help=False)
+    common.add_argument('--profile', action='store_true',
+                        help="print the time and peak memory of each phase")
+
+    subparsers = parser.add_subparsers(title='commands')
+
+    ## Build
+    build = subparsers.add_parser(
+        'build', parents=[common], help="build a level set tree",
+        description="Build a level set tree from a '.npy' file, which is " +
+        "memory-mapped, or a delimited text file, which is parsed in chunks.")
+    build.add_argument('input', help="input data file")
+    build.add_argument('output', help="output tree file")
+    build.add_argument('--k', type=int, default=10,
+                       help="number of neighbors (default: %(default)s)")
+    build.add_argument('--prune-threshold', type=int, default=None,
+                       help="minimum node size")
+    build.add_argument('--num-levels', type=int, default=None,
+                       help="number of density levels")
+    build.add_argument('--metric', default='euclidean',
+                       help="distance metric (default: %(default)s)")
+    build.add_argument('--dtype', default=None,
+                       help="precision of the neighbor search, e.g. float32")
+    build.add_argument('--jobs', type=int, default=1,
+                       help="threads for the neighbor search, or -1 for " +
+                       "one per CPU (default: %(default)s)")
+    build.add_argument('--memory-limit', type=float, default=None,
+                       help="memory budget in GB (default: the available " +
+                       "memory)")
+    build.add_argument('--cache-dir', default=None,
+                       help="cache directory for neighbor graphs and " +
+                       "density estimates")
+    build.add_argument('--delimiter', default=',',
+                       help="text file delimiter (default: '%(default)s')")
+    build.add_argument('--skip-header', type=int, default=0,
+                       help="text file header lines to skip")
+    build.add_argument('--chunk-size', type=int, default=100000,
+                       help="text file rows to parse at once " +
+                       "(default: %(default)s)")
+    build.set_defaults(command=_build)
+
+    ## Prune
+    prune = subparsers.add_parser(
+        'prune', parents=[common], help="prune a level set tree",
+        description="Prune a saved level set tree.")
+    prune.add_argument('input', help="input tree file")
+    prune.add_argument('output', help="output tree file")
+    prune.add_argument('--threshold', type=int, required=True,
+                       help="minimum node size")
+    prune.set_defaults(command=_prune)
+
+    ## Labels
+    labels = subparsers.add_parser(
+        'labels', parents=[common], help="write cluster labels",
+        description="Write the cluster label of each point, or -1 for " +
+        "background points, to a memory-mapped '.npy' file.")
+    labels.add_argument('input', help="input tree file")
+    labels.add_argument('output', help="output '.npy' file")
+    labels.add_argument('--method', default='leaf',
+                        choices=['leaf', 'first-k', 'upper-level-set',
+                                 'k-level'],
+                        help="cluster labeling method (default: " +
+                        "%(default)s)")
+    labels.add_argument('--k', type=int, default=None,
+                        help="number of clusters for 'first-k' and 'k-level'")
+    labels.add_argument('--threshold', type=float, default=None,
+                        help="level for 'upper-level-set'")
+    labels.add_argument('--form', default='mass',
+                        choices=['mass', 'density'],
+                        help="scale of the 'upper-level-set' threshold " +
+                        "(default: %(default)s)")
+    labels.set_defaults(command=_labels)
+
+    ## Import time
+    startup = subparsers.add_parser(
+        'import-time', parents=[common],
+        help="measure the time to import DeBaCl",
+        description="Measure the time to import a module in fresh Python " +
+        "processes, and list the heavy dependencies that it loads.")
+    startup.add_argument('--module', default='debacl',
+                         help="module to import (default: %(default)s)")
+    startup.add_argument('--repeats', type=int, default=5,
+                         help="number of processes (default: %(default)s)")
+    startup.set_defaults(command=_import_time)
+
+    return parser
+
+
+def _build(args, profiler):
+    """
+    Build a level set tree. This function is not meant to be called by the
+    user.
+    """
+    with profiler.phase('read'):
+        X, temp_file = _read_data(args.input, args.delimiter,
+                                  args.skip_header, args.chunk_size)
+
+    if args.memory_limit is None:
+        memory_limit = None
+    else:
+        memory_limit = int(args.memory_limit * 2**30)
+
+    try:
+        with profiler.phase('construct'):
+            tree = _lst.construct_tree(X, args.k,
+                                       prune_threshold=args.prune_threshold,
+                                       num_levels=args.num_levels,
+                                       dtype=args.dtype, metric=args.metric,
+                                       cache=args.cache_dir,
+                                       n_jobs=args.jobs,
+                                       memory_limit=memory_limit)
+    finally:
+        del X
+        if temp_file is not None:
+            _os.remove(temp_file)
+
+    with profiler.phase('write'):
+        tree.save(args.output)
+
+
+def _prune(args, profiler):
+    """
+    Prune a saved level set tree. This function is not meant to be called by
+    the user.
+    """
+    with profiler.phase('read'):
+        tree = _lst.load_tree(args.input)
+
+    with profiler.phase('prune'):
+        tree = tree.prune(threshold=args.threshold)
+
+    with profiler.phase('write'):
+        tree.save(args.output)
+
+
+def _labels(args, profiler):
+    """
+    Write the cluster labels of a saved level set tree. This function is not
+    meant to be called by the user.
+    """
+    method_params = {}
+
+    if args.method in ('first-k', 'k-level'):
+        if args.k is None:
+            raise ValueError("The '{}' method requires --k.".format(
+                args.method))
+        method_params['k'] = args.k
+
+    elif args.method == 'upper-level-set':
+        if args.threshold is None:
+            raise ValueError("The 'upper-level-set' method requires " +
+                             "--threshold.")
+        method_params['threshold'] = args.threshold
+        method_params['form'] = args.form
+
+    with profiler.phase('read'):
+        tree = _lst.load_tree(args.input)
+
+    with profiler.phase('cluster'):
+        labels = tree.get_clusters(args.method, **method_params)
+
+    with profiler.phase('write'):
+        output = _np.lib.format.open_memmap(args.output, mode='w+',
+                                            dtype=_np.int,
+                                            shape=(len(tree.density),))
+        output[:] = -1
+        output[labels[:, 0]] = labels[:, 1]
+        output.flush()
+        del output
+
+
+def _import_time(args, profiler):
+    """
+    Report the time to import a module. This function is not meant to be
+    called by the user.
+    """
+    import_times, process_times, loaded = _measure_import(args.module,
+                                                          args.repeats)
+
+    print("import {}: median {:.3f} s, min {:.3f} s".format(
+        args.module, _np.median(import_times), min(import_times)))
+    print("process with import: median {:.3f} s".format(
+        _np.median(process_times)))
+    print("loaded: {}".format(', '.join(loaded) or 'none'))
+
+
+def _measure_import(module='debacl', repeats=5):
+    """
+    Time importing a module in fresh Python processes. This function is not
+    meant to be called by the user.
+
+    Returns
+    -------
+    import_times : list [float]
+        Time in seconds to import the module, in each process.
+
+    process_times : list [float]
+        Time in seconds to start each process, import the module, and exit.
+
+    loaded : list [str]
+        Heavy dependencies imported along with the module.
+    """
+    import_times = []
+    process_times = []
+
+    for _ in range(repeats):
+        start = _time.time()
+        output = _subprocess.check_output(
+            [_sys.executable, '-c', _IMPORT_SCRIPT, module] +
+            list(_HEAVY_MODULES))
+        process_times.append(_time.time() - start)
+
+        lines = output.decode().splitlines()
+        import_times.append(float(lines[0]))
+        loaded = lines[1].split() if len(lines) > 1 else []
+
+    return import_times, process_times, loaded
+
+
+def _read_data(filename, delimiter=',', skip_header=0, chunk_size=100000):
+    """
+    Open a data file as a 2-dimensional array. '.npy' files are memory-mapped.
+    Text files are parsed in chunks of rows, which are written to a temporary
+    binary file that is then memory-mapped, so the text is never held in
+    memory at once. This function is not meant to be called by the user.
+
+    Returns
+    -------
+    X : numpy array
+        Data, as a read-only memory map.
+
+    temp_file : str
+        Temporary file backing 'X', to be removed when done, or None.
+    """
+    if filename.endswith('.npy'):
+        X = _np.load(filename, mmap_mode='r')
+        if X.ndim == 1:
+            X = X.reshape((-1, 1))
+        return X, None
+
+    fd, temp_file = _tempfile.mkstemp(suffix='.dat', prefix='debacl-')
+    num_rows = 0
+    num_cols = None
+
+    try:
+        with _os.fdopen(fd, 'wb') as out, open(filename) as f:
+            for _ in range(skip_header):
+                f.readline()
+
+            while True:
+                lines = list(_itertools.islice(f, chunk_size))
+                lines = [line for line in lines if len(line.strip()) > 0]
+                if len(lines) == 0:
+                    break
+
+                chunk = _np.loadtxt(lines, delimiter=delimiter, ndmin=2,
+                                    dtype=_np.float)
+
+                if num_cols is None:
+                    num_cols = chunk.shape[1]
+                elif chunk.shape[1] != num_cols:
+                    raise ValueError("Rows of '{}' have ".format(filename) +
+                                     "different numbers of columns.")
+
+                out.write(chunk.tobytes())
+                num_rows += chunk.shape[0]
+
+        if num_rows == 0:
+            raise ValueError("'{}' contains no data.".format(filename))
+
+        X = _np.memmap(temp_file, dtype=_np.float, mode='r',
+                       shape=(num_rows, num_cols))
+
+    except:
+        _os.remove(temp_file)
+        raise
+
+    return X, temp_file
+
+
+class _Profiler(object):
+    """
+    Record the time and peak memory of the phases of a command. Peak memory
+    is measured with `tracemalloc` if it is available (Python 3). Otherwise
+    it is the peak resident set size of the process so far, which can't be
+    reset between phases, so each phase also reports how much it raised the
+    peak. This class is not meant to be used directly.
+    """
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.phases = []
+
+    @_contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+
+        if _HAS_TRACEMALLOC:
+            _tracemalloc.start()
+        else:
+            start_peak = _peak_rss()
+
+        start = _time.time()
+
+        try:
+            yield
+        finally:
+            elapsed = _time.time() - start
+
+            if _HAS_TRACEMALLOC:
+                peak = _tracemalloc.get_traced_memory()[1]
+                increase = None
+                _tracemalloc.stop()
+            else:
+                peak = _peak_rss()
+                increase = None if peak is None else peak - start_peak
+
+            self.phases.append((name, elapsed, peak, increase))
+
+    def report(self, stream):
+        """
+        Print the phase timings and peak memory.
+        """
+        if not self.enabled:
+            return
+
+        for name, elapsed, peak, increase in self.phases:
+            line = "{:<10} {:10.3f} s".format(name, elapsed)
+
+            if increase is not None:
+                line += ("   process peak so far: {:.1f} MB " +
+                         "(+{:.1f} MB)").format(peak / 2.**20,
+                                                increase / 2.**20)
+            elif peak is not None:
+                line += "   peak traced memory: {:.1f} MB".format(
+                    peak / 2.**20)
+
+            print(line, file=stream)
+
+
+def _peak_rss():
+    """
+    Peak resident set size of the process so far, in bytes, or None if it
+    can't be measured. This function is not meant to be called by the user.
+    """
+    if not _HAS_RESOURCE:
+        return None
+
+    ## Kilobytes on Linux.
+    return _resource.getrusage(_resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+if __name__ == '__main__':
+    _sys.exit(main())
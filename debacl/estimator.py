@@ -0,0 +1,276 @@
+"""
+Scikit-learn style clustering estimator for the DEnsity-BAsed CLustering
+(DeBaCl) toolbox.
+"""
+
+## Built-in packages
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import hashlib as _hashlib
+
+import debacl.cache as _cache
+import debacl.serving as _serving
+import debacl.level_set_tree as _lst
+
+## Required packages
+try:
+    import numpy as _np
+except:
+    raise ImportError("DeBaCl requires the numpy, networkx, and " +
+                      "prettytable packages.")
+
+
+class DeBaClClustering(object):
+    """
+    Level set tree clustering, with the scikit-learn estimator interface.
+    `fit` builds a level set tree with `debacl.construct_tree`, prunes it,
+    and labels the points with `LevelSetTree.get_clusters`.
+
+    Parameters
+    ----------
+    k : int, optional
+        Number of observations to consider as neighbors to each point.
+
+    prune_threshold : int, optional
+        Leaf nodes with fewer than this number of members are recursively
+        merged into larger nodes. If None (default), the tree is not pruned.
+
+    num_levels : int, optional
+        Number of density levels in the tree. If None (default), every
+        distinct density value is a level.
+
+    method : {'leaf', 'first-k', 'upper-level-set', 'k-level'}, optional
+        Cluster labeling method. See `LevelSetTree.get_clusters`.
+
+    method_params : dict, optional
+        Parameters of the labeling method, e.g. {'k': 3} for 'first-k', or
+        {'threshold': 0.5, 'form': 'mass'} for 'upper-level-set'.
+
+    metric : str or callable, optional
+        Distance metric. See `debacl.utils.knn_query`.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    dtype : numpy dtype, optional
+        Precision of the neighbor search. See `debacl.construct_tree`.
+
+    warm_start : bool, optional
+        If True, refitting on the same data with the same 'k', 'metric',
+        'metric_params', and 'dtype' reuses the fitted similarity graph and
+        density estimate, and also the unpruned tree if 'num_levels' is
+        unchanged. Changing only 'prune_threshold', 'method', or
+        'method_params' then costs no more than pruning the tree.
+
+    n_jobs : int, optional
+        Number of threads for the neighbor search, or -1 for one thread per
+        CPU.
+
+    Attributes
+    ----------
+    labels_ : numpy array[int]
+        Cluster label of each point, or -1 for background points. Labels are
+        the indices of the tree nodes for each cluster.
+
+    tree_ : LevelSetTree
+        The pruned level set tree.
+
+    graph_ : numpy array[int]
+        k-nearest neighbors of each unique row of the data.
+
+    density_ : numpy array
+        Estimated density of each unique row of the data.
+
+    See Also
+    --------
+    debacl.construct_tree, debacl.TreeAssigner
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> model = debacl.DeBaClClustering(k=8, prune_threshold=5,
+    ...                                 warm_start=True)
+    >>> labels = model.fit_predict(X)
+
+    Refitting with a new pruning threshold reuses the neighbor graph and the
+    tree.
+
+    >>> labels = model.set_params(prune_threshold=10).fit_predict(X)
+
+    Notes
+    -----
+    The estimator implements `get_params` and `set_params` itself rather
+    than inheriting from scikit-learn's `BaseEstimator`, so importing DeBaCl
+    doesn't import scikit-learn and scipy. Scikit-learn tools such as
+    `clone` and `GridSearchCV` work with it all the same.
+    """
+
+    _estimator_type = 'clusterer'
+    _param_names = ('k', 'prune_threshold', 'num_levels', 'method',
+                    'method_params', 'metric', 'metric_params', 'dtype',
+                    'warm_start', 'n_jobs')
+
+    def __init__(self, k=10, prune_threshold=None, num_levels=None,
+                 method='leaf', method_params=None, metric='euclidean',
+                 metric_params=None, dtype=None, warm_start=False, n_jobs=1):
+        self.k = k
+        self.prune_threshold = prune_threshold
+        self.num_levels = num_levels
+        self.method = method
+        self.method_params = method_params
+        self.metric = metric
+        self.metric_params = metric_params
+        self.dtype = dtype
+        self.warm_start = warm_start
+        self.n_jobs = n_jobs
+
+    def __repr__(self):
+        params = ", ".join("{}={!r}".format(name, value) for name, value
+                           in sorted(self.get_params().items()))
+        return "{}({})".format(type(self).__name__, params)
+
+    def get_params(self, deep=True):
+        """
+        Get the parameters of the estimator.
+
+        Parameters
+        ----------
+        deep : bool, optional
+            Ignored; the estimator has no nested estimators.
+
+        Returns
+        -------
+        params : dict
+            Parameter names mapped to their values.
+        """
+        return {name: getattr(self, name) for name in self._param_names}
+
+    def set_params(self, **params):
+        """
+        Set the parameters of the estimator.
+
+        Parameters
+        ----------
+        params : keyword arguments
+            New parameter values.
+
+        Returns
+        -------
+        self : DeBaClClustering
+        """
+        for name, value in params.items():
+            if name not in self._param_names:
+                raise ValueError(("Invalid parameter '{}' for estimator " +
+                                  "{}.").format(name, type(self).__name__))
+            setattr(self, name, value)
+
+        return self
+
+    def fit(self, X, y=None, sample_weight=None):
+        """
+        Build the level set tree and label the points.
+
+        Parameters
+        ----------
+        X : numpy array | scipy.sparse matrix
+            Data, with each row as an observation.
+
+        y : ignored
+
+        sample_weight : numpy array, optional
+            Weight of each observation. See `debacl.construct_tree`.
+
+        Returns
+        -------
+        self : DeBaClClustering
+        """
+        neighbor_params = (self.k, self.metric, self.metric_params,
+                           self.dtype)
+
+        ## Functions can't be hashed, so callable metrics are never reused.
+        if _cache._has_callable(neighbor_params):
+            fit_key = None
+        else:
+            digest = _hashlib.sha1()
+            _cache._hash_update(digest, (X, sample_weight, neighbor_params))
+            fit_key = digest.hexdigest()
+
+        reuse = (self.warm_start and fit_key is not None and
+                 getattr(self, '_fit_key', None) == fit_key)
+
+        if not reuse:
+            self.graph_, _, self.density_, self._unique_weights, \
+                self._assignment = _lst._neighbors_and_density(
+                    X, self.k, weights=sample_weight, landmarks=None,
+                    dtype=self.dtype, metric=self.metric,
+                    metric_params=self.metric_params, num_components=None,
+                    reduction=None, refine=True, rng=None, n_jobs=self.n_jobs)
+
+            self._fit_key = fit_key
+            self._full_tree = None
+
+        if self._full_tree is None or self._num_levels != self.num_levels:
+            tree = _lst.construct_tree_from_graph(
+                self.graph_, self.density_, num_levels=self.num_levels,
+                weights=self._unique_weights)
+
+            if self._assignment is not None:
+                tree = _lst._expand_tree(tree, self._assignment,
+                                         sample_weight)
+
+            self._full_tree = tree
+            self._num_levels = self.num_levels
+
+        if self.prune_threshold is None:
+            self.tree_ = self._full_tree
+        else:
+            self.tree_ = self._full_tree.prune(self.prune_threshold)
+
+        self._fit_X = X
+        self._assigner = None
+        self.labels_ = self.tree_.get_clusters(
+            self.method, fill_background=True,
+            **(self.method_params or {}))[:, 1]
+
+        return self
+
+    def fit_predict(self, X, y=None, sample_weight=None):
+        """
+        Build the level set tree and return the cluster labels of the points.
+        The parameters are the same as `fit`.
+
+        Returns
+        -------
+        labels : numpy array[int]
+            Cluster label of each point, or -1 for background points.
+        """
+        return self.fit(X, sample_weight=sample_weight).labels_
+
+    def predict(self, X):
+        """
+        Assign new points to the fitted clusters, with
+        `debacl.TreeAssigner`. The assigner is built on the first call after
+        each fit and reused by later calls.
+
+        Parameters
+        ----------
+        X : numpy array
+            New points, with each row as an observation.
+
+        Returns
+        -------
+        labels : numpy array[int]
+            Cluster label of each point, or -1 for background points.
+        """
+        if not hasattr(self, 'tree_'):
+            raise ValueError("The estimator must be fit before predicting.")
+
+        if self._assigner is None:
+            self._assigner = _serving.TreeAssigner(
+                self.tree_, self._fit_X, self.k, self.method,
+                method_params=self.method_params, dtype=self.dtype,
+                metric=self.metric, metric_params=self.metric_params,
+                n_jobs=self.n_jobs)
+
+        return self._assigner(X)
@@ -9,31 +9,40 @@ from __future__ import print_function as _print_function
 from __future__ import absolute_import as _absolute_import
 
 import logging as _logging
+import os as _os
+import time as _time
 import copy as _copy
+import collections as _collections
+import heapq as _heapq
 import pickle as _pickle
+import hashlib as _hashlib
+import threading as _threading
 import debacl.utils as _utl
+import debacl.cache as _cache
 
-_logging.basicConfig(level=_logging.INFO, datefmt='%Y-%m-%d %I:%M:%S',
-                     format='%(levelname)s (%(asctime)s): %(message)s')
+_logger = _logging.getLogger(__name__)
 
-## Required packages
+## Required packages. Networkx and prettytable are imported on first use.
 try:
     import numpy as _np
-    import networkx as _nx
-    from prettytable import PrettyTable as _PrettyTable
 except:
     raise ImportError("DeBaCl requires the numpy, networkx, and " +
                       "prettytable packages.")
 
-## Soft dependencies
-try:
-    import matplotlib.pyplot as _plt
-    from matplotlib.collections import LineCollection as _LineCollection
-    _HAS_MPL = True
-except:
-    _HAS_MPL = False
-    _logging.warning("Matplotlib could not be loaded, so DeBaCl plots will " +
-                     "fail.")
+_nx = _utl._LazyModule('networkx')
+
+## Guards the creation of each tree's cache lock.
+_CACHE_LOCK = _threading.Lock()
+
+## Number of lattice cells whose neighbors are found at once.
+_LATTICE_CHUNK_SIZE = 2**15
+
+_prettytable = _utl._LazyModule('prettytable')
+
+## Soft dependencies, imported on first use.
+_plt = _utl._LazyModule('matplotlib.pyplot')
+_mcollections = _utl._LazyModule('matplotlib.collections')
+_HAS_MPL = _utl._has_module('matplotlib')
 
 
 class ConnectedComponent(object):
@@ -78,16 +87,47 @@ class LevelSetTree(object):
     levels : array_like
         Probability density levels at which to find clusters. Defines the
         vertical resolution of the tree.
+
+    weights : numpy array, optional
+        Weight of each point, e.g. the number of duplicates of each unique
+        row. If specified, node sizes and masses are total weights rather than
+        numbers of points.
     """
 
-    def __init__(self, density=[], levels=[]):
+    # Trees saved before observation weights existed load without them.
+    weights = None
+
+    # Resolution and construction time of trees built from a similarity
+    # graph; see `construct_tree_from_graph`.
+    build_info = None
+
+    # Cluster labels and other query results are cached on the tree, up to
+    # '_cache_size' entries. The cache and its lock are not pickled or
+    # deep-copied.
+    _cache = None
+    _cache_lock = None
+    _cache_size = 32
+
+    def __init__(self, density=[], levels=[], weights=None):
         self.density = density
         self.levels = levels
+        self.weights = weights
         self.num_levels = len(levels)
         self.prune_threshold = None
         self.nodes = {}
         self._subgraphs = {}
 
+    def __getstate__(self):
+        """
+        Drop the query cache when the tree is pickled or copied. Pruning
+        deep-copies the tree before changing its nodes, so the pruned tree
+        starts with an empty cache.
+        """
+        state = self.__dict__.copy()
+        state.pop('_cache', None)
+        state.pop('_cache_lock', None)
+        return state
+
     def __repr__(self):
         """
         Print the tree summary table.
@@ -98,8 +138,9 @@ class LevelSetTree(object):
         """
         Print the tree summary table.
         """
-        summary = _PrettyTable(["id", "start_level", "end_level", "start_mass",
-                                "end_mass", "size", "parent", "children"])
+        summary = _prettytable.PrettyTable(["id", "start_level", "end_level",
+                                            "start_mass", "end_mass", "size",
+                                            "parent", "children"])
         for node_id, v in self.nodes.items():
             summary.add_row([node_id,
                              v.start_level,
@@ -139,6 +180,133 @@ class LevelSetTree(object):
         """
         return self._merge_by_size(threshold)
 
+    def coarsen(self, num_levels, form='mass'):
+        """
+        Snap the tree onto a coarser grid of density levels, without
+        re-building it from the similarity graph. Splits that fall in the same
+        cell of the coarse grid are merged, and the start and end levels and
+        masses of the remaining nodes are recomputed. The LevelSetTree is
+        *immutable*, so coarsening returns a new LevelSetTree.
+
+        Parameters
+        ----------
+        num_levels : int
+            Number of density levels in the coarse grid.
+
+        form : {'mass', 'density'}, optional
+            Type of the coarse grid. If 'mass' (the default), the grid has a
+            uniform number of points between each level, as in the tree
+            constructors. If 'density', the levels are evenly spaced between
+            the minimum and maximum density values.
+
+        Returns
+        -------
+        out : LevelSetTree
+            A level set tree with at most 'num_levels' density levels. The
+            original tree is unchanged.
+
+        See Also
+        --------
+        debacl.utils.define_density_mass_grid,
+        debacl.utils.define_density_level_grid
+
+        Notes
+        -----
+        Each level of the coarse grid is snapped up to the nearest level of
+        the original tree. If the original tree was built with the default
+        `num_levels` and a 'mass' grid is requested, the snapping has no
+        effect and the output is identical to the tree built directly with
+        'num_levels' levels. If the original tree was pruned, the coarse tree
+        is pruned with the same threshold. Observation weights carry over to
+        the coarse grid, masses, and pruning.
+
+        Examples
+        --------
+        >>> X = numpy.random.rand(100, 2)
+        >>> tree = debacl.construct_tree(X, k=8)
+        >>> coarse_tree = tree.coarsen(num_levels=20)
+        """
+
+        ## Define the coarse grid on top of the existing levels.
+        if form == 'mass':
+            grid = _utl.define_density_mass_grid(self.density, num_levels,
+                                                 weights=self.weights)
+        elif form == 'density':
+            grid = _utl.define_density_level_grid(self.density, num_levels)
+        else:
+            raise ValueError("Grid form not understood. 'form' must be " +
+                             "either 'mass' or 'density'.")
+
+        fine_levels = _np.sort(self.levels)
+        snap = _np.searchsorted(fine_levels, grid, side='left')
+        snap = _np.minimum(snap, len(fine_levels) - 1)
+        grid = _np.union1d(fine_levels[snap], fine_levels[-1:])
+
+        ## Mass of the background set at each coarse level.
+        density = _np.asarray(self.density)
+        grid_mass = _background_mass(density, self.weights)(grid)
+
+        ## For each node, find the first coarse level at or above its end.
+        end_index = {k: _np.searchsorted(grid, v.end_level, side='left')
+                     for k, v in self.nodes.items()}
+
+        T = LevelSetTree(self.density, grid, self.weights)
+        T.build_info = self.build_info
+
+        ## Walk down each chain of the original tree. A new node ends at the
+        #  first coarse level where either none or several of the original
+        #  node's descendants are still alive.
+        queue = [(-1, k, None) for k, v in self.nodes.items()
+                 if v.parent is None]
+        _heapq.heapify(queue)
+
+        while len(queue) > 0:
+            start_index, ix, parent = _heapq.heappop(queue)
+            node = self.nodes[ix]
+            new_key = len(T.nodes)
+
+            if parent is None:
+                start_level = node.start_level
+                start_mass = node.start_mass
+                members = set(node.members)
+            else:
+                start_level = grid[start_index]
+                start_mass = grid_mass[start_index]
+                members = _np.fromiter(node.members, dtype=_np.int)
+                members = set(members[density[members] > start_level])
+                T.nodes[parent].children.append(new_key)
+
+            while True:
+                j = end_index[ix]
+                alive = []
+                stack = self.nodes[ix].children[:]
+
+                while len(stack) > 0:
+                    u = stack.pop()
+                    if end_index[u] > j:
+                        alive.append(u)
+                    else:
+                        stack += self.nodes[u].children
+
+                if len(alive) == 1:
+                    ix = alive[0]
+                else:
+                    break
+
+            T.nodes[new_key] = ConnectedComponent(
+                new_key, parent=parent, children=[], start_level=start_level,
+                end_level=grid[j], start_mass=start_mass,
+                end_mass=grid_mass[j], members=members)
+
+            for u in alive:
+                _heapq.heappush(queue, (j, u, new_key))
+
+        ## Re-apply the pruning of the original tree.
+        if self.prune_threshold is not None:
+            T = T.prune(threshold=self.prune_threshold)
+
+        return T
+
     def save(self, filename):
         """
         Save a level set tree object to file. All members of the level set tree
@@ -164,10 +332,13 @@ class LevelSetTree(object):
             _pickle.dump(self, f, _pickle.HIGHEST_PROTOCOL)
 
     def plot(self, form='mass', horizontal_spacing='uniform', color_nodes=[],
-             colormap='Dark2', annotate_nodes=[], annotate_kwargs={}):
+             colormap='Dark2', annotate_nodes=[], annotate_kwargs={},
+             level_of_detail=False, min_pixels=2., min_mass=0.):
         """
         Plot the level set tree as a dendrogram and return coordinates and
-        colors of the branches.
+        colors of the branches. The layout is cached on the tree for each
+        'form' and 'horizontal_spacing', so re-plotting with different
+        'color_nodes' or annotations only redraws the figure.
 
         Parameters
         ----------
@@ -214,6 +385,23 @@ class LevelSetTree(object):
             `alpha` to a value less than 1 can make the node annotations less
             distracting.
 
+        level_of_detail : bool, optional
+            If True, subtrees narrower than 'min_pixels' on screen, or with
+            less than 'min_mass' of the data, are drawn as a single shaded
+            box spanning the subtree, and nodes outside the horizontal view
+            are not drawn. The view is refined when the axes are zoomed,
+            panned, or resized, so the cost of drawing depends on the screen
+            resolution rather than the size of the tree. Recommended for
+            unpruned trees with thousands of nodes.
+
+        min_pixels : float, optional
+            In the level-of-detail mode, the narrowest subtree, in pixels, that
+            is drawn in full.
+
+        min_mass : float, optional
+            In the level-of-detail mode, the smallest subtree, as a fraction
+            of the data, that is drawn in full.
+
         Returns
         -------
         fig : matplotlib figure
@@ -239,6 +427,11 @@ class LevelSetTree(object):
         >>> plot = tree.plot(form='density')
         >>> fig = plot[0]
         >>> fig.show()
+
+        Unpruned trees are easier to explore in the level-of-detail mode.
+
+        >>> tree = debacl.construct_tree(X, k=8)
+        >>> fig = tree.plot(level_of_detail=True, min_mass=0.01)[0]
         """
 
         ## Validate inputs
@@ -262,55 +455,36 @@ class LevelSetTree(object):
                              "of the printed tree, or by printing the " +
                              "tree's `nodes.keys()` attribute.")
 
+        if form not in ('mass', 'density', 'branch-mass'):
+            raise ValueError('Plot form not understood')
+
         ## Constants
         gap = 0.05
         min_node_width = 1.2
 
-        ## Initialize the plot containers
-        node_coords = {}
-        split_coords = {}
-
-        ## Find the root connected components and corresponding plot intervals
-        ix_root = _np.array([k for k, v in self.nodes.iteritems()
-                             if v.parent is None])
-        n_root = len(ix_root)
-        census = _np.array([len(self.nodes[x].members) for x in ix_root],
-                           dtype=_np.float)
-        n = sum(census)
-
-        seniority = _np.argsort(census)[::-1]
-        ix_root = ix_root[seniority]
-        census = census[seniority]
-
-        if horizontal_spacing == 'proportional':
-            weights = census / n
-            intervals = _np.cumsum(weights)
-            intervals = _np.insert(intervals, 0, 0.0)
-        else:
-            intervals = _np.linspace(0.0, 1.0, n_root + 1)
+        ## Node coordinates, from the cached layout.
+        layout = self._plot_layout(form, horizontal_spacing)
+        ids = layout['ids']
+        parent = layout['parent']
+        x, bottom, top = layout['x'], layout['bottom'], layout['top']
 
-        ## Do a depth-first search on each root to get segments for each branch
-        for i, ix in enumerate(ix_root):
-            if form == 'branch-mass':
-                branch = self._construct_mass_map(
-                    ix, 0.0, (intervals[i], intervals[i + 1]),
-                    horizontal_spacing)
-            else:
-                branch = self._construct_branch_map(
-                    ix, (intervals[i], intervals[i + 1]), form,
-                    horizontal_spacing, sort=True)
+        node_coords = {ix: ([xpos, start], [xpos, end]) for ix, xpos, start,
+                       end in zip(ids, x.tolist(), bottom.tolist(),
+                                  top.tolist())}
 
-            branch_node_coords, branch_split_coords, _, _ = branch
-            node_coords.update(branch_node_coords)
-            split_coords.update(branch_split_coords)
+        children = _np.flatnonzero(parent >= 0)
+        split_coords = {ids[c]: ([xpos, level], [child_xpos, level])
+                        for c, xpos, level, child_xpos in zip(
+                            children, x[parent[children]].tolist(),
+                            top[parent[children]].tolist(),
+                            x[children].tolist())}
 
         ## Find the fraction of nodes in each segment (to use as line widths)
-        node_widths = {k: max(min_node_width, 12.0 * len(node.members) / n)
-                       for k, node in self.nodes.items()}
+        n = layout['size'][parent < 0].sum()
+        node_widths = _np.maximum(min_node_width, 12.0 * layout['size'] / n)
 
         ## Get the relevant vertical ticks
-        primary_ticks = [(x[0][1], x[1][1]) for x in node_coords.values()]
-        primary_ticks = _np.unique(_np.array(primary_ticks).flatten())
+        primary_ticks = _np.unique(_np.concatenate((bottom, top)))
         primary_labels = [str(round(tick, 2)) for tick in primary_ticks]
 
         ## Set up the plot framework
@@ -320,8 +494,12 @@ class LevelSetTree(object):
         ax.set_xticks([])
         ax.set_xticklabels([])
         ax.yaxis.grid(color='gray')
-        ax.set_yticks(primary_ticks)
-        ax.set_yticklabels(primary_labels)
+
+        ## A tick at every node level is too many in the level-of-detail
+        #  mode, so matplotlib chooses the ticks instead.
+        if not level_of_detail:
+            ax.set_yticks(primary_ticks)
+            ax.set_yticklabels(primary_labels)
 
         ## Form-specific details
         if form == 'branch-mass':
@@ -329,49 +507,93 @@ class LevelSetTree(object):
             ax.set_ylim((-1.0 * gap * yrange, 1.04 * yrange))
             ax.set_ylabel("branch mass")
 
-        elif form == 'density':
-            ax.set_ylabel("density level")
-            ymin = min([v.start_level for v in self.nodes.itervalues()])
-            ymax = max([v.end_level for v in self.nodes.itervalues()])
-            yrange = ymax - ymin
-            ax.set_ylim(ymin - gap * yrange, ymax + 0.05 * yrange)
+        else:
+            if form == 'density':
+                ax.set_ylabel("density level")
+            else:
+                ax.set_ylabel("mass level")
 
-        elif form == 'mass':
-            ax.set_ylabel("mass level")
-            ymin = min([v.start_mass for v in self.nodes.itervalues()])
-            ymax = max([v.end_mass for v in self.nodes.itervalues()])
+            ymin = bottom.min()
+            ymax = top.max()
             yrange = ymax - ymin
             ax.set_ylim(ymin - gap * yrange, ymax + 0.05 * yrange)
 
-        else:
-            raise ValueError('Plot form not understood')
-
-        ## Color the line segments.
-        node_colors = {k: [0.0, 0.0, 0.0, 1.0] for k, v in self.nodes.items()}
+        ## Color the line segments. Each subtree is a contiguous block of the
+        #  nodes in depth-first order.
+        colors = _np.zeros((len(ids), 4))
+        colors[:, 3] = 1.0
         palette = _plt.get_cmap(colormap)
         colorset = palette(_np.linspace(0, 1, len(color_nodes)))
+        index = {ix: i for i, ix in enumerate(ids)}
+        depth_first = _np.argsort(layout['preorder'])
 
         for i, ix in enumerate(color_nodes):
-            subtree = self._make_subtree(ix)
+            first = layout['preorder'][index[ix]]
+            subtree = depth_first[first:first +
+                                  layout['num_descendants'][index[ix]]]
+            colors[subtree] = colorset[i]
 
-            for ix_sub in subtree.nodes.keys():
-                node_colors[ix_sub] = list(colorset[i])
+        node_colors = dict(zip(ids, colors.tolist()))
 
         ## Add the line segments to the figure.
-        line_coords = [node_coords[c] for c in node_coords.keys()]
-        line_widths = [node_widths[c] for c in node_coords.keys()]
-        line_colors = [node_colors[c] for c in node_coords.keys()]
-
-        node_lines = _LineCollection(line_coords, linewidths=line_widths,
-                                     colors=line_colors)
+        node_segments = _np.empty((len(ids), 2, 2))
+        node_segments[:, :, 0] = x[:, _np.newaxis]
+        node_segments[:, 0, 1] = bottom
+        node_segments[:, 1, 1] = top
+
+        node_lines = _mcollections.LineCollection(node_segments,
+                                                  linewidths=node_widths,
+                                                  colors=colors)
         ax.add_collection(node_lines)
 
-        line_coords = [split_coords[c] for c in split_coords.keys()]
-        line_colors = [node_colors[c] for c in split_coords.keys()]
+        split_segments = _np.empty((len(children), 2, 2))
+        split_segments[:, 0, 0] = x[parent[children]]
+        split_segments[:, 1, 0] = x[children]
+        split_segments[:, :, 1] = top[parent[children]][:, _np.newaxis]
 
-        split_lines = _LineCollection(line_coords, colors=line_colors)
+        split_lines = _mcollections.LineCollection(split_segments,
+                                                   colors=colors[children])
         ax.add_collection(split_lines)
 
+        ## In the level-of-detail mode, draw only what the current view can
+        #  resolve, and redraw when the view changes.
+        if level_of_detail:
+            glyphs = _mcollections.PolyCollection([], linewidths=0.5)
+            ax.add_collection(glyphs)
+
+            glyph_colors = colors.copy()
+            glyph_colors[:, 3] = 0.35
+
+            def refine(*args):
+                drawn, collapsed = _detail_view(
+                    layout, ax.get_xlim(), ax.bbox.width, min_pixels,
+                    min_mass)
+
+                node_lines.set_segments(node_segments[drawn])
+                node_lines.set_linewidths(node_widths[drawn])
+                node_lines.set_color(colors[drawn])
+
+                shown = (drawn[parent[children]] &
+                         (drawn[children] | collapsed[children]))
+                split_lines.set_segments(split_segments[shown])
+                split_lines.set_color(colors[children[shown]])
+
+                boxes = _np.flatnonzero(collapsed)
+                verts = _np.empty((len(boxes), 4, 2))
+                verts[:, [0, 3], 0] = layout['low'][boxes, _np.newaxis]
+                verts[:, [1, 2], 0] = layout['high'][boxes, _np.newaxis]
+                verts[:, :2, 1] = bottom[boxes, _np.newaxis]
+                verts[:, 2:, 1] = layout['subtree_top'][boxes, _np.newaxis]
+                glyphs.set_verts(verts)
+                glyphs.set_facecolor(glyph_colors[boxes])
+                glyphs.set_edgecolor(colors[boxes])
+
+                fig.canvas.draw_idle()
+
+            refine()
+            ax.callbacks.connect('xlim_changed', refine)
+            fig.canvas.mpl_connect('resize_event', refine)
+
         ## Add node IDs above specified dendrogram branches.
         for idx in set(annotate_nodes):
             horizontal_coord = node_coords[idx][1][0]
@@ -444,6 +666,21 @@ class LevelSetTree(object):
         >>> labels = tree.get_clusters(method='leaf')
         """
 
+        ## Labels are cached by query, and copied so the caller can modify
+        #  them.
+        key = ('clusters', method, bool(fill_background),
+               tuple(sorted(kwargs.items())))
+        labels = self._cached(key, lambda: self._cluster_labels(
+            method, fill_background, **kwargs))
+
+        return labels.copy()
+
+    def _cluster_labels(self, method, fill_background, **kwargs):
+        """
+        Compute cluster labels for `get_clusters`, without the cache. The
+        parameters and output are described in `get_clusters`.
+        """
+
         ## Retrieve foreground labels.
         if method == 'leaf':
             labels = self._leaf_cluster()
@@ -605,7 +842,7 @@ class LevelSetTree(object):
 
         ## remove small root branches
         small_roots = [k for k, v in tree.nodes.iteritems()
-                       if v.parent is None and len(v.members) <= threshold]
+                       if v.parent is None and tree._node_size(k) <= threshold]
 
         for root in small_roots:
             root_tree = tree._make_subtree(root)
@@ -621,7 +858,7 @@ class LevelSetTree(object):
             parent = tree.nodes[ix_parent]
 
             # get size of each child
-            kid_size = {k: len(tree.nodes[k].members) for k in parent.children}
+            kid_size = {k: tree._node_size(k) for k in parent.children}
 
             # count children larger than 'threshold'
             n_bigkid = sum(_np.array(kid_size.values()) >= threshold)
@@ -791,19 +1028,28 @@ class LevelSetTree(object):
                             if (v.start_level <= threshold and
                                 v.end_level > threshold)]
 
-            ## find intersection between upper set points and each active
-            #  component
-            points = []
-            cluster = []
+            ## Each upper set point belongs to the active ancestor of the
+            #  highest density node that contains it, if there is one.
+            node_index, point_node = self._point_node_map()
+            active = _np.full(len(node_index) + 1, -1, dtype=_np.int)
+
+            for rank, c in enumerate(active_nodes):
+                stack = [c]
+                while len(stack) > 0:
+                    u = stack.pop()
+                    active[node_index[u]] = rank
+                    stack += self.nodes[u].children
 
-            for c in active_nodes:
-                cluster_mask = _np.in1d(upper_level_set,
-                                        list(self.nodes[c].members))
-                cluster_pts = upper_level_set[cluster_mask]
-                points.extend(cluster_pts)
-                cluster += ([c] * len(cluster_pts))
+            rank = active[point_node[upper_level_set]]
+            keep = rank >= 0
+            points = upper_level_set[keep]
+            rank = rank[keep]
 
-            labels = _np.array([points, cluster], dtype=_np.int).T
+            ## Group the points by active node, in the order of the nodes.
+            order = _np.argsort(rank, kind='mergesort')
+            cluster = _np.array(active_nodes, dtype=_np.int)[rank[order]]
+
+            labels = _np.array([points[order], cluster], dtype=_np.int).T
             return labels
 
     def _first_K_level_cluster(self, k):
@@ -863,6 +1109,8 @@ class LevelSetTree(object):
         -------
         """
 
+        self._cache = None
+
         for ix in active_nodes:
             subtree = self._make_subtree(ix)
 
@@ -918,325 +1166,350 @@ class LevelSetTree(object):
 
         return cut
 
-    def _construct_branch_map(self, ix, interval, form, horizontal_spacing,
-                              sort):
+    def _plot_layout(self, form, horizontal_spacing):
         """
-        Map level set tree nodes to locations in a plot canvas. Finds the plot
-        coordinates of vertical line segments corresponding to LST nodes and
-        horizontal line segments corresponding to node splits. Also provides
-        indices of vertical segments and splits for downstream use with
-        interactive plot picker tools. This function is not meant to be called
-        by the user; it is a helper function for the LevelSetTree.plot()
-        method. This function is recursive: it calls itself to map the
-        coordinates of children of the current node 'ix'.
-
-        Parameters
-        ----------
-        ix : int
-            The tree node to map.
-
-        interval: length 2 tuple of floats
-            Horizontal space allocated to node 'ix'.
-
-        form : {'density', 'mass'}, optional
-
-        horizontal_spacing : {'uniform', 'proportional'}, optional
-            Determines how much horizontal space each level set tree node is
-            given. See LevelSetTree.plot() for more information.
-
-        sort : bool
-            If True, sort sibling nodes from most to least points and draw left
-            to right. Also sorts root nodes in the same way.
+        Compute the dendrogram layout for `plot`: the horizontal position and
+        vertical extent of the segment for each node. The layout is computed
+        one depth of the tree at a time with array operations over the node
+        table, so deep trees don't hit the recursion limit, and it is cached
+        for each 'form' and 'horizontal_spacing'. This function is not meant
+        to be called by the user.
+
+        Siblings (and roots) are drawn left to right from largest to
+        smallest, and each node is centered over its children. As in earlier
+        versions of DeBaCl, the children in the 'density' and 'mass' forms
+        are spaced in proportion to their size when 'horizontal_spacing' is
+        'uniform', and evenly when it is 'proportional'.
 
         Returns
         -------
-        segments : dict
-            A dictionary with values that contain the coordinates of vertical
-            line segment endpoints. This is only useful to the interactive
-            analysis tools.
-
-        segmap : list
-            Indicates the order of the vertical line segments as returned by
-            the recursive coordinate mapping function, so they can be picked by
-            the user in the interactive tools.
-
-        splits : dict
-            Dictionary values contain the coordinates of horizontal line
-            segments (i.e. node splits).
-
-        splitmap : list
-            Indicates the order of horizontal line segments returned by
-            recursive coordinate mapping function, for use with interactive
-            tools.
+        layout : dict [str, numpy array]
+            Arrays over the tree nodes, in the order of 'ids'.
+
+            - 'ids': node indices, in increasing order (a list).
+            - 'parent': position of each node's parent, or -1 for roots.
+            - 'size': size of each node, as in `_node_size`.
+            - 'x': horizontal position of each node's segment.
+            - 'low', 'high': horizontal interval of each node's subtree.
+            - 'bottom', 'top': vertical extent of each node's segment.
+            - 'subtree_top': highest top of the segments in each node's
+              subtree.
+            - 'preorder': position of each node in depth-first order.
+            - 'num_descendants': number of nodes in each node's subtree,
+              including the node itself.
         """
+        if form not in ('mass', 'density', 'branch-mass'):
+            raise ValueError('Plot form not understood')
 
-        ## get children
-        children = _np.array(self.nodes[ix].children)
-        n_child = len(children)
-
-        ## if there's no children, just one segment at the interval mean
-        if n_child == 0:
-            xpos = _np.mean(interval)
-            segments = {}
-            segmap = [ix]
-            splits = {}
-            splitmap = []
-
+        if horizontal_spacing not in ('uniform', 'proportional'):
+            raise ValueError("'horizontal_spacing' argument not " +
+                             "understood. 'horizontal_spacing' " +
+                             "must be either 'uniform' or 'proportional'.")
+
+        def compute():
+            node_index, point_node = self._point_node_map()
+            ids = sorted(self.nodes)
+            num_nodes = len(ids)
+
+            parent = _np.array([-1 if self.nodes[ix].parent is None else
+                                node_index[self.nodes[ix].parent]
+                                for ix in ids], dtype=_np.int)
+            is_root = parent < 0
+
+            ## Ties between siblings of the same size are broken by their
+            #  order in the parent's list of children, or for roots in the
+            #  node dictionary.
+            rank = _np.zeros(num_nodes, dtype=_np.int)
+            roots = [k for k, v in self.nodes.items() if v.parent is None]
+            rank[[node_index[ix] for ix in roots]] = _np.arange(len(roots))
+            for ix in ids:
+                for i, child in enumerate(self.nodes[ix].children):
+                    rank[node_index[child]] = i
+
+            ## Node sizes and subtree node counts, from the deepest nodes up.
+            #  Each point is counted in its highest density node.
+            size = _np.bincount(point_node, weights=self.weights,
+                                minlength=num_nodes + 1)[:num_nodes]
+            size = size.astype(_np.float)
+            num_descendants = _np.ones(num_nodes, dtype=_np.int)
+
+            by_parent = _np.argsort(parent, kind='mergesort')
+            for level in _tree_levels(parent, by_parent)[:0:-1]:
+                _np.add.at(size, parent[level], size[level])
+                _np.add.at(num_descendants, parent[level],
+                           num_descendants[level])
+
+            ## Sort siblings from largest to smallest, and group the nodes by
+            #  depth in that order.
+            order = _np.lexsort((-rank, -size, parent))
+            levels = _tree_levels(parent, order)
+
+            num_children = _np.bincount(parent[~is_root],
+                                        minlength=num_nodes)
+            child_size = _np.bincount(parent[~is_root],
+                                      weights=size[~is_root],
+                                      minlength=num_nodes)
+
+            num_siblings = _np.where(is_root, is_root.sum(),
+                                     num_children[parent])
+            sibling_size = _np.where(is_root, size[is_root].sum(),
+                                     child_size[parent])
+
+            ## Offsets of each node among its siblings, in sibling order.
+            child_start = (is_root.sum() + _np.cumsum(num_children) -
+                           num_children)
+            first = _np.where(is_root[order], 0, child_start[parent[order]])
+
+            def sibling_offset(values):
+                ordered = values[order]
+                offset = _np.cumsum(ordered) - ordered
+                result = _np.empty(num_nodes, dtype=offset.dtype)
+                result[order] = offset - offset[first]
+                return result
+
+            ## Horizontal interval of each node, as fractions of the parent's
+            #  interval.
+            if form == 'branch-mass':
+                proportional = horizontal_spacing == 'proportional'
+            else:
+                proportional = horizontal_spacing == 'uniform'
+            proportional = _np.where(is_root,
+                                     horizontal_spacing == 'proportional',
+                                     proportional)
+
+            weight = size / sibling_size
+            weight_low = sibling_offset(weight)
+            position = sibling_offset(_np.ones(num_nodes, dtype=_np.int))
+
+            low = _np.where(proportional, weight_low,
+                            position * (1.0 / num_siblings))
+            high = _np.where(proportional, weight_low + weight,
+                             (position + 1) * (1.0 / num_siblings))
+            high[~proportional & (position + 1 == num_siblings)] = 1.0
+
+            ## Vertical extents.
             if form == 'density':
-                segments[ix] = (
-                    ([xpos, self.nodes[ix].start_level],
-                     [xpos, self.nodes[ix].end_level]))
+                bottom = _np.array([self.nodes[ix].start_level for ix in ids])
+                top = _np.array([self.nodes[ix].end_level for ix in ids])
+            elif form == 'mass':
+                bottom = _np.array([self.nodes[ix].start_mass for ix in ids])
+                top = _np.array([self.nodes[ix].end_mass for ix in ids])
             else:
-                segments[ix] = (
-                    ([xpos, self.nodes[ix].start_mass],
-                     [xpos, self.nodes[ix].end_mass]))
+                bottom = _np.zeros(num_nodes)
+                top = (size - child_size) / float(self._node_size(None))
+
+            ## Absolute intervals, depth-first positions, and branch-mass
+            #  piles, from the roots down.
+            preorder = sibling_offset(num_descendants)
+
+            for level in levels[1:]:
+                above = parent[level]
+                scale = high[above] - low[above]
+                low[level] = low[above] + low[level] * scale
+                high[level] = low[above] + high[level] * scale
+                preorder[level] += preorder[above] + 1
+
+                if form == 'branch-mass':
+                    bottom[level] = top[above]
+                    top[level] += top[above]
+
+            ## Leaves are centered in their intervals, and parents over their
+            #  children, from the deepest nodes up.
+            x = (low + high) / 2.
+            subtree_top = top.copy()
+
+            for level in levels[:0:-1]:
+                above = _np.unique(parent[level])
+                x_sum = _np.zeros(num_nodes)
+                _np.add.at(x_sum, parent[level], x[level])
+                x[above] = x_sum[above] / num_children[above]
+                _np.maximum.at(subtree_top, parent[level], subtree_top[level])
+
+            return {'ids': ids, 'parent': parent, 'size': size, 'x': x,
+                    'low': low, 'high': high, 'bottom': bottom, 'top': top,
+                    'subtree_top': subtree_top, 'preorder': preorder,
+                    'num_descendants': num_descendants}
+
+        return self._cached(('layout', form, horizontal_spacing), compute)
 
-        ## else, construct child branches then figure out parent's
-        ## position
-        else:
-            parent_range = interval[1] - interval[0]
-            segments = {}
-            segmap = [ix]
-            splits = {}
-            splitmap = []
+    def _mass_to_density(self, mass):
+        """
+        Convert the specified mass level value into a density level value.
 
-            census = _np.array([len(self.nodes[x].members) for x in children],
-                               dtype=_np.float)
-            weights = census / sum(census)
+        Parameters
+        ----------
+        mass : float
+            Float in the interval [0.0, 1.0], with the desired fraction of all
+            points.
 
-            if sort is True:
-                seniority = _np.argsort(weights)[::-1]
-                children = children[seniority]
-                weights = weights[seniority]
+        Returns
+        -------
+        level: float
+            Density level corresponding to the 'mass' fraction of background
+            points.
+        """
+        density_order, mass_below = self._cached(('density_order',),
+                                                 self._density_order)
+        n = len(self.density)
 
-            ## get relative branch intervals
-            if horizontal_spacing == 'uniform':
-                child_intervals = _np.cumsum(weights)
-                child_intervals = _np.insert(child_intervals, 0, 0.0)
+        if self.weights is None:
+            mass_fraction = max(0, int(round(mass * n)) - 1)
+        else:
+            mass_fraction = _np.searchsorted(mass_below, mass * mass_below[-1])
+            mass_fraction = min(mass_fraction, n - 1)
 
-            elif horizontal_spacing == 'proportional':
-                child_intervals = _np.linspace(0.0, 1.0, n_child + 1)
+        level_index = density_order[mass_fraction]
+        level = self.density[level_index]
 
-            else:
-                raise ValueError("'horizontal_spacing' argument not " +
-                                 "understood. 'horizontal_spacing' " +
-                                 "must be either 'uniform' or 'proportional'.")
-
-            ## loop over the children
-            for j, child in enumerate(children):
-
-                ## translate local interval to absolute interval
-                branch_interval = (
-                    interval[0] + child_intervals[j] * parent_range,
-                    interval[0] + child_intervals[j + 1] * parent_range)
-
-                ## recurse on the child
-                branch = self._construct_branch_map(child, branch_interval,
-                                                    form, horizontal_spacing,
-                                                    sort)
-                branch_segs, branch_splits, branch_segmap, \
-                    branch_splitmap = branch
-
-                segmap += branch_segmap
-                splitmap += branch_splitmap
-                splits = dict(splits.items() + branch_splits.items())
-                segments = dict(segments.items() + branch_segs.items())
-
-            ## find the middle of the children's x-position and make vertical
-            #  segment ix
-            children_xpos = _np.array([segments[k][0][0] for k in children])
-            xpos = _np.mean(children_xpos)
-
-            ## add horizontal segments to the list
-            for child in children:
-                splitmap.append(child)
-                child_xpos = segments[child][0][0]
-
-                if form == 'density':
-                    splits[child] = (
-                        [xpos, self.nodes[ix].end_level],
-                        [child_xpos, self.nodes[ix].end_level])
-                else:
-                    splits[child] = (
-                        [xpos, self.nodes[ix].end_mass],
-                        [child_xpos, self.nodes[ix].end_mass])
+        return level
 
-            ## add vertical segment for current node
-            if form == 'density':
-                segments[ix] = (
-                    ([xpos, self.nodes[ix].start_level],
-                     [xpos, self.nodes[ix].end_level]))
-            else:
-                segments[ix] = (
-                    ([xpos, self.nodes[ix].start_mass],
-                     [xpos, self.nodes[ix].end_mass]))
+    def _density_order(self):
+        """
+        Sort the points by density, for `_mass_to_density`.
 
-        return segments, splits, segmap, splitmap
+        Returns
+        -------
+        density_order : numpy array[int]
+            Point indices in increasing order of density.
 
-    def _construct_mass_map(self, ix, start_pile, interval,
-                            horizontal_spacing):
+        mass_below : numpy array
+            Cumulative weight of the points in 'density_order', or None if the
+            tree has no observation weights.
         """
-        Map level set tree nodes to locations in a plot canvas. Finds the plot
-        coordinates of vertical line segments corresponding to LST nodes and
-        horizontal line segments corresponding to node splits. Also provides
-        indices of vertical segments and splits for downstream use with
-        interactive plot picker tools. This function is not meant to be called
-        by the user; it is a helper function for the LevelSetTree.plot()
-        method. This function is recursive: it calls itself to map the
-        coordinates of children of the current node 'ix'. Differs from
-        'constructBranchMap' by setting the height of each vertical segment to
-        be proportional to the number of points in the corresponding LST node.
-
-        Parameters
-        ----------
-        ix : int
-            The tree node to map.
+        density_order = _np.argsort(self.density)
 
-        start_pile: float
-            The height of the branch on the plot at it's start (i.e. lower
-            terminus).
+        if self.weights is None:
+            mass_below = None
+        else:
+            mass_below = _np.cumsum(self.weights[density_order])
 
-        interval: length 2 tuple of floats
-            Horizontal space allocated to node 'ix'.
+        return density_order, mass_below
 
-        horizontal_spacing : {'uniform', 'proportional'}, optional
-            Determines how much horizontal space each level set tree node is
-            given. See LevelSetTree.plot() for more information.
+    def _point_node_map(self):
+        """
+        Map each point to the highest density node that contains it, i.e. its
+        node in `branch_partition`. The map is cached on the tree.
 
         Returns
         -------
-        segments : dict
-            A dictionary with values that contain the coordinates of vertical
-            line segment endpoints. This is only useful to the interactive
-            analysis tools.
-
-        segmap : list
-            Indicates the order of the vertical line segments as returned by
-            the recursive coordinate mapping function, so they can be picked by
-            the user in the interactive tools.
-
-        splits : dict
-            Dictionary values contain the coordinates of horizontal line
-            segments (i.e. node splits).
-
-        splitmap : list
-            Indicates the order of horizontal line segments returned by
-            recursive coordinate mapping function, for use with interactive
-            tools.
+        node_index : dict [int, int]
+            Position of each tree node in the map.
+
+        point_node : numpy array[int]
+            For each point, the position of its node in 'node_index', or
+            len(node_index) if no node contains the point.
         """
 
-        size = float(len(self.nodes[ix].members))
+        def compute():
+            node_index = {ix: i for i, ix in enumerate(sorted(self.nodes))}
+            point_node = _np.full(len(self.density), len(node_index),
+                                  dtype=_np.int)
 
-        ## get children
-        children = _np.array(self.nodes[ix].children)
-        n_child = len(children)
+            ## Parents are labeled before their children, which overwrite
+            #  them.
+            stack = [k for k, v in self.nodes.items() if v.parent is None]
+            while len(stack) > 0:
+                ix = stack.pop()
+                members = _np.fromiter(self.nodes[ix].members, dtype=_np.int,
+                                       count=len(self.nodes[ix].members))
+                point_node[members] = node_index[ix]
+                stack += self.nodes[ix].children
 
-        ## if there's no children, just one segment at the interval mean
-        if n_child == 0:
-            xpos = _np.mean(interval)
-            end_pile = start_pile + size / len(self.density)
-            segments = {}
-            segmap = [ix]
-            splits = {}
-            splitmap = []
-            segments[ix] = ([xpos, start_pile], [xpos, end_pile])
+            return node_index, point_node
 
-        else:
-            parent_range = interval[1] - interval[0]
-            segments = {}
-            segmap = [ix]
-            splits = {}
-            splitmap = []
-
-            census = _np.array([len(self.nodes[x].members) for x in children],
-                               dtype=_np.float)
-            weights = census / sum(census)
-
-            seniority = _np.argsort(weights)[::-1]
-            children = children[seniority]
-            weights = weights[seniority]
-
-            ## get relative branch intervals
-            if horizontal_spacing == 'proportional':
-                child_intervals = _np.cumsum(weights)
-                child_intervals = _np.insert(child_intervals, 0, 0.0)
-            else:
-                child_intervals = _np.linspace(0.0, 1.0, n_child + 1)
+        return self._cached(('point_node',), compute)
+
+    def _cached(self, key, compute):
+        """
+        Look up 'key' in the tree's query cache, calling 'compute' to fill in
+        the value if it is missing. The least recently used entries are
+        dropped when the cache holds more than '_cache_size' entries. The
+        cache is safe to use from several threads; 'compute' runs without the
+        lock, so two threads may compute the same value.
 
-            ## find height of the branch
-            end_pile = start_pile + (size - sum(census)) / len(self.density)
+        Parameters
+        ----------
+        key : tuple
+            Query key. If it is not hashable, the value is not cached.
 
-            ## loop over the children
-            for j, child in enumerate(children):
+        compute : function
+            Function with no arguments that computes the value.
+        """
+        if self._cache_lock is None:
+            with _CACHE_LOCK:
+                if self._cache_lock is None:
+                    self._cache_lock = _threading.Lock()
 
-                ## translate local interval to absolute interval
-                branch_interval = (
-                    interval[0] + child_intervals[j] * parent_range,
-                    interval[0] + child_intervals[j + 1] * parent_range)
+        with self._cache_lock:
+            if self._cache is None:
+                self._cache = _collections.OrderedDict()
 
-                ## recurse on the child
-                branch = self._construct_mass_map(child, end_pile,
-                                                  branch_interval,
-                                                  horizontal_spacing)
-                branch_segs, branch_splits, branch_segmap, \
-                    branch_splitmap = branch
+            try:
+                value = self._cache.pop(key)
+                self._cache[key] = value
+                return value
+            except KeyError:
+                hashable = True
+            except TypeError:
+                hashable = False
 
-                segmap += branch_segmap
-                splitmap += branch_splitmap
-                splits = dict(splits.items() + branch_splits.items())
-                segments = dict(segments.items() + branch_segs.items())
+        ## Compute outside the lock; 'compute' may itself query the cache.
+        value = compute()
 
-            ## find the middle of the children's x-position and make vertical
-            ## segment ix
-            children_xpos = _np.array([segments[k][0][0] for k in children])
-            xpos = _np.mean(children_xpos)
+        if not hashable:
+            return value
 
-            ## add horizontal segments to the list
-            for child in children:
-                splitmap.append(child)
-                child_xpos = segments[child][0][0]
-                splits[child] = ([xpos, end_pile], [child_xpos, end_pile])
+        with self._cache_lock:
+            self._cache[key] = value
 
-            ## add vertical segment for current node
-            segments[ix] = ([xpos, start_pile], [xpos, end_pile])
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
 
-        return segments, splits, segmap, splitmap
+        return value
 
-    def _mass_to_density(self, mass):
+    def _node_size(self, ix):
         """
-        Convert the specified mass level value into a density level value.
+        Return the size of node 'ix', i.e. the number of its members, or their
+        total weight if the tree has observation weights.
 
         Parameters
         ----------
-        mass : float
-            Float in the interval [0.0, 1.0], with the desired fraction of all
-            points.
+        ix : int
+            Tree node. If None, return the size of the whole dataset.
 
         Returns
         -------
-        level: float
-            Density level corresponding to the 'mass' fraction of background
-            points.
+        size : int or float
         """
-        density_order = _np.argsort(self.density)
-        n = len(self.density)
-        mass_fraction = max(0, int(round(mass * n)) - 1)
-        level_index = density_order[mass_fraction]
-        level = self.density[level_index]
 
-        return level
+        if ix is None:
+            members = slice(None)
+            num_members = len(self.density)
+        else:
+            members = list(self.nodes[ix].members)
+            num_members = len(members)
+
+        if self.weights is None:
+            return num_members
+        else:
+            return _np.sum(self.weights[members])
 
 
 #############################################
 ### LEVEL SET TREE CONSTRUCTION FUNCTIONS ###
 #############################################
-def construct_tree(X, k, prune_threshold=None, num_levels=None, verbose=False):
+def construct_tree(X, k, prune_threshold=None, num_levels=None, verbose=False,
+                   weights=None, landmarks=None, dtype=None,
+                   metric='euclidean', metric_params=None, num_components=None,
+                   reduction='random_projection', refine=True,
+                   random_state=None, cache=None, time_budget=None,
+                   cancel=None, n_jobs=1, memory_limit=None, cache_key=None):
     """
     Construct a level set tree from tabular data.
 
     Parameters
     ----------
-    X : 2-dimensional numpy array
+    X : 2-dimensional numpy array or scipy sparse matrix
         Numeric dataset, where each row represents one observation.
 
     k : int
@@ -1252,8 +1525,91 @@ def construct_tree(X, k, prune_threshold=None, num_levels=None, verbose=False):
         `num_levels` is internally set to be the number of rows in `X`.
 
     verbose : bool, optional
-        If True, a progress indicator is printed at every 100th level of tree
-        construction.
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    weights : numpy array, optional
+        Weight of each observation. If None (default), every observation has
+        weight 1. Node sizes (for pruning) and masses are total weights.
+
+    landmarks : int or 2-dimensional numpy array, optional
+        If specified, density is estimated approximately from the distances
+        to a set of landmark points, instead of the k-nearest neighbors in
+        'X'. Either the number of rows of 'X' to sample as landmarks, or an
+        array of landmark points. See `debacl.utils.landmark_density`. Not
+        supported with the 'precomputed' metric.
+
+    dtype : numpy dtype, optional
+        Precision of the neighbor distance computations. With
+        'numpy.float32', candidate neighbors are found in single precision
+        and re-ranked in double precision, so the tree is not affected by
+        the precision loss. See `debacl.utils.knn_query`.
+
+    metric : str or callable, optional
+        Distance metric for the similarity graph and density estimate. See
+        `debacl.utils.knn_query`. If 'precomputed', 'X' is a condensed or
+        square distance matrix, as for `debacl.utils.knn_graph`; duplicate
+        points are not collapsed in this case.
+
+    metric_params : dict, optional
+        Parameters of the distance metric, e.g. the exponent 'p' for the
+        'minkowski' metric. See `debacl.utils.knn_query`.
+
+    num_components : int, optional
+        If specified, the data is first projected onto this many dimensions,
+        and candidate neighbors are found in the projected space, with a
+        KD-tree if 'num_components' is at most 20. Requires the Euclidean
+        metric.
+
+    reduction : {'random_projection', 'pca'}, optional
+        Projection method, if 'num_components' is specified. See
+        `debacl.utils.reduce_dimension`.
+
+    refine : bool, optional
+        If True (default), twice 'k' candidate neighbors are found in the
+        projected space, then re-ranked with exact distances in the original
+        space, which are also used for the density estimate. If False, the
+        neighbors and distances in the projected space are used directly.
+
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random number generator for the projection and the landmark
+        sample. If None, numpy's global random number generator is used.
+
+    cache : str or debacl.cache.NeighborCache, optional
+        Cache directory for the similarity graph, neighbor radii, and density
+        estimate. They are keyed by a hash of 'X', the parameters above that
+        affect them, and the planned neighbor search method, so building
+        another tree with a different 'prune_threshold' or 'num_levels' skips
+        the neighbor search. Results that depend on random numbers are cached
+        only if 'random_state' is an integer. Results for a callable 'metric',
+        or 'metric_params' with callables, are cached only with a
+        'cache_key'.
+
+    time_budget : float, optional
+        Time limit in seconds for the whole construction. The similarity graph
+        and density estimate are always computed; the tree is then refined
+        from a coarse mass grid toward 'num_levels' levels for the rest of the
+        budget. See `construct_tree_from_graph`.
+
+    cancel : function, optional
+        Function with no arguments that returns True to stop refining the
+        tree. See `construct_tree_from_graph`.
+
+    n_jobs : int, optional
+        Number of threads for the neighbor search, or -1 for one thread per
+        CPU. See `debacl.utils.knn_graph`.
+
+    memory_limit : int, optional
+        Memory budget in bytes. The neighbor search method and block size
+        are chosen with `debacl.utils.plan_resources` to fit in the budget,
+        and a MemoryError is raised before the search starts if the
+        estimated peak memory of the construction exceeds it. If None
+        (default), the memory available to the process.
+
+    cache_key : str, optional
+        Name of a callable 'metric' and its 'metric_params' in the cache key.
+        Functions can't be hashed by their contents, so the name must change
+        whenever the metric or its parameters do.
 
     Returns
     -------
@@ -1264,6 +1620,30 @@ def construct_tree(X, k, prune_threshold=None, num_levels=None, verbose=False):
     --------
     construct_tree_from_graph, LevelSetTree
 
+    Notes
+    -----
+    Duplicate rows of 'X' are collapsed into a single row, weighted by the
+    number of duplicates, before building the similarity graph and density
+    estimate. This avoids zero k'th neighbor distances, which would make the
+    density estimate infinite. The members of the output tree are still the
+    row indices of 'X'.
+
+    With 'landmarks', only the density estimate is approximate; the
+    similarity graph is still the k-nearest neighbor graph of 'X'. Landmarks
+    sampled from weighted observations carry the observations' weights.
+
+    Sparse 'X' is never densified; neighbors are found with blocked
+    sparse products. The kNN density estimate uses the ball volume of the
+    metric; for the 'cosine', 'inner_product', and callable metrics the
+    dimension is set to 1, which preserves the relative order of the
+    estimates, and hence the shape of the tree (see
+    `debacl.utils.density_dimension`). The 'inner_product' metric assumes
+    rows with unit norm.
+
+    With 'verbose', the distortion of the projected distances on a sample of
+    pairs is logged. To inspect it directly, use
+    `debacl.utils.reduce_dimension` and `debacl.utils.projection_distortion`.
+
     Examples
     --------
     >>> X = numpy.random.rand(100, 2)
@@ -1280,154 +1660,1320 @@ def construct_tree(X, k, prune_threshold=None, num_levels=None, verbose=False):
     +----+-------------+-----------+------------+----------+------+--------+----------+
     """
 
-    sim_graph, radii = _utl.knn_graph(X, k, method='brute_force')
+    if num_components is not None and metric != 'euclidean':
+        raise ValueError("Dimensionality reduction requires the " +
+                         "'euclidean' metric.")
 
-    n, p = X.shape
-    density = _utl.knn_density(radii, n, p, k)
+    if landmarks is not None and metric == 'precomputed':
+        raise ValueError("Landmarks are not supported for precomputed " +
+                         "distances.")
 
-    tree = construct_tree_from_graph(adjacency_list=sim_graph, density=density,
-                                     prune_threshold=prune_threshold,
-                                     num_levels=num_levels, verbose=verbose)
+    start_time = _time.time()
 
-    return tree
+    params = dict(weights=weights, landmarks=landmarks, dtype=dtype,
+                  metric=metric, metric_params=metric_params,
+                  num_components=num_components, reduction=reduction,
+                  refine=refine)
 
+    ## Results that depend on the random number generator are cached only
+    ## if it is seeded.
+    random = (num_components is not None or
+              isinstance(landmarks, (int, _np.integer)))
+    seeded = isinstance(random_state, (int, _np.integer))
 
-def construct_tree_from_graph(adjacency_list, density, prune_threshold=None,
-                              num_levels=None, verbose=False):
-    """
-    Construct a level set tree from a similarity graph and a density estimate.
+    ## Functions are keyed by the name the caller gives them.
+    key_params = params
+    if _cache._has_callable((metric, metric_params)):
+        if cache_key is None:
+            cache = None
+        else:
+            key_params = dict(params, metric=cache_key, metric_params=None)
+
+    ## Plan the neighbor search first, so that it fails early if there isn't
+    #  enough memory, and so that cached results are keyed by the method.
+    if num_components is None:
+        plan = _plan_neighbors(X, k, memory_limit, num_levels, dtype, metric,
+                               landmarks, n_jobs)
+    else:
+        plan = None
+
+    if cache is not None and (seeded or not random):
+        if not isinstance(cache, _cache.NeighborCache):
+            cache = _cache.NeighborCache(cache)
+
+        key = cache.key('construct_tree', X, k,
+                        random_state=random_state if random else None,
+                        method=plan and plan['method'], **key_params)
+        entry = cache.get(key)
+    else:
+        cache, entry = None, None
+
+    if entry is not None:
+        sim_graph = entry['sim_graph']
+        density = _np.array(entry['density'])
+        unique_weights = entry.get('unique_weights')
+        assignment = entry.get('assignment')
+
+        if verbose:
+            _logger.info("Loaded the similarity graph and density " +
+                         "estimate from the cache.")
+
+    else:
+        rng = _utl._check_random_state(random_state)
+        sim_graph, radii, density, unique_weights, assignment = \
+            _neighbors_and_density(X, k, rng=rng, verbose=verbose,
+                                   n_jobs=n_jobs, plan=plan, **params)
+
+        if cache is not None:
+            arrays = dict(sim_graph=sim_graph, radii=radii, density=density)
+            if unique_weights is not None:
+                arrays['unique_weights'] = unique_weights
+            if assignment is not None:
+                arrays['assignment'] = assignment
+            cache.put(key, **arrays)
+
+    if time_budget is not None:
+        time_budget = max(time_budget - (_time.time() - start_time), 0.)
 
-    Parameters
-    ----------
-    adjacency_list : list [list]
-        Adjacency list of the k-nearest neighbors graph on the data. Each entry
-        contains the indices of the `k` closest neighbors to the data point at
-        the same row index.
+    tree = construct_tree_from_graph(adjacency_list=sim_graph, density=density,
+                                     prune_threshold=prune_threshold,
+                                     num_levels=num_levels, verbose=verbose,
+                                     weights=unique_weights,
+                                     time_budget=time_budget, cancel=cancel)
 
-    density : list [float]
-        Estimate of the density function, evaluated at the data points
-        represented by the keys in `adjacency_list`.
+    ## Map the tree on unique rows back to the original rows.
+    if assignment is not None and tree is not None:
+        tree = _expand_tree(tree, assignment, weights)
 
-    prune_threshold : int, optional
-        Leaf nodes with fewer than this number of members are recursively
-        merged into larger nodes. If 'None' (the default), then no pruning
-        is performed.
+    return tree
 
-    num_levels : list int, optional
-        Number of density levels in the constructed tree. If None (default),
-        `num_levels` is internally set to be the number of rows in `X`.
 
-    verbose : bool, optional
-        If True, a progress indicator is printed at every 100th level of tree
-        construction.
+def _neighbors_and_density(X, k, weights, landmarks, dtype, metric,
+                           metric_params, num_components, reduction, refine,
+                           rng, verbose=False, n_jobs=1, memory_limit=None,
+                           num_levels=None, plan=None):
+    """
+    Compute the similarity graph and density estimate for `construct_tree`,
+    on the unique rows of the data. Unless a 'plan' from `_plan_neighbors` is
+    given, the neighbor search is planned with
+    `debacl.utils.plan_resources`. This function is not meant to be called
+    by the user; the other parameters are described in `construct_tree`.
 
     Returns
     -------
-    T : levelSetTree
-        See the LevelSetTree class for attributes and method definitions.
+    sim_graph : numpy array
+        k-nearest neighbors of each unique row.
 
-    See Also
-    --------
-    construct_tree, LevelSetTree
+    radii : numpy array
+        Distance from each unique row to its k'th nearest neighbor, counting
+        the row itself.
 
-    Examples
-    --------
-    >>> X = numpy.random.rand(100, 2)
-    >>> knn_graph, radii = debacl.utils.knn_graph(X, k=8)
-    >>> density = debacl.utils.knn_density(radii, n=100, p=2, k=8)
-    >>> tree = debacl.construct_tree_from_graph(knn_graph, density,
-    ...                                         prune_threshold=5)
-    >>> print(tree)
-    +----+-------------+-----------+------------+----------+------+--------+----------+
-    | id | start_level | end_level | start_mass | end_mass | size | parent | children |
-    +----+-------------+-----------+------------+----------+------+--------+----------+
-    | 0  |    0.000    |   0.768   |   0.000    |  0.390   | 100  |  None  |  [1, 2]  |
-    | 1  |    0.768    |   1.494   |   0.390    |  0.790   |  30  |   0    |  [7, 8]  |
-    | 2  |    0.768    |   4.812   |   0.390    |  1.000   |  31  |   0    |    []    |
-    | 7  |    1.494    |   2.375   |   0.790    |  0.950   |  6   |   1    |    []    |
-    | 8  |    1.494    |   2.308   |   0.790    |  0.940   |  5   |   1    |    []    |
-    +----+-------------+-----------+------------+----------+------+--------+----------+
+    density : numpy array
+        Estimated density of each unique row.
+
+    unique_weights : numpy array
+        Total weight of each unique row, or None if the rows are unique and
+        unweighted.
+
+    assignment : numpy array[int]
+        For each row of 'X', the index of its unique row, or None if the rows
+        are already unique.
     """
 
-    ## Initialize the graph and cluster tree
-    levels = _utl.define_density_mass_grid(density, num_levels=num_levels)
+    p = _utl.density_dimension(X, metric)
+
+    ## The rows of a precomputed distance matrix aren't points, so duplicates
+    #  are kept, and the matrix isn't read until the neighbor search.
+    if metric == 'precomputed':
+        n = _utl._precomputed_size(X)
+        unique_X, counts, assignment = X, None, None
+    else:
+        n = X.shape[0]
+        unique_X, counts, assignment = _utl.collapse_duplicates(X)
+
+    if weights is not None and assignment is None:
+        unique_weights = _np.asarray(weights, dtype=_np.float)
+    elif weights is not None:
+        unique_weights = _np.bincount(assignment, weights=weights)
+    elif assignment is not None and unique_X.shape[0] < n:
+        unique_weights = counts
+    else:
+        unique_weights = None
+
+    if num_components is None:
+        if plan is None:
+            plan = _plan_neighbors(unique_X, k, memory_limit, num_levels,
+                                   dtype, metric, landmarks, n_jobs)
+
+        if verbose:
+            _logger.info("Planned the '{}' neighbor search ".format(
+                plan['method']) + "(block size {}), ".format(
+                plan['block_size']) + "with about {} ".format(
+                _utl._format_bytes(plan['memory'])) + "of memory and " +
+                "{:.1f} seconds for the tree.".format(plan['time']))
+
+        sim_graph, radii = _utl.knn_graph(unique_X, k, method=plan['method'],
+                                          dtype=dtype, metric=metric,
+                                          metric_params=metric_params,
+                                          n_jobs=n_jobs,
+                                          block_size=plan['block_size'])
+    else:
+        sim_graph, radii = _reduced_knn_graph(unique_X, k, num_components,
+                                              reduction, refine, rng, verbose)
+        if not refine:
+            p = num_components
+
+    if landmarks is not None:
+        if isinstance(landmarks, (int, _np.integer)):
+            sample = rng.choice(n, min(landmarks, n), replace=False)
+            if weights is None:
+                landmark_weights = None
+            else:
+                landmark_weights = _np.asarray(weights)[sample]
+            landmarks = X[sample]
+        else:
+            landmark_weights = None
 
-    G = _nx.from_dict_of_lists(
-        {i: neighbors for i, neighbors in enumerate(adjacency_list)})
+        density = _utl.landmark_density(unique_X, landmarks, k,
+                                        weights=landmark_weights, dtype=dtype,
+                                        metric=metric,
+                                        metric_params=metric_params)
 
-    T = LevelSetTree(density, levels)
+    elif unique_weights is None:
+        density = _utl.knn_density(radii, n, p, k, metric, metric_params)
+    else:
+        neighbor_weights = unique_weights[sim_graph].sum(axis=1)
+        density = _utl.knn_density(radii, unique_weights.sum(), p,
+                                   neighbor_weights, metric, metric_params)
 
-    ## Figure out roots of the tree
-    cc0 = _nx.connected_components(G)
+    if assignment is not None and unique_X.shape[0] == n:
+        assignment = None
 
-    for i, c in enumerate(cc0):  # c is only the vertex list, not the subgraph
-        T._subgraphs[i] = G.subgraph(c)
-        T.nodes[i] = ConnectedComponent(
-            i, parent=None, children=[], start_level=0., end_level=None,
-            start_mass=0., end_mass=None, members=c)
+    return sim_graph, radii, density, unique_weights, assignment
 
-    # Loop through the removal grid
-    previous_level = 0.
-    n = float(len(adjacency_list))
 
-    for i, level in enumerate(levels):
-        if verbose and i % 100 == 0:
-            _logging.info("iteration {}".format(i))
+def _plan_neighbors(X, k, memory_limit, num_levels, dtype, metric, landmarks,
+                    n_jobs):
+    """
+    Plan the neighbor search for `construct_tree` with
+    `debacl.utils.plan_resources`, and raise a MemoryError if the estimated
+    peak memory exceeds the limit. This function is not meant to be called
+    by the user.
+    """
+    sparse = _utl._issparse(X)
 
-        ## figure out which points to remove, i.e. the background set.
-        bg = _np.where((density > previous_level) & (density <= level))[0]
-        previous_level = level
+    if metric == 'precomputed':
+        n = p = _utl._precomputed_size(X)
+    else:
+        n = X.shape[0]
+        p = max(X.nnz // max(n, 1), 1) if sparse else X.shape[1]
 
-        ## compute the mass after the current bg set is removed
-        old_vcount = sum([x.number_of_nodes()
-                          for x in T._subgraphs.itervalues()])
-        current_mass = 1. - ((old_vcount - len(bg)) / n)
+    if landmarks is not None and not isinstance(landmarks,
+                                                (int, _np.integer)):
+        landmarks = len(landmarks)
 
-        # loop through active components, i.e. subgraphs
-        deactivate_keys = []     # subgraphs to deactivate at the iter end
-        activate_subgraphs = {}  # new subgraphs to add at the end of the iter
+    plan = _utl.plan_resources(n, p, k, memory_limit=memory_limit,
+                               num_levels=num_levels, dtype=dtype,
+                               metric=metric, sparse=sparse,
+                               landmarks=landmarks, n_jobs=n_jobs)
 
-        for (k, H) in T._subgraphs.iteritems():
+    limit = plan['memory_limit']
 
-            ## remove nodes at the current level
-            H.remove_nodes_from(bg)
+    if limit is not None and (plan['method'] is None or
+                              plan['memory'] > limit):
+        raise MemoryError(
+            "Building a level set tree on {} points needs ".format(n) +
+            "an estimated {} of memory, ".format(
+                _utl._format_bytes(plan['memory'])) +
+            "more than the limit of {}. ".format(_utl._format_bytes(limit)) +
+            "Use a smaller 'k', fewer points (e.g. with " +
+            "'construct_tree_sampled'), or a larger 'memory_limit'. See " +
+            "'debacl.utils.plan_resources' for the estimates.")
 
-            ## check if subgraph has vanished
-            if H.number_of_nodes() == 0:
-                T.nodes[k].end_level = level
-                T.nodes[k].end_mass = current_mass
-                deactivate_keys.append(k)
+    return plan
 
-            else:  # subgraph hasn't vanished
 
-                ## check if subgraph now has multiple connected components
-                # NOTE: this is *the* bottleneck
-                if not _nx.is_connected(H):
+def _reduced_knn_graph(X, k, num_components, reduction, refine, rng,
+                       verbose=False):
+    """
+    Compute the k-nearest neighbor graph of a dataset by neighbor search in
+    a projection of the data onto fewer dimensions. This function is not
+    meant to be called by the user; it is a helper function for
+    `construct_tree`.
 
-                    ## deactivate the parent subgraph
-                    T.nodes[k].end_level = level
-                    T.nodes[k].end_mass = current_mass
-                    deactivate_keys.append(k)
+    Parameters
+    ----------
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Data points, with each row as an observation.
 
-                    ## start a new subgraph & node for each child component
-                    cc = _nx.connected_components(H)
+    k : int
+        Number of neighbors of each point.
 
-                    for c in cc:
-                        new_key = max(T.nodes.keys()) + 1
-                        T.nodes[k].children.append(new_key)
-                        activate_subgraphs[new_key] = H.subgraph(c)
+    num_components : int
+        Number of dimensions of the projected data.
 
-                        T.nodes[new_key] = ConnectedComponent(
-                            new_key, parent=k, children=[], start_level=level,
-                            end_level=None, start_mass=current_mass,
-                            end_mass=None, members=c)
+    reduction : {'random_projection', 'pca'}
+        Projection method.
 
-        # update active components
-        for k in deactivate_keys:
-            del T._subgraphs[k]
+    refine : bool
+        If True, re-rank twice 'k' candidates with exact distances.
+
+    rng : numpy.random.RandomState
+        Random number generator.
+
+    verbose : bool, optional
+        If True, log the distortion of the projected distances.
+
+    Returns
+    -------
+    neighbors : numpy array
+        Each row contains the nearest neighbors of the corresponding row in
+        'X'.
+
+    radii : numpy array
+        For each row of 'X', the distance to its k'th nearest neighbor.
+    """
+
+    X_reduced, _ = _utl.reduce_dimension(X, num_components, reduction,
+                                         random_state=rng)
+
+    if verbose:
+        mean_error, max_error = _utl.projection_distortion(
+            X, X_reduced, random_state=rng)
+        _logger.info("Projection distortion on sampled pairs: mean " +
+                     "{:.3f}, max {:.3f}.".format(mean_error, max_error))
+
+    if num_components <= 20 and _utl._HAS_SKLEARN:
+        method = 'kd_tree'
+    else:
+        method = 'brute_force'
+
+    if not refine:
+        return _utl.knn_graph(X_reduced, k, method=method)
+
+    candidates, _ = _utl.knn_graph(X_reduced, min(2 * k, X.shape[0]),
+                                   method=method)
+    return _utl.refine_neighbors(X, candidates, k)
+
+
+def construct_tree_binned(X, bin_width, connectivity=None,
+                          prune_threshold=None, num_levels=None,
+                          verbose=False):
+    """
+    Construct a level set tree from low-dimensional tabular data, by first
+    aggregating the points into the cells of a fine histogram grid. The tree
+    is estimated on the occupied cells, then mapped back to the original
+    points. This avoids the all-pairs nearest neighbor search of
+    `construct_tree`, and is intended for data with one to three columns.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array
+        Numeric dataset, where each row represents one observation.
+
+    bin_width : float or numpy array[float]
+        Width of the grid cells, either the same in every dimension or one
+        value for each column of 'X'.
+
+    connectivity : int, optional
+        Which cells are neighbors in the similarity graph, and in the window
+        used to estimate density. Cells are neighbors if they differ by one
+        step in at most 'connectivity' dimensions. If None (the default),
+        cells that share at least a corner are neighbors.
+
+    prune_threshold : int, optional
+        Leaf nodes with fewer than this number of members are recursively
+        merged into larger nodes. If 'None' (the default), then no pruning
+        is performed.
+
+    num_levels : int, optional
+        Number of density levels in the constructed tree. If None (default),
+        `num_levels` is internally set to be the number of occupied cells.
+
+    verbose : bool, optional
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    Returns
+    -------
+    T : LevelSetTree
+        A level set tree whose members are the row indices of 'X'.
+
+    See Also
+    --------
+    construct_tree, debacl.utils.bin_data, debacl.utils.cell_graph
+
+    Notes
+    -----
+    The density of each cell is the fraction of points in the window formed
+    by the cell and its neighbors, divided by the window volume. Every point
+    gets the density and the neighbors of its cell, so the result is the
+    level set tree of a dataset where each point is moved to the center of
+    its cell. Each point moves by at most `0.5 * norm(bin_width)`, which is
+    the approximation error of the binned tree. Binning costs O(n log n)
+    time, and the tree is built on the occupied cells only.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(10000, 2)
+    >>> tree = debacl.construct_tree_binned(X, bin_width=0.02,
+    ...                                     prune_threshold=50)
+    >>> labels = tree.get_clusters()
+    """
+
+    cells, counts, assignment = _utl.bin_data(X, bin_width)
+    sim_graph = _utl.cell_graph(cells, connectivity=connectivity)
+    density = _utl.cell_density(cells, counts, sim_graph, bin_width,
+                                connectivity=connectivity)
+
+    ## Build the tree on the cells, then map it back to the points.
+    tree = construct_tree_from_graph(adjacency_list=sim_graph, density=density,
+                                     prune_threshold=prune_threshold,
+                                     num_levels=num_levels, verbose=verbose,
+                                     weights=counts)
+    tree = _expand_tree(tree, assignment)
+
+    return tree
+
+
+def construct_tree_sampled(X, k, sample_size, prune_threshold=None,
+                           num_levels=None, stratify=None,
+                           validation_size=None, batch_size=1000,
+                           random_state=None, verbose=False, dtype=None):
+    """
+    Construct a level set tree for a large dataset by building the tree on a
+    subsample, then extending it to the remaining observations. Each
+    remaining observation gets a k-nearest neighbor density estimate with
+    respect to the sample, and joins the nodes of its nearest sample point
+    whose start levels are below its density.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array
+        Numeric dataset, where each row represents one observation.
+
+    k : int
+        Number of observations to consider as neighbors to a given point.
+
+    sample_size : int
+        Number of observations in the sample used to build the tree.
+
+    prune_threshold : int, optional
+        Leaf nodes with fewer than this number of members are recursively
+        merged into larger nodes, after the tree is extended to all
+        observations. If 'None' (the default), then no pruning is performed.
+
+    num_levels : int, optional
+        Number of density levels in the constructed tree. If None (default),
+        `num_levels` is internally set to be the sample size.
+
+    stratify : {None, 'density'}, optional
+        How to draw the sample. If None (default), the sample is drawn
+        uniformly at random. If 'density', the observations are grouped into
+        strata by a pilot density estimate and the same number of
+        observations is drawn from each stratum, so low-density regions are
+        not lost. Sampled observations are then weighted by the inverse of
+        their inclusion probability.
+
+    validation_size : int, optional
+        If specified, a tree is also built directly on this many randomly
+        chosen observations, and its leaf clusters are compared to those of
+        the extended tree on the same observations.
+
+    batch_size : int, optional
+        Number of observations to extend at once. Memory use is proportional
+        to 'batch_size' times 'sample_size'.
+
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random number generator for the sample and validation slice.
+
+    verbose : bool, optional
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    dtype : numpy dtype, optional
+        Precision of the neighbor distance computations. See
+        `construct_tree`.
+
+    Returns
+    -------
+    T : LevelSetTree
+        A level set tree whose members are the row indices of 'X'.
+
+    agreement : float
+        Adjusted Rand index between the leaf clusters (with background
+        filled) of 'T' and of the tree built directly on the validation
+        slice. None if 'validation_size' is not specified.
+
+    See Also
+    --------
+    construct_tree, debacl.utils.knn_query
+
+    Notes
+    -----
+    The neighbor search costs O(n * sample_size) time, instead of O(n^2)
+    for `construct_tree`. Observations in the sample keep the density and
+    node memberships from the sample tree. The prune threshold of the
+    validation tree is scaled by the fraction of observations in the
+    validation slice.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100000, 2)
+    >>> tree, agreement = debacl.construct_tree_sampled(
+    ...     X, k=10, sample_size=5000, prune_threshold=500,
+    ...     validation_size=2000)
+    """
+
+    n, p = X.shape
+    sample_size = min(sample_size, n)
+
+    if isinstance(random_state, _np.random.RandomState):
+        rng = random_state
+    else:
+        rng = _np.random.RandomState(random_state)
+
+    ## Draw the sample.
+    if stratify is None:
+        sample = _np.sort(rng.choice(n, sample_size, replace=False))
+        sample_weights = None
+
+    elif stratify == 'density':
+        sample, sample_weights = _density_stratified_sample(
+            X, k, sample_size, rng, batch_size, dtype=dtype)
+
+    else:
+        raise ValueError("Sampling method not understood. Please use 'None' " +
+                         "or 'density'.")
+
+    ## Build the tree on the sample.
+    sample_tree = construct_tree(X[sample], k, num_levels=num_levels,
+                                 verbose=verbose, weights=sample_weights,
+                                 dtype=dtype)
+
+    ## Estimate density for every observation, relative to the sample.
+    if sample_weights is None:
+        total_weight = len(sample)
+    else:
+        total_weight = sample_weights.sum()
+
+    density = _np.empty(n, dtype=_np.float)
+    nearest = _np.empty(n, dtype=_np.int)
+
+    for start in range(0, n, batch_size):
+        batch = slice(start, start + batch_size)
+        distances, neighbors = _utl.knn_query(X[batch], X[sample], k,
+                                              block_size=batch_size,
+                                              dtype=dtype)
+
+        if sample_weights is None:
+            neighbor_weights = k
+        else:
+            neighbor_weights = sample_weights[neighbors].sum(axis=1)
+
+        density[batch] = _utl.knn_density(distances[:, -1], total_weight, p,
+                                          neighbor_weights)
+        nearest[batch] = neighbors[:, 0]
+
+    density[sample] = sample_tree.density
+    nearest[sample] = _np.arange(len(sample))
+
+    tree = _extend_tree(sample_tree, nearest, density)
+
+    if prune_threshold is not None:
+        tree = tree.prune(threshold=prune_threshold)
+
+    if verbose:
+        _logger.info("Extended the tree from {} ".format(len(sample)) +
+                     "sampled observations to {}.".format(n))
+
+    ## Compare with a tree built directly on a validation slice.
+    agreement = None
+
+    if validation_size is not None:
+        validation = _np.sort(rng.choice(n, min(validation_size, n),
+                                         replace=False))
+
+        if prune_threshold is None:
+            validation_threshold = None
+        else:
+            validation_threshold = max(
+                1, int(round(prune_threshold * len(validation) / float(n))))
+
+        validation_tree = construct_tree(X[validation], k,
+                                         prune_threshold=validation_threshold,
+                                         num_levels=num_levels, dtype=dtype)
+
+        labels = tree.get_clusters(fill_background=True)[validation, 1]
+        validation_labels = validation_tree.get_clusters(
+            fill_background=True)[:, 1]
+        agreement = _adjusted_rand_index(labels, validation_labels)
+
+        if verbose:
+            _logger.info("Agreement with the validation tree: " +
+                         "{:.3f}".format(agreement))
+
+    return tree, agreement
+
+
+def construct_tree_from_graph(adjacency_list, density, prune_threshold=None,
+                              num_levels=None, verbose=False, weights=None,
+                              checkpoint=None, checkpoint_interval=600.,
+                              time_budget=None, cancel=None):
+    """
+    Construct a level set tree from a similarity graph and a density estimate.
+
+    Parameters
+    ----------
+    adjacency_list : list [list]
+        Adjacency list of the k-nearest neighbors graph on the data. Each entry
+        contains the indices of the `k` closest neighbors to the data point at
+        the same row index.
+
+    density : list [float]
+        Estimate of the density function, evaluated at the data points
+        represented by the keys in `adjacency_list`.
+
+    prune_threshold : int, optional
+        Leaf nodes with fewer than this number of members are recursively
+        merged into larger nodes. If 'None' (the default), then no pruning
+        is performed.
+
+    num_levels : list int, optional
+        Number of density levels in the constructed tree. If None (default),
+        `num_levels` is internally set to be the number of rows in `X`.
+
+    verbose : bool, optional
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    weights : numpy array, optional
+        Weight of each point, e.g. the number of duplicates of each unique
+        row. If None (default), every point has weight 1. The density grid,
+        node masses and node sizes (for pruning) use total weights instead of
+        numbers of points.
+
+    checkpoint : str, optional
+        File name for checkpoints of the construction. If specified, the state
+        of the construction is saved to this file every
+        'checkpoint_interval' seconds, and an interrupted construction can be
+        continued with `resume_tree`.
+
+    checkpoint_interval : float, optional
+        Minimum time in seconds between checkpoints.
+
+    time_budget : float, optional
+        Time limit in seconds. If specified, trees are built on increasingly
+        fine mass grids of 16, 32, 64, ... levels, up to 'num_levels', and the
+        finest tree completed before the limit is returned. The 16-level tree
+        is always completed, even if it takes longer than 'time_budget'.
+
+    cancel : function, optional
+        Function with no arguments, called at every density level. If it
+        returns True, construction stops and the finest tree completed so
+        far is returned, as with 'time_budget'.
+
+    Returns
+    -------
+    T : levelSetTree
+        See the LevelSetTree class for attributes and method definitions.
+        The tree's `build_info` dictionary records the number of levels
+        actually used ('num_levels'), the number requested ('target_levels'),
+        whether they are the same ('complete'), and the construction time in
+        seconds ('elapsed'). If construction is cancelled before any tree is
+        complete, the output is None. Checkpoints are only saved for the tree
+        with 'num_levels' levels.
+
+    See Also
+    --------
+    construct_tree, LevelSetTree, resume_tree
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> knn_graph, radii = debacl.utils.knn_graph(X, k=8)
+    >>> density = debacl.utils.knn_density(radii, n=100, p=2, k=8)
+    >>> tree = debacl.construct_tree_from_graph(knn_graph, density,
+    ...                                         prune_threshold=5)
+    >>> print(tree)
+    +----+-------------+-----------+------------+----------+------+--------+----------+
+    | id | start_level | end_level | start_mass | end_mass | size | parent | children |
+    +----+-------------+-----------+------------+----------+------+--------+----------+
+    | 0  |    0.000    |   0.768   |   0.000    |  0.390   | 100  |  None  |  [1, 2]  |
+    | 1  |    0.768    |   1.494   |   0.390    |  0.790   |  30  |   0    |  [7, 8]  |
+    | 2  |    0.768    |   4.812   |   0.390    |  1.000   |  31  |   0    |    []    |
+    | 7  |    1.494    |   2.375   |   0.790    |  0.950   |  6   |   1    |    []    |
+    | 8  |    1.494    |   2.308   |   0.790    |  0.940   |  5   |   1    |    []    |
+    +----+-------------+-----------+------------+----------+------+--------+----------+
+    """
+
+    ## Initialize the graph and cluster tree
+    if weights is not None:
+        weights = _np.asarray(weights)
+
+    start_time = _time.time()
+
+    G = _nx.from_dict_of_lists(
+        {i: neighbors for i, neighbors in enumerate(adjacency_list)})
+
+    ## Figure out roots of the tree. Components are ordered by their smallest
+    #  member, so that node indices don't depend on the graph's history.
+    cc0 = sorted(_nx.connected_components(G), key=min)
+
+    if num_levels is None or num_levels > len(density):
+        num_levels = len(density)
+
+    ## Without a time budget or cancellation, build the tree directly.
+    #  Otherwise, build trees on mass grids of 16, 32, 64, ... levels, up to
+    #  'num_levels', and keep the last complete one.
+    if time_budget is None and cancel is None:
+        schedule = [num_levels]
+        deadline = None
+    else:
+        schedule = [16]
+        while schedule[-1] < num_levels:
+            schedule.append(2 * schedule[-1])
+        schedule[-1] = num_levels
+
+        if time_budget is None:
+            deadline = None
+        else:
+            deadline = start_time + time_budget
+
+    if checkpoint is None:
+        graph_hash = None
+    else:
+        graph_hash = _graph_hash(adjacency_list)
+
+    T = None
+
+    for j, resolution in enumerate(schedule):
+        levels = _utl.define_density_mass_grid(density, num_levels=resolution,
+                                               weights=weights)
+        tree = LevelSetTree(density, levels, weights)
+
+        for i, c in enumerate(cc0):  # c is only the vertex list
+            tree._subgraphs[i] = G.subgraph(c)
+            tree.nodes[i] = ConnectedComponent(
+                i, parent=None, children=[], start_level=0., end_level=None,
+                start_mass=0., end_mass=None, members=set(c))
+
+        tree.prune_threshold = prune_threshold
+
+        ## The coarsest tree is finished even if the deadline has passed.
+        tree = _grow_tree(
+            tree, 0, -_np.inf, verbose=verbose,
+            checkpoint=checkpoint if j == len(schedule) - 1 else None,
+            checkpoint_interval=checkpoint_interval,
+            deadline=deadline if j > 0 else None, cancel=cancel,
+            graph_hash=graph_hash)
+
+        if tree is None:
+            break
+
+        T = tree
+        T.build_info = {'num_levels': resolution,
+                        'target_levels': num_levels,
+                        'complete': resolution == num_levels}
+
+        if deadline is not None and _time.time() >= deadline:
+            break
+
+    if T is None:
+        return None
+
+    T.build_info['elapsed'] = _time.time() - start_time
+
+    ## Prune the tree
+    if prune_threshold is not None:
+        T = T.prune(threshold=prune_threshold)
+
+    return T
+
+
+def resume_tree(checkpoint, adjacency_list, verbose=False,
+                checkpoint_interval=600.):
+    """
+    Finish the construction of a level set tree from the last checkpoint
+    saved by `construct_tree_from_graph`. The output is identical to the tree
+    from an uninterrupted construction.
+
+    Parameters
+    ----------
+    checkpoint : str
+        Checkpoint file name. New checkpoints are saved to the same file.
+
+    adjacency_list : list [list]
+        Similarity graph used to start the construction. A different graph
+        raises a ValueError.
+
+    verbose : bool, optional
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    checkpoint_interval : float, optional
+        Minimum time in seconds between checkpoints.
+
+    Returns
+    -------
+    T : LevelSetTree
+        The level set tree, pruned with the original 'prune_threshold'.
+
+    See Also
+    --------
+    construct_tree_from_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> knn_graph, radii = debacl.utils.knn_graph(X, k=8)
+    >>> density = debacl.utils.knn_density(radii, n=100, p=2, k=8)
+    >>> tree = debacl.construct_tree_from_graph(knn_graph, density,
+    ...                                         prune_threshold=5,
+    ...                                         checkpoint='my_checkpoint')
+
+    If the construction is interrupted, it can be finished later with the
+    same graph.
+
+    >>> tree = debacl.resume_tree('my_checkpoint', knn_graph)
+    """
+    with _np.load(checkpoint) as state:
+        if 'weights' in state.files:
+            weights = state['weights']
+        else:
+            weights = None
+
+        T = LevelSetTree(state['density'], state['levels'], weights)
+
+        prune_threshold = state['prune_threshold']
+        start = int(state['start'])
+        previous_level = float(state['previous_level'])
+        active_weight = state['active_weight'][()]
+
+        ## Node fields, and members as a concatenated array.
+        ids = state['ids']
+        parents = state['parents']
+        fields = state['fields']
+        members = _np.split(state['members'], state['offsets'][1:-1])
+        children = _np.split(state['children'], state['child_offsets'][1:-1])
+        active = state['active']
+
+        if 'graph_hash' in state.files:
+            saved_hash = str(state['graph_hash'])
+        else:
+            saved_hash = None
+
+    ## Checkpoints without a graph hash only have the number of points.
+    if len(adjacency_list) != len(T.density):
+        raise ValueError("The checkpoint has {} points, but the graph has {} "
+                         "vertices.".format(len(T.density),
+                                            len(adjacency_list)))
+
+    graph_hash = _graph_hash(adjacency_list)
+
+    if saved_hash is not None and saved_hash != graph_hash:
+        raise ValueError("The graph doesn't match the graph used to start "
+                         "the construction.")
+
+    ## An empty array means the tree is not pruned.
+    if len(prune_threshold) > 0:
+        prune_threshold = prune_threshold[0].item()
+    else:
+        prune_threshold = None
+
+    T.prune_threshold = prune_threshold
+
+    for j, ix in enumerate(ids.tolist()):
+        start_level, end_level, start_mass, end_mass = fields[j].tolist()
+        T.nodes[ix] = ConnectedComponent(
+            ix, parent=None if parents[j] < 0 else int(parents[j]),
+            children=children[j].tolist(), start_level=start_level,
+            end_level=None if _np.isnan(end_level) else end_level,
+            start_mass=start_mass,
+            end_mass=None if _np.isnan(end_mass) else end_mass,
+            members=set(members[j].tolist()))
+
+    ## Rebuild the active subgraphs from the points above the last level.
+    G = _nx.from_dict_of_lists(
+        {i: neighbors for i, neighbors in enumerate(adjacency_list)})
+    density = _np.asarray(T.density)
+
+    for ix in active.tolist():
+        points = _np.fromiter(T.nodes[ix].members, dtype=_np.int)
+        T._subgraphs[ix] = G.subgraph(points[density[points] >
+                                             previous_level])
+
+    T = _grow_tree(T, start, previous_level, active_weight, verbose,
+                   checkpoint, checkpoint_interval, graph_hash=graph_hash)
+
+    if prune_threshold is not None:
+        T = T.prune(threshold=prune_threshold)
+
+    return T
+
+
+def _grow_tree(T, start, previous_level, active_weight=None, verbose=False,
+               checkpoint=None, checkpoint_interval=600., deadline=None,
+               cancel=None, graph_hash=None):
+    """
+    Grow a level set tree upward from its active subgraphs, by removing the
+    points below each level of the tree's density grid, starting at level
+    index 'start'. This function is not meant to be called by the user; it
+    is the main loop of `construct_tree_from_graph` and `resume_tree`.
+
+    Parameters
+    ----------
+    T : LevelSetTree
+        Tree with the nodes built so far. Active nodes have a subgraph in
+        'T._subgraphs' that contains their points above 'previous_level'.
+
+    start : int
+        Index of the next density level.
+
+    previous_level : float
+        Density level before 'start'.
+
+    active_weight : int or float, optional
+        Total weight of the points above 'previous_level'. If None, it is the
+        total weight of all points.
+
+    deadline : float, optional
+        Time, as returned by `time.time`, at which construction stops.
+
+    cancel : function, optional
+        Function with no arguments; construction stops if it returns True.
+
+    graph_hash : str, optional
+        Hash of the similarity graph, saved with each checkpoint.
+
+    Returns
+    -------
+    T : LevelSetTree
+        The unpruned tree, grown in place, or None if construction stopped
+        before the last level.
+    """
+    density = _np.asarray(T.density)
+    levels = T.levels
+
+    if T.weights is None:
+        point_weights = _np.ones(len(density), dtype=_np.int)
+    else:
+        point_weights = T.weights
+
+    n = float(point_weights.sum())
+
+    if active_weight is None:
+        active_weight = point_weights.sum()
+    last_checkpoint = _time.time()
+
+    for i in range(start, len(levels)):
+        level = levels[i]
+
+        if verbose and i % 100 == 0:
+            _logger.info("iteration {}".format(i))
+
+        if ((deadline is not None and _time.time() >= deadline) or
+                (cancel is not None and cancel())):
+            return None
+
+        ## figure out which points to remove, i.e. the background set.
+        bg = _np.where((density > previous_level) & (density <= level))[0]
+        previous_level = level
+
+        ## compute the mass after the current bg set is removed
+        active_weight -= point_weights[bg].sum()
+        current_mass = 1. - (active_weight / n)
+
+        # loop through active components, i.e. subgraphs
+        deactivate_keys = []     # subgraphs to deactivate at the iter end
+        activate_subgraphs = {}  # new subgraphs to add at the end of the iter
+
+        for (k, H) in sorted(T._subgraphs.items()):
+
+            ## remove nodes at the current level
+            H.remove_nodes_from(bg)
+
+            ## check if subgraph has vanished
+            if H.number_of_nodes() == 0:
+                T.nodes[k].end_level = level
+                T.nodes[k].end_mass = current_mass
+                deactivate_keys.append(k)
+
+            else:  # subgraph hasn't vanished
+
+                ## check if subgraph now has multiple connected components
+                # NOTE: this is *the* bottleneck
+                if not _nx.is_connected(H):
+
+                    ## deactivate the parent subgraph
+                    T.nodes[k].end_level = level
+                    T.nodes[k].end_mass = current_mass
+                    deactivate_keys.append(k)
+
+                    ## start a new subgraph & node for each child component
+                    cc = sorted(_nx.connected_components(H), key=min)
+
+                    for c in cc:
+                        new_key = max(T.nodes.keys()) + 1
+                        T.nodes[k].children.append(new_key)
+                        activate_subgraphs[new_key] = H.subgraph(c)
+
+                        T.nodes[new_key] = ConnectedComponent(
+                            new_key, parent=k, children=[], start_level=level,
+                            end_level=None, start_mass=current_mass,
+                            end_mass=None, members=c)
+
+        # update active components
+        for k in deactivate_keys:
+            del T._subgraphs[k]
 
         T._subgraphs.update(activate_subgraphs)
 
+        if (checkpoint is not None and
+                _time.time() - last_checkpoint >= checkpoint_interval):
+            _save_checkpoint(T, checkpoint, i + 1, level, active_weight,
+                             graph_hash)
+            last_checkpoint = _time.time()
+
+    return T
+
+
+def _graph_hash(adjacency_list):
+    """
+    Hash a similarity graph, so `resume_tree` can check that it continues
+    with the graph the construction started with. This function is not meant
+    to be called by the user.
+    """
+    digest = _hashlib.sha1()
+    _cache._hash_update(digest, len(adjacency_list))
+
+    ## Lists and arrays of the same neighbors have the same hash.
+    for neighbors in adjacency_list:
+        _cache._hash_update(digest, _np.asarray(neighbors, dtype=_np.int64))
+
+    return digest.hexdigest()
+
+
+def _save_checkpoint(T, filename, start, previous_level, active_weight,
+                     graph_hash=None):
+    """
+    Save the state of a level set tree construction to a compressed numpy
+    file, for `resume_tree`. The file is written under a temporary name and
+    then renamed, so an interruption never leaves a partial checkpoint. This
+    function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    T : LevelSetTree
+        Tree under construction.
+
+    filename : str
+        Checkpoint file name.
+
+    start : int
+        Index of the next density level.
+
+    previous_level : float
+        Density level of the last completed iteration.
+
+    active_weight : int or float
+        Total weight of the points above 'previous_level'.
+
+    graph_hash : str, optional
+        Hash of the similarity graph, from `_graph_hash`.
+    """
+    ids = sorted(T.nodes)
+    nodes = [T.nodes[ix] for ix in ids]
+
+    members = [_np.fromiter(v.members, dtype=_np.int, count=len(v.members))
+               for v in nodes]
+    children = [_np.array(v.children, dtype=_np.int) for v in nodes]
+
+    fields = [[v.start_level, v.end_level, v.start_mass, v.end_mass]
+              for v in nodes]
+    fields = _np.array(fields, dtype=_np.float).reshape((-1, 4))
+
+    if T.prune_threshold is None:
+        prune_threshold = []
+    else:
+        prune_threshold = [T.prune_threshold]
+
+    state = dict(
+        density=_np.asarray(T.density), levels=_np.asarray(T.levels),
+        prune_threshold=_np.array(prune_threshold),
+        start=start, previous_level=previous_level,
+        active_weight=active_weight,
+        ids=_np.array(ids, dtype=_np.int),
+        parents=_np.array([-1 if v.parent is None else v.parent
+                           for v in nodes], dtype=_np.int),
+        fields=fields,
+        members=_np.concatenate(members + [_np.zeros(0, dtype=_np.int)]),
+        offsets=_np.cumsum([0] + [len(x) for x in members]),
+        children=_np.concatenate(children + [_np.zeros(0, dtype=_np.int)]),
+        child_offsets=_np.cumsum([0] + [len(x) for x in children]),
+        active=_np.array(sorted(T._subgraphs), dtype=_np.int))
+
+    if T.weights is not None:
+        state['weights'] = _np.asarray(T.weights)
+
+    if graph_hash is not None:
+        state['graph_hash'] = _np.array(graph_hash)
+
+    ## Write to an open file, so numpy doesn't add a '.npz' extension.
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, 'wb') as f:
+        _np.savez_compressed(f, **state)
+
+    _os.rename(temp_filename, filename)
+
+
+def construct_tree_from_lattice(density, connectivity=1, prune_threshold=None,
+                                num_levels=None, verbose=False):
+    """
+    Construct a level set tree from density values on a regular lattice, such
+    as an image or a voxel grid. Neighbors are the adjacent cells of the
+    lattice, so no similarity graph needs to be built.
+
+    Parameters
+    ----------
+    density : numpy array
+        Estimate of the density function at each cell of the lattice. May have
+        any number of dimensions.
+
+    connectivity : int, optional
+        Which lattice cells are neighbors, with the same meaning as in
+        `scipy.ndimage.generate_binary_structure`. Cells are neighbors if they
+        differ by one step in at most 'connectivity' dimensions. For 2D
+        lattices, 1 (the default) gives the 4-neighbor stencil and 2 gives the
+        8-neighbor stencil; for 3D lattices, 1 gives the 6-neighbor stencil
+        and 3 gives the 26-neighbor stencil.
+
+    prune_threshold : int, optional
+        Leaf nodes with fewer than this number of members are recursively
+        merged into larger nodes. If 'None' (the default), then no pruning
+        is performed.
+
+    num_levels : int, optional
+        Number of density levels in the constructed tree. If None (default),
+        `num_levels` is internally set to be the number of cells in `density`.
+
+    verbose : bool, optional
+        If True, a progress indicator is logged to the 'debacl' logger at every
+        100th level of tree construction.
+
+    Returns
+    -------
+    T : LevelSetTree
+        See the LevelSetTree class for attributes and method definitions. The
+        members of each node are indices into the *flattened* lattice, in
+        C order, and the tree's `density` attribute is the flattened lattice.
+
+    See Also
+    --------
+    construct_tree_from_graph, LevelSetTree
+
+    Notes
+    -----
+    The tree is built in a single sweep over the cells, from the highest
+    density to the lowest. Each cell is merged with the components of its
+    neighbors that are already in the upper level set, with a union-find
+    structure, and the tree nodes are recorded when components merge. The
+    neighbors of each cell are found from the offsets of the stencil as the
+    cell is added, so no edge list is stored, and construction takes
+    O(N log N) time for N cells, regardless of 'num_levels'.
+
+    Examples
+    --------
+    >>> x, y = numpy.mgrid[-2:2:0.05, -2:2:0.05]
+    >>> density = numpy.exp(-(x - 1)**2 - y**2) + numpy.exp(-(x + 1)**2 - y**2)
+    >>> tree = debacl.construct_tree_from_lattice(density, connectivity=2,
+    ...                                           num_levels=100)
+    >>> labels = tree.get_clusters()
+    >>> image = numpy.unravel_index(labels[:, 0], density.shape)
+    """
+
+    ## Validate inputs
+    if not isinstance(density, _np.ndarray):
+        raise TypeError("Input 'density' must be a numpy array.")
+
+    if density.size < 1:
+        raise ValueError("Input 'density' must contain at least one value.")
+
+    if not isinstance(connectivity, int):
+        raise TypeError("Input 'connectivity' must be an integer.")
+
+    if connectivity < 1 or connectivity > density.ndim:
+        raise ValueError("Input 'connectivity' must be between 1 and the " +
+                         "number of dimensions of 'density'.")
+
+    ## Initialize the lattice and cluster tree
+    flat_density = density.ravel()
+    n = flat_density.size
+    levels = _utl.define_density_mass_grid(flat_density, num_levels=num_levels)
+    T = LevelSetTree(flat_density, levels)
+
+    ## Cells are added from the highest density down. Cells between two
+    #  levels of the grid form one batch, and each cell is joined to its
+    #  neighbors that were added before it.
+    order = _np.argsort(-flat_density, kind='mergesort')
+    rank = _np.empty(n, dtype=_np.int64)
+    rank[order] = _np.arange(n)
+
+    batch = _np.searchsorted(levels, flat_density[order], side='left') - 1
+    num_upper = n - _np.searchsorted(flat_density[order][::-1], levels,
+                                     side='right')
+    mass = 1. - (num_upper / float(n))
+
+    stencil = _utl._cell_stencil(density.ndim, connectivity)
+    stencil = stencil[_np.any(stencil != 0, axis=1)]
+
+    ## Union-find forest over the cells, and the tree node of each component.
+    parent = list(range(n))
+    set_size = [1] * n
+    component_node = {}
+
+    def find(x):
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    ## Nodes in the order they are created, i.e. children before parents.
+    node_children = []
+    node_start = []
+    node_end = []
+    own_node = _np.empty(n, dtype=_np.int64)
+
+    def new_node(children, end):
+        node_children.append(children)
+        node_start.append(None)
+        node_end.append(end)
+        return len(node_children) - 1
+
+    num_levels = len(levels)
+    steps = _np.arange(num_levels - 1, -2, -1)
+    batch_ends = _np.searchsorted(-batch, -steps, side='right').tolist()
+    first = 0
+    chunk_end = 0
+
+    for i, last in zip(steps.tolist(), batch_ends):
+        if verbose and i % 100 == 0:
+            _logger.info("iteration {}".format(i))
+
+        if last == first:
+            continue
+
+        ## Merge the new cells into the active components. For each merged
+        #  component, keep the nodes of the components that were active
+        #  before this batch.
+        merged = {}
+
+        if last > chunk_end:
+            chunk_end = min(max(last, first + _LATTICE_CHUNK_SIZE), n)
+            key, src, dst = _lattice_neighbors(density.shape, stencil, order,
+                                               rank, first, chunk_end)
+
+        e0, e1 = _np.searchsorted(key, [first, last])
+
+        for u, v in zip(src[e0:e1].tolist(), dst[e0:e1].tolist()):
+            ru, rv = find(u), find(v)
+
+            if ru == rv:
+                continue
+
+            if set_size[ru] < set_size[rv]:
+                ru, rv = rv, ru
+
+            parent[rv] = ru
+            set_size[ru] += set_size[rv]
+
+            nodes = []
+            for r in (ru, rv):
+                if r in merged:
+                    nodes.extend(merged.pop(r))
+                elif r in component_node:
+                    nodes.append(component_node.pop(r))
+
+            merged[ru] = nodes
+
+        cells = order[first:last].tolist()
+        roots = [find(c) for c in cells]
+
+        for r in roots:
+            if r not in merged and r not in component_node:
+                merged[r] = []
+
+        ## A component with no active part vanishes at the next level, and a
+        #  component with several active parts splits at the next level.
+        end = i + 1 if i + 1 < num_levels else None
+
+        for r, nodes in merged.items():
+            if len(nodes) == 1:
+                component_node[r] = nodes[0]
+
+            else:
+                component_node[r] = new_node(nodes, end)
+
+                for child in nodes:
+                    node_start[child] = end
+
+        own_node[first:last] = [component_node[r] for r in roots]
+        first = last
+
+    del set_size, rank, src, dst, key
+
+    ## Each node's members are its own cells and the members of its
+    #  children, which are created before it.
+    own_order = _np.argsort(own_node, kind='mergesort')
+    breaks = _np.searchsorted(own_node[own_order],
+                              _np.arange(1, len(node_children)))
+    members = [set(c.tolist())
+               for c in _np.split(order[own_order], breaks)]
+
+    for ix, children in enumerate(node_children):
+        for child in children:
+            members[ix] |= members[child]
+
+    ## Number the nodes from the roots down, as the level-by-level
+    #  constructors do.
+    node_parent = [None] * len(node_children)
+    for ix, children in enumerate(node_children):
+        for child in children:
+            node_parent[child] = ix
+
+    by_start = _collections.defaultdict(list)
+    for ix, start in enumerate(node_start):
+        by_start[-1 if start is None else start].append(ix)
+
+    new_id = {}
+    for start in sorted(by_start):
+        for ix in sorted(by_start[start],
+                         key=lambda ix: (new_id.get(node_parent[ix], -1),
+                                         min(members[ix]))):
+            new_id[ix] = len(new_id)
+
+    for ix, node_id in new_id.items():
+        if node_start[ix] is None:
+            start_level, start_mass = 0., 0.
+        else:
+            start_level = levels[node_start[ix]]
+            start_mass = mass[node_start[ix]]
+
+        if node_end[ix] is None:
+            end_level, end_mass = None, None
+        else:
+            end_level = levels[node_end[ix]]
+            end_mass = mass[node_end[ix]]
+
+        T.nodes[node_id] = ConnectedComponent(
+            node_id,
+            parent=(None if node_parent[ix] is None
+                    else new_id[node_parent[ix]]),
+            children=sorted(new_id[c] for c in node_children[ix]),
+            start_level=start_level, end_level=end_level,
+            start_mass=start_mass, end_mass=end_mass,
+            members=members[ix])
+
     ## Prune the tree
     if prune_threshold is not None:
         T = T.prune(threshold=prune_threshold)
@@ -1435,6 +2981,470 @@ def construct_tree_from_graph(adjacency_list, density, prune_threshold=None,
     return T
 
 
+def _lattice_neighbors(shape, stencil, order, rank, start, end):
+    """
+    Find the neighbors of a range of cells of a regular lattice that were
+    added before them, in the descending density order of
+    `construct_tree_from_lattice`. Neighbors are computed from the stencil
+    offsets, so only the edges of the range are stored. This function is not
+    meant to be called by the user.
+
+    Parameters
+    ----------
+    shape : tuple [int]
+        Shape of the lattice.
+
+    stencil : 2-dimensional numpy array[int]
+        Offsets from a cell to its neighbors, excluding the cell itself.
+
+    order : numpy array[int]
+        Flat indices of the cells, in the order they are added.
+
+    rank : numpy array[int]
+        Position of each cell in 'order'.
+
+    start, end : int
+        Range of positions in 'order'.
+
+    Returns
+    -------
+    key : numpy array[int]
+        Position in 'order' of the later cell of each edge, sorted.
+
+    src, dst : numpy array[int]
+        Flat indices, in C order, of the later and earlier cell of each edge.
+    """
+    cells = order[start:end]
+    coords = _np.unravel_index(cells, shape)
+    strides = _np.cumprod((shape[1:] + (1,))[::-1])[::-1]
+
+    src = [_np.array([], dtype=_np.int64)]
+    dst = [_np.array([], dtype=_np.int64)]
+
+    for offset in stencil:
+        inside = _np.ones(len(cells), dtype=bool)
+        for x, o, size in zip(coords, offset, shape):
+            inside &= (x + o >= 0) & (x + o < size)
+
+        u = cells[inside]
+        v = u + _np.dot(offset, strides)
+
+        earlier = rank[v] < rank[u]
+        src.append(u[earlier])
+        dst.append(v[earlier])
+
+    src = _np.concatenate(src)
+    dst = _np.concatenate(dst)
+    key = rank[src]
+
+    edge_order = _np.argsort(key, kind='mergesort')
+
+    return key[edge_order], src[edge_order], dst[edge_order]
+
+
+def _expand_tree(tree, assignment, weights=None):
+    """
+    Map a level set tree built on groups of points (e.g. histogram cells or
+    duplicate rows) back to the individual points. Each point gets the
+    density of its group and belongs to every node that contains its group.
+    Node masses are recomputed from the points. This function is not meant to
+    be called by the user.
+
+    Parameters
+    ----------
+    tree : LevelSetTree
+        Level set tree whose members are group indices.
+
+    assignment : numpy array[int]
+        For each point, the index of its group.
+
+    weights : numpy array, optional
+        Weight of each point. If None (default), every point has weight 1.
+
+    Returns
+    -------
+    T : LevelSetTree
+        Level set tree whose members are point indices.
+    """
+
+    ## Find the points in each group.
+    order = _np.argsort(assignment, kind='mergesort')
+    breaks = _np.searchsorted(assignment[order],
+                              _np.arange(1, len(tree.density)))
+    groups = _np.split(order, breaks)
+
+    density = _np.asarray(tree.density)[assignment]
+    T = LevelSetTree(density, tree.levels, weights)
+    T.prune_threshold = tree.prune_threshold
+    T.build_info = tree.build_info
+
+    mass = _background_mass(density, weights)
+
+    for k, v in tree.nodes.items():
+        members = _np.concatenate([groups[i] for i in v.members])
+        start_mass = v.start_mass if v.parent is None else mass(v.start_level)
+
+        T.nodes[k] = ConnectedComponent(
+            k, parent=v.parent, children=v.children[:],
+            start_level=v.start_level, end_level=v.end_level,
+            start_mass=start_mass, end_mass=mass(v.end_level),
+            members=set(members.tolist()))
+
+    return T
+
+
+def _density_stratified_sample(X, k, sample_size, rng, block_size=1000,
+                               num_strata=10, dtype=None):
+    """
+    Draw a sample with the same number of observations from each stratum of
+    a pilot density estimate. This function is not meant to be called by the
+    user; it is a helper function for `construct_tree_sampled`.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array
+        Numeric dataset, where each row represents one observation.
+
+    k : int
+        Number of neighbors for the pilot density estimate.
+
+    sample_size : int
+        Number of observations to draw, at most.
+
+    rng : numpy.random.RandomState
+        Random number generator.
+
+    block_size : int, optional
+        Number of observations for which to find pilot neighbors at once.
+
+    num_strata : int, optional
+        Number of strata, of equal width in log density.
+
+    dtype : numpy dtype, optional
+        Precision of the pilot distance computations.
+
+    Returns
+    -------
+    sample : numpy array[int]
+        Sorted row indices of the sampled observations.
+
+    weights : numpy array[float]
+        Inverse inclusion probability of each sampled observation.
+    """
+
+    n = X.shape[0]
+
+    ## Pilot density estimate, from the distances to a uniform sample.
+    pilot = rng.choice(n, sample_size, replace=False)
+    radii = _utl.knn_query(X, X[pilot], k, block_size=block_size,
+                           dtype=dtype)[0][:, -1]
+
+    positive = radii[radii > 0]
+    floor = positive.min() if len(positive) > 0 else 1.
+    log_radii = _np.log(_np.maximum(radii, floor))
+
+    edges = _np.linspace(log_radii.min(), log_radii.max(), num_strata + 1)
+    strata = _np.searchsorted(edges[1:-1], log_radii, side='right')
+
+    ## Draw the same number of observations from each non-empty stratum.
+    stratum_sizes = _np.bincount(strata, minlength=num_strata)
+    quota = sample_size // _np.count_nonzero(stratum_sizes)
+
+    sample = []
+    weights = []
+
+    for i in _np.flatnonzero(stratum_sizes):
+        members = _np.flatnonzero(strata == i)
+        num_drawn = min(quota, len(members))
+        sample.append(rng.choice(members, num_drawn, replace=False))
+        weights.append(_np.repeat(len(members) / float(num_drawn), num_drawn))
+
+    sample = _np.concatenate(sample)
+    weights = _np.concatenate(weights)
+    order = _np.argsort(sample)
+
+    return sample[order], weights[order]
+
+
+def _extend_tree(tree, nearest, density):
+    """
+    Extend a level set tree built on a sample to a larger set of points. Each
+    point joins the ancestors of the highest density node of its nearest
+    sample point, up to the deepest ancestor whose start level is below the
+    point's density. Every point belongs to the root of its nearest sample
+    point. Node masses are recomputed from all of the points. This function
+    is not meant to be called by the user.
+
+    Parameters
+    ----------
+    tree : LevelSetTree
+        Level set tree whose members are sample indices.
+
+    nearest : numpy array[int]
+        For each point, the index of its nearest sample point.
+
+    density : numpy array[float]
+        Estimated density of each point.
+
+    Returns
+    -------
+    T : LevelSetTree
+        Level set tree whose members are point indices.
+    """
+
+    parent, start_level, deepest = _node_tables(tree)
+    node = _assign_nodes(parent, start_level, deepest, nearest, density)
+
+    ## Each point belongs to its node and all of the node's ancestors.
+    members = {k: [] for k in tree.nodes.keys()}
+    order = _np.argsort(node, kind='mergesort')
+    breaks = _np.flatnonzero(_np.diff(node[order])) + 1
+
+    for group in _np.split(order, breaks):
+        ix = node[group[0]]
+        while ix >= 0:
+            members[ix].append(group)
+            ix = parent[ix]
+
+    T = LevelSetTree(density, tree.levels)
+    mass = _background_mass(density)
+
+    for k, v in tree.nodes.items():
+        start_mass = v.start_mass if v.parent is None else mass(v.start_level)
+
+        T.nodes[k] = ConnectedComponent(
+            k, parent=v.parent, children=v.children[:],
+            start_level=v.start_level, end_level=v.end_level,
+            start_mass=start_mass, end_mass=mass(v.end_level),
+            members=set(_np.concatenate(members[k]).tolist()))
+
+    return T
+
+
+def _node_tables(tree):
+    """
+    Tabulate the parent and start level of each node of a level set tree, and
+    the highest density node of each point, for `_assign_nodes`. This
+    function is not meant to be called by the user.
+
+    Returns
+    -------
+    parent : numpy array[int]
+        Parent of each node, indexed by node key, or -1 for roots.
+
+    start_level : numpy array[float]
+        Start level of each node, indexed by node key.
+
+    deepest : numpy array[int]
+        Highest density node of each point, as in
+        `LevelSetTree.branch_partition`, or -1 if no node contains the point.
+    """
+
+    num_keys = max(tree.nodes.keys()) + 1
+    parent = _np.repeat(-1, num_keys)
+    start_level = _np.zeros(num_keys, dtype=_np.float)
+
+    for k, v in tree.nodes.items():
+        parent[k] = -1 if v.parent is None else v.parent
+        start_level[k] = v.start_level
+
+    partition = tree.branch_partition()
+    deepest = _np.repeat(-1, len(tree.density))
+    deepest[partition[:, 0]] = partition[:, 1]
+
+    return parent, start_level, deepest
+
+
+def _detail_view(layout, xlim, width, min_pixels, min_mass):
+    """
+    Choose how to draw each node of a level set tree in the level-of-detail
+    mode of `LevelSetTree.plot`. A subtree is collapsed into a single glyph if
+    it is narrower than 'min_pixels' or smaller than 'min_mass'; because
+    children are narrower and smaller than their parents, only the tops of
+    collapsed subtrees need glyphs. Nodes outside the horizontal view are not
+    drawn. This function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    layout : dict
+        Tree layout, from `LevelSetTree._plot_layout`.
+
+    xlim : tuple [float]
+        Horizontal limits of the view, in data coordinates.
+
+    width : float
+        Width of the view in pixels.
+
+    min_pixels, min_mass : float
+        See `LevelSetTree.plot`.
+
+    Returns
+    -------
+    drawn : numpy array[bool]
+        Nodes to draw as segments.
+
+    collapsed : numpy array[bool]
+        Nodes to draw as a glyph for their whole subtree.
+    """
+    parent = layout['parent']
+    low, high = layout['low'], layout['high']
+    is_root = parent < 0
+
+    pixels = (high - low) * width / float(xlim[1] - xlim[0])
+    mass = layout['size'] / layout['size'][is_root].sum()
+    coarse = (pixels < min_pixels) | (mass < min_mass)
+    visible = (high >= xlim[0]) & (low <= xlim[1])
+
+    drawn = visible & ~coarse
+    collapsed = visible & coarse & (is_root | ~coarse[parent])
+
+    return drawn, collapsed
+
+
+def _tree_levels(parent, order):
+    """
+    Group the nodes of a tree by depth, for computations over a tree one
+    depth at a time. This function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    parent : numpy array[int]
+        Position of the parent of each node, or -1 for roots.
+
+    order : numpy array[int]
+        Node positions sorted by parent, with the roots first. Siblings are
+        listed in the order they should appear in the output.
+
+    Returns
+    -------
+    levels : list [numpy array[int]]
+        Node positions at each depth, starting with the roots. Within each
+        depth, the children of each node are grouped together in 'order',
+        and the groups follow the order of the parents at the previous depth.
+    """
+    is_root = parent < 0
+    num_children = _np.bincount(parent[~is_root], minlength=len(parent))
+    child_start = is_root.sum() + _np.cumsum(num_children) - num_children
+
+    levels = []
+    level = order[:is_root.sum()]
+
+    while len(level) > 0:
+        levels.append(level)
+        counts = num_children[level]
+        offsets = _np.repeat(child_start[level] - _np.cumsum(counts) + counts,
+                             counts)
+        level = order[offsets + _np.arange(counts.sum())]
+
+    return levels
+
+
+def _assign_nodes(parent, start_level, deepest, nearest, density):
+    """
+    Assign new points to the nodes of a level set tree. Each point starts at
+    the highest density node of its nearest tree point, and moves up the
+    tree until its density is above the node's start level, or the node is a
+    root. This function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    parent, start_level, deepest : numpy array
+        Node tables, from `_node_tables`.
+
+    nearest : numpy array[int]
+        For each new point, the index of its nearest tree point.
+
+    density : numpy array[float]
+        Estimated density of each new point.
+
+    Returns
+    -------
+    node : numpy array[int]
+        Node of each new point, or -1 if its nearest tree point is not in any
+        node.
+    """
+    node = deepest[nearest]
+    active = _np.flatnonzero(node >= 0)
+
+    while len(active) > 0:
+        u = node[active]
+        active = active[(start_level[u] >= density[active]) & (parent[u] >= 0)]
+        node[active] = parent[node[active]]
+
+    return node
+
+
+def _background_mass(density, weights=None):
+    """
+    Make a function that returns the fraction of the total weight with
+    density at or below a given level. This function is not meant to be
+    called by the user.
+
+    Parameters
+    ----------
+    density : numpy array[float]
+        Density of each point.
+
+    weights : numpy array, optional
+        Weight of each point. If None (default), every point has weight 1.
+
+    Returns
+    -------
+    mass : function
+        Maps a density level to the mass of its background set.
+    """
+
+    if weights is None:
+        weights = _np.ones(len(density), dtype=_np.int)
+
+    order = _np.argsort(density, kind='mergesort')
+    sorted_density = density[order]
+    mass_below = _np.insert(_np.cumsum(weights[order]), 0, 0)
+    n = float(mass_below[-1])
+
+    def mass(level):
+        ix = _np.searchsorted(sorted_density, level, side='right')
+        return 1. - ((mass_below[-1] - mass_below[ix]) / n)
+
+    return mass
+
+
+def _adjusted_rand_index(labels_a, labels_b):
+    """
+    Adjusted Rand index between two clusterings of the same points. This
+    function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    labels_a, labels_b : numpy array[int]
+        Cluster label of each point in each clustering.
+
+    Returns
+    -------
+    ari : float
+        1 for identical clusterings, and close to 0 for independent ones.
+    """
+
+    def pairs(counts):
+        counts = _np.asarray(counts, dtype=_np.float)
+        return _np.sum(counts * (counts - 1) / 2.)
+
+    _, a = _np.unique(labels_a, return_inverse=True)
+    _, b = _np.unique(labels_b, return_inverse=True)
+    _, contingency = _np.unique(a * (b.max() + 1) + b, return_counts=True)
+
+    index = pairs(contingency)
+    pairs_a = pairs(_np.bincount(a))
+    pairs_b = pairs(_np.bincount(b))
+    expected = pairs_a * pairs_b / pairs(len(a)) if len(a) > 1 else 0.
+    maximum = (pairs_a + pairs_b) / 2.
+
+    if maximum == expected:
+        return 1.
+
+    return (index - expected) / (maximum - expected)
+
+
 def load_tree(filename):
     """
     Load a saved tree from file.
@@ -0,0 +1,1012 @@
+"""
+Tools for serving level set trees from long-running processes, for the
+DEnsity-BAsed CLustering (DeBaCl) toolbox. New trees are built in the
+background, in a separate process, while queries are answered with the
+current tree. Trees can be published as memory-mapped arrays, which any
+number of worker processes can attach without copying. New points are
+assigned to clusters in micro-batches, over a stream or a local socket.
+"""
+
+## Built-in packages
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import os as _os
+import json as _json
+import operator as _operator
+import shutil as _shutil
+import tempfile as _tempfile
+import time as _time
+import functools as _functools
+import threading as _threading
+
+try:
+    from collections.abc import Set as _Set
+except ImportError:
+    from collections import Set as _Set
+
+try:
+    import queue as _queue
+    import socketserver as _socketserver
+except ImportError:
+    import Queue as _queue
+    import SocketServer as _socketserver
+
+import debacl.utils as _utl
+import debacl.level_set_tree as _lst
+
+## Required packages
+try:
+    import numpy as _np
+except:
+    raise ImportError("DeBaCl requires the numpy, networkx, and " +
+                      "prettytable packages.")
+
+## Soft dependencies
+try:
+    import concurrent.futures as _futures
+    _HAS_FUTURES = True
+except:
+    _HAS_FUTURES = False
+
+
+def build_async(X, k, executor=None, **kwargs):
+    """
+    Start the construction of a level set tree in the background, with
+    `debacl.construct_tree`.
+
+    Parameters
+    ----------
+    X : numpy array | scipy.sparse matrix
+        Data, passed to `construct_tree`.
+
+    k : int
+        Number of neighbors, passed to `construct_tree`.
+
+    executor : concurrent.futures.Executor, optional
+        Executor that runs the construction. If None (default), a new process
+        is started for it, so the construction doesn't hold the calling
+        process's global interpreter lock.
+
+    kwargs : keyword arguments
+        Other parameters of `construct_tree`.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Future whose result is the level set tree.
+
+    See Also
+    --------
+    TreeHolder, debacl.construct_tree
+
+    Notes
+    -----
+    On Python 2, this function requires the 'futures' package. On Python 3,
+    `asyncio.wrap_future` turns the output into an awaitable.
+
+    The data and the output tree are pickled to pass them between processes,
+    so the arguments must be picklable; for example, a 'cancel' function must
+    be defined at the top level of a module.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> future = debacl.build_async(X, k=8, prune_threshold=5)
+    >>> tree = future.result()
+    """
+    if executor is not None:
+        return executor.submit(_lst.construct_tree, X, k, **kwargs)
+
+    if not _HAS_FUTURES:
+        raise ImportError("Background construction requires the " +
+                          "'concurrent.futures' module ('futures' package " +
+                          "on Python 2).")
+
+    ## The worker process exits when the construction is done.
+    executor = _futures.ProcessPoolExecutor(max_workers=1)
+    future = executor.submit(_lst.construct_tree, X, k, **kwargs)
+    executor.shutdown(wait=False)
+
+    return future
+
+
+class TreeHolder(object):
+    """
+    Container for the level set tree that a service currently uses. Trees
+    built in the background are swapped in atomically when they are done,
+    so every query sees either the old tree or the new tree, never a mix.
+
+    Parameters
+    ----------
+    tree : LevelSetTree, optional
+        Initial tree.
+
+    Attributes
+    ----------
+    version : int
+        Number of times a tree has been swapped in, including the initial
+        tree.
+
+    error : Exception
+        Exception raised by the last failed background build, or None.
+
+    See Also
+    --------
+    build_async
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> holder = debacl.TreeHolder()
+    >>> tree = holder.rebuild(X, k=8, prune_threshold=5).result()
+    >>> labels = holder.get_clusters(method='leaf')
+
+    While the next tree is built, queries use the current one.
+
+    >>> future = holder.rebuild(numpy.random.rand(100, 2), k=8)
+    >>> labels = holder.get_clusters(method='leaf')
+    """
+
+    def __init__(self, tree=None):
+        self._lock = _threading.Lock()
+        self._tree = tree
+        self._ticket = 0
+        self._swapped_ticket = 0
+        self._error_ticket = 0
+        self.version = 0 if tree is None else 1
+        self.error = None
+
+    @property
+    def tree(self):
+        """
+        The current level set tree, or None if no tree has been built.
+        """
+        return self._tree
+
+    def swap(self, tree):
+        """
+        Replace the current tree. Background builds registered with `update`
+        before the swap no longer replace the tree when they are done.
+
+        Parameters
+        ----------
+        tree : LevelSetTree
+            New tree.
+
+        Returns
+        -------
+        old_tree : LevelSetTree
+            The tree that was replaced.
+        """
+        with self._lock:
+            old_tree = self._tree
+            self._tree = tree
+            self._swapped_ticket = self._ticket
+            self.version += 1
+
+        return old_tree
+
+    def update(self, future):
+        """
+        Swap in the result of a background build when it is done. If several
+        builds are pending, a build never replaces the tree from a build that
+        was registered after it. If the build fails, the current tree is
+        kept, and the exception is stored in 'error', unless a newer build
+        has already been swapped in.
+
+        Parameters
+        ----------
+        future : concurrent.futures.Future
+            Future whose result is a level set tree, e.g. from `build_async`.
+
+        Returns
+        -------
+        swapped : concurrent.futures.Future
+            Future with the same result as the input future, which is done
+            only after the holder has handled the result, so the new tree is
+            already in the holder when `swapped.result()` returns.
+        """
+        with self._lock:
+            self._ticket += 1
+            ticket = self._ticket
+
+        swapped = _futures.Future()
+        future.add_done_callback(_functools.partial(self._finish, ticket,
+                                                    swapped))
+
+        return swapped
+
+    def rebuild(self, X, k, executor=None, **kwargs):
+        """
+        Build a new tree in the background with `build_async`, and swap it in
+        when it is done. The parameters are those of `build_async`.
+
+        Returns
+        -------
+        swapped : concurrent.futures.Future
+            Future whose result is the new level set tree, done after the
+            tree is swapped in; see `update`.
+        """
+        return self.update(build_async(X, k, executor=executor, **kwargs))
+
+    def get_clusters(self, *args, **kwargs):
+        """
+        Retrieve cluster labels from the current tree, with
+        `LevelSetTree.get_clusters`.
+        """
+        tree = self._tree
+
+        if tree is None:
+            raise ValueError("The holder does not have a tree yet.")
+
+        return tree.get_clusters(*args, **kwargs)
+
+    def _finish(self, ticket, swapped, future):
+        """
+        Swap in the result of a completed build, then pass the result on to
+        the future returned by `update`. This function is not meant to be
+        called by the user; it is the callback for `update`.
+        """
+        if future.cancelled():
+            swapped.cancel()
+            return
+
+        error = future.exception()
+
+        if error is not None:
+            with self._lock:
+                if ticket > max(self._swapped_ticket, self._error_ticket):
+                    self._error_ticket = ticket
+                    self.error = error
+
+            swapped.set_exception(error)
+            return
+
+        tree = future.result()
+
+        ## A cancelled construction has no tree.
+        if tree is not None:
+            with self._lock:
+                if ticket > self._swapped_ticket:
+                    self._swapped_ticket = ticket
+                    self._tree = tree
+                    self.version += 1
+
+                    if ticket > self._error_ticket:
+                        self.error = None
+
+        swapped.set_result(tree)
+
+
+def publish_tree(tree, directory):
+    """
+    Save a level set tree as a directory of flat '.npy' arrays, which worker
+    processes can attach read-only with `attach_tree`, without copying.
+
+    Parameters
+    ----------
+    tree : LevelSetTree
+        Tree to publish.
+
+    directory : str
+        Output directory. It must not exist yet; the tree is written to a
+        temporary directory that is then renamed, so workers never see a
+        partial tree.
+
+    See Also
+    --------
+    attach_tree, LevelSetTree.save
+
+    Notes
+    -----
+    The points are ordered so that the members of every node are a
+    contiguous block: each node's own points, i.e. those not in any of its
+    children, come first, followed by the blocks of its children. The node
+    table stores the start and end of each node's block in this permutation.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> debacl.publish_tree(tree, 'my_tree_v1')
+    """
+    density = _np.asarray(tree.density)
+    ids = sorted(tree.nodes)
+
+    ## Group the points by the highest density node that contains them.
+    node_index, point_node = tree._point_node_map()
+
+    order = _np.argsort(point_node, kind='mergesort')
+    breaks = _np.searchsorted(point_node[order], _np.arange(len(ids) + 1))
+    own_points = _np.split(order, breaks[1:-1])
+
+    ## Lay out the blocks in depth-first order.
+    pieces = []
+    offset = 0
+    start = _np.zeros(len(ids), dtype=_np.int)
+    stop = _np.zeros(len(ids), dtype=_np.int)
+
+    roots = sorted(k for k, v in tree.nodes.items() if v.parent is None)
+    stack = [(ix, False) for ix in reversed(roots)]
+
+    while len(stack) > 0:
+        ix, done = stack.pop()
+        i = node_index[ix]
+
+        if done:
+            stop[i] = offset
+        else:
+            start[i] = offset
+            pieces.append(own_points[i])
+            offset += len(own_points[i])
+
+            stack.append((ix, True))
+            stack += [(c, False) for c in reversed(tree.nodes[ix].children)]
+
+    permutation = _np.concatenate(pieces + [_np.zeros(0, dtype=_np.int)])
+    position = _np.full(len(density), -1, dtype=_np.int)
+    position[permutation] = _np.arange(len(permutation))
+
+    nodes = [tree.nodes[ix] for ix in ids]
+    fields = [[v.start_level, v.end_level, v.start_mass, v.end_mass]
+              for v in nodes]
+    children = [_np.array(v.children, dtype=_np.int) for v in nodes]
+
+    arrays = dict(
+        density=density, levels=_np.asarray(tree.levels),
+        ids=_np.array(ids, dtype=_np.int),
+        parents=_np.array([-1 if v.parent is None else v.parent
+                           for v in nodes], dtype=_np.int),
+        fields=_np.array(fields, dtype=_np.float).reshape((-1, 4)),
+        start=start, stop=stop, permutation=permutation, position=position,
+        children=_np.concatenate(children + [_np.zeros(0, dtype=_np.int)]),
+        child_offsets=_np.cumsum([0] + [len(x) for x in children]))
+
+    if tree.weights is not None:
+        arrays['weights'] = _np.asarray(tree.weights)
+
+    info = {'prune_threshold': tree.prune_threshold,
+            'build_info': tree.build_info}
+
+    parent_directory = _os.path.dirname(_os.path.abspath(directory))
+    staging = _tempfile.mkdtemp(dir=parent_directory, prefix='.tmp-')
+
+    try:
+        for name, value in arrays.items():
+            _np.save(_os.path.join(staging, name + '.npy'), value)
+
+        with open(_os.path.join(staging, 'info.json'), 'w') as f:
+            _json.dump(info, f, default=_json_default)
+
+        _os.rename(staging, directory)
+
+    except:
+        _shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+
+def attach_tree(directory):
+    """
+    Attach a level set tree saved by `publish_tree`. The density, levels,
+    weights, and node memberships are read-only memory maps of the published
+    files, so the operating system shares them between all the processes
+    that attach the same tree.
+
+    Parameters
+    ----------
+    directory : str
+        Directory written by `publish_tree`.
+
+    Returns
+    -------
+    T : LevelSetTree
+        The level set tree. Node members are read-only set-like views of the
+        published arrays. Pickling or pruning the tree makes private copies.
+
+    See Also
+    --------
+    publish_tree, debacl.load_tree
+
+    Examples
+    --------
+    >>> tree = debacl.attach_tree('my_tree_v1')
+    >>> labels = tree.get_clusters(method='leaf')
+    """
+    def load(name):
+        return _np.load(_os.path.join(directory, name + '.npy'),
+                        mmap_mode='r')
+
+    with open(_os.path.join(directory, 'info.json')) as f:
+        info = _json.load(f)
+
+    if _os.path.exists(_os.path.join(directory, 'weights.npy')):
+        weights = load('weights')
+    else:
+        weights = None
+
+    T = _lst.LevelSetTree(load('density'), load('levels'), weights)
+    T.prune_threshold = info['prune_threshold']
+    T.build_info = info['build_info']
+
+    ## The node table is small, so it is read into memory.
+    ids = _np.array(load('ids'))
+    parents = _np.array(load('parents'))
+    fields = _np.array(load('fields'))
+    start = _np.array(load('start'))
+    stop = _np.array(load('stop'))
+    children = _np.split(_np.array(load('children')),
+                         _np.array(load('child_offsets'))[1:-1])
+
+    permutation = load('permutation')
+    position = load('position')
+
+    for j, ix in enumerate(ids.tolist()):
+        start_level, end_level, start_mass, end_mass = fields[j].tolist()
+        T.nodes[ix] = _lst.ConnectedComponent(
+            ix, parent=None if parents[j] < 0 else int(parents[j]),
+            children=children[j].tolist(), start_level=start_level,
+            end_level=end_level, start_mass=start_mass, end_mass=end_mass,
+            members=_MemberView(permutation, position, int(start[j]),
+                                int(stop[j])))
+
+    return T
+
+
+class _MemberView(_Set):
+    """
+    Read-only set of the members of a node in an attached tree, backed by a
+    slice of the published point permutation. This class is not meant to be
+    used directly; see `attach_tree`.
+
+    Parameters
+    ----------
+    permutation : numpy array[int]
+        Points in the published order.
+
+    position : numpy array[int]
+        Position of each point in 'permutation', or -1.
+
+    start, stop : int
+        Slice of 'permutation' with the node's members.
+    """
+
+    def __init__(self, permutation, position, start, stop):
+        self._permutation = permutation
+        self._position = position
+        self._start = start
+        self._stop = stop
+
+    @classmethod
+    def _from_iterable(cls, iterable):
+        ## Set operations return regular sets.
+        return set(iterable)
+
+    def __contains__(self, point):
+        try:
+            point = _operator.index(point)
+        except TypeError:
+            return False
+
+        if point < 0 or point >= len(self._position):
+            return False
+
+        return self._start <= self._position[point] < self._stop
+
+    def __iter__(self):
+        return iter(self._permutation[self._start:self._stop].tolist())
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __repr__(self):
+        return repr(set(self))
+
+    def copy(self):
+        """
+        Return the members as a regular, mutable set.
+        """
+        return set(self)
+
+    def __deepcopy__(self, memo):
+        return set(self)
+
+    def __reduce__(self):
+        return (set, (list(self),))
+
+
+class TreeAssigner(object):
+    """
+    Assign new points to the clusters of a fixed level set tree. Each point's
+    density is estimated from its k-nearest neighbors in the tree's data, and
+    the point joins the node of its nearest neighbor, or the deepest ancestor
+    of that node whose start level is below the point's density. The point's
+    label is the cluster that contains its node, or -1 for background points.
+
+    Parameters
+    ----------
+    tree : LevelSetTree
+        Level set tree built on 'X' with `construct_tree`.
+
+    X : numpy array
+        Data used to build the tree.
+
+    k : int
+        Number of neighbors for the density estimate, usually the same as for
+        the tree.
+
+    method : str, optional
+        Cluster labeling method; see `LevelSetTree.get_clusters`.
+
+    method_params : dict, optional
+        Parameters of the labeling method, e.g. {'k': 3} for 'first-k'.
+
+    dtype : numpy dtype, optional
+        Precision of the neighbor search; see `debacl.utils.knn_query`.
+
+    metric : str or callable, optional
+        Distance metric, the same as for the tree; see
+        `debacl.utils.knn_query`.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    n_jobs : int, optional
+        Number of threads for the neighbor search, or -1 for one thread per
+        CPU.
+
+    See Also
+    --------
+    MicroBatcher
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> assigner = debacl.TreeAssigner(tree, X, k=8)
+    >>> labels = assigner(numpy.random.rand(10, 2))
+    """
+
+    def __init__(self, tree, X, k, method='leaf', method_params=None,
+                 dtype=None, metric='euclidean', metric_params=None,
+                 n_jobs=1):
+        self.tree = tree
+        self.X = X
+        self.k = k
+        self.dtype = dtype
+        self.metric = metric
+        self.metric_params = metric_params
+        self.n_jobs = n_jobs
+
+        self._parent, self._start_level, self._deepest = \
+            _lst._node_tables(tree)
+
+        ## Label each node with the cluster that contains it.
+        self._cluster = _np.repeat(-1, len(self._parent))
+        labels = tree.get_clusters(method, **(method_params or {}))
+
+        for c in _np.unique(labels[:, 1]).tolist():
+            stack = [c]
+            while len(stack) > 0:
+                u = stack.pop()
+                self._cluster[u] = c
+                stack += tree.nodes[u].children
+
+        self._cluster = _np.append(self._cluster, -1)  # for node -1
+
+    def __call__(self, points):
+        """
+        Label new points.
+
+        Parameters
+        ----------
+        points : numpy array
+            New points, one per row.
+
+        Returns
+        -------
+        labels : numpy array[int]
+            Cluster label of each point, or -1 for background points.
+        """
+        nearest, density = self._estimate(points)
+        node = _lst._assign_nodes(self._parent, self._start_level,
+                                  self._deepest, nearest, density)
+
+        return self._cluster[node]
+
+    def _estimate(self, points):
+        """
+        Find the nearest neighbor of each point in the data, and estimate
+        the density at each point. This function is not meant to be called by
+        the user.
+        """
+        if not _utl._issparse(points):
+            points = _np.atleast_2d(points)
+        distances, neighbors = _utl.knn_query(
+            points, self.X, self.k, dtype=self.dtype, metric=self.metric,
+            metric_params=self.metric_params, n_jobs=self.n_jobs)
+
+        p = _utl.density_dimension(self.X, self.metric)
+        n = len(self.tree.density)
+
+        ## Like in `knn_graph`, each point counts itself as its first
+        #  neighbor. A point of the data is its own nearest neighbor, but a
+        #  new point is not, so its radius is the distance to its (k-1)'th
+        #  neighbor in the data.
+        if self.k > 1:
+            new = distances[:, 0] > 0
+            radius = _np.where(new, distances[:, -2], distances[:, -1])
+        else:
+            new = _np.zeros(len(distances), dtype=_np.bool)
+            radius = distances[:, -1]
+
+        if self.tree.weights is None:
+            density = _utl.knn_density(radius, n, p, self.k, self.metric,
+                                       self.metric_params)
+        else:
+            ## New points have unit weight.
+            weights = _np.asarray(self.tree.weights)
+            neighbor_weights = weights[neighbors].sum(axis=1)
+            neighbor_weights[new] += 1 - weights[neighbors[new, -1]]
+            density = _utl.knn_density(radius, weights.sum(), p,
+                                       neighbor_weights, self.metric,
+                                       self.metric_params)
+
+        return neighbors[:, 0], density
+
+
+class MicroBatcher(object):
+    """
+    Queue single requests and process them in batches. A worker thread
+    collects requests until the batch is full or the oldest request has
+    waited 'max_latency' seconds, calls 'function' once on the stacked
+    requests, and answers each caller with its row of the result. If the
+    batch fails, e.g. because one request has the wrong shape, the requests
+    are retried one at a time, so only the bad requests fail.
+
+    Parameters
+    ----------
+    function : function
+        Vectorized function of a 2-dimensional array, which returns one
+        result per row, e.g. a `TreeAssigner`.
+
+    max_batch_size : int, optional
+        Maximum number of requests in a batch.
+
+    max_latency : float, optional
+        Maximum time in seconds that a request waits for the batch to fill.
+
+    See Also
+    --------
+    TreeAssigner, serve_stream, socket_server, benchmark
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> with debacl.MicroBatcher(debacl.TreeAssigner(tree, X, k=8)) as batcher:
+    ...     future = batcher.submit([0.5, 0.5])
+    ...     label = future.result()
+    """
+
+    def __init__(self, function, max_batch_size=256, max_latency=0.002):
+        if not _HAS_FUTURES:
+            raise ImportError("Micro-batching requires the " +
+                              "'concurrent.futures' module ('futures' " +
+                              "package on Python 2).")
+
+        self.function = function
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+
+        self._requests = _queue.Queue()
+        self._lock = _threading.Lock()
+        self._closed = False
+        self._worker = _threading.Thread(target=self._run)
+        self._worker.daemon = True
+        self._worker.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def submit(self, point):
+        """
+        Queue a request.
+
+        Parameters
+        ----------
+        point : array_like
+            One row of input for 'function'.
+
+        Returns
+        -------
+        future : concurrent.futures.Future
+            Future whose result is the row of the output for 'point'.
+
+        Raises
+        ------
+        RuntimeError
+            If the batcher is closed.
+        """
+        future = _futures.Future()
+
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The batcher is closed.")
+
+            self._requests.put((point, future))
+
+        return future
+
+    def close(self):
+        """
+        Process the queued requests, then stop the worker thread. Requests
+        submitted after closing raise a RuntimeError.
+        """
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                self._requests.put(None)
+
+        self._worker.join()
+
+    def _run(self):
+        """
+        Worker loop. This function is not meant to be called by the user.
+        """
+        closed = False
+
+        while not closed:
+            request = self._requests.get()
+            if request is None:
+                break
+
+            batch = [request]
+            deadline = _time.time() + self.max_latency
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - _time.time()
+                try:
+                    if timeout > 0:
+                        request = self._requests.get(timeout=timeout)
+                    else:
+                        request = self._requests.get_nowait()
+                except _queue.Empty:
+                    break
+
+                if request is None:
+                    closed = True
+                    break
+
+                batch.append(request)
+
+            batch = [(x, f) for x, f in batch
+                     if f.set_running_or_notify_cancel()]
+
+            if len(batch) == 0:
+                continue
+
+            try:
+                results = self.function(_np.vstack([x for x, _ in batch]))
+                num_results = len(results)
+            except Exception as error:
+                if len(batch) == 1:
+                    batch[0][1].set_exception(error)
+                    continue
+            else:
+                if num_results != len(batch):
+                    error = ValueError("The function returned {} results "
+                                       "for {} requests.".format(
+                                           num_results, len(batch)))
+                    for _, future in batch:
+                        future.set_exception(error)
+                else:
+                    for (_, future), result in zip(batch, results):
+                        future.set_result(result)
+                continue
+
+            ## Find the bad requests.
+            for x, future in batch:
+                try:
+                    result = self.function(_np.vstack([x]))[0]
+                except Exception as error:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+
+
+def serve_stream(batcher, infile, outfile):
+    """
+    Answer requests from a line-based stream, e.g. stdin and stdout, until
+    the input ends. Each input line is a JSON list with the coordinates of one
+    point, and each output line is the JSON result for that point, in the
+    same order. Requests are read ahead of the answers, so a client can send
+    many points before reading. A request that fails, including a line that
+    isn't valid JSON, is answered with an object whose 'error' field is the
+    error message.
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+        Batcher that processes the requests.
+
+    infile, outfile : file
+        Input and output streams.
+
+    See Also
+    --------
+    socket_server
+
+    Examples
+    --------
+    >>> import sys
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> batcher = debacl.MicroBatcher(debacl.TreeAssigner(tree, X, k=8))
+    >>> debacl.serve_stream(batcher, sys.stdin, sys.stdout)
+    """
+    pending = _queue.Queue()
+
+    def write():
+        while True:
+            future = pending.get()
+            if future is None:
+                break
+
+            try:
+                result = future.result()
+            except Exception as error:
+                result = {'error': str(error)}
+
+            outfile.write(_json.dumps(result, default=_json_default) + '\n')
+            outfile.flush()
+
+    writer = _threading.Thread(target=write)
+    writer.start()
+
+    try:
+        for line in iter(infile.readline, ''):
+            if len(line.strip()) == 0:
+                continue
+
+            try:
+                point = _np.array(_json.loads(line), dtype=_np.float)
+            except Exception as error:
+                future = _futures.Future()
+                future.set_exception(error)
+            else:
+                future = batcher.submit(point)
+
+            pending.put(future)
+    finally:
+        pending.put(None)
+        writer.join()
+
+
+def socket_server(batcher, address):
+    """
+    Create a server that answers requests from local socket connections, with
+    the line protocol of `serve_stream`. All connections share the batcher, so
+    requests from different clients are processed in the same batches.
+
+    Parameters
+    ----------
+    batcher : MicroBatcher
+        Batcher that processes the requests.
+
+    address : str or tuple
+        File name of a Unix domain socket, or a (host, port) pair for a TCP
+        socket.
+
+    Returns
+    -------
+    server : socketserver.BaseServer
+        Server, which handles each connection in a new thread. Call its
+        'serve_forever' method to start answering, and 'shutdown' to stop.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> batcher = debacl.MicroBatcher(debacl.TreeAssigner(tree, X, k=8))
+    >>> server = debacl.socket_server(batcher, ('localhost', 8470))
+    >>> server.serve_forever()
+    """
+
+    class Handler(_socketserver.StreamRequestHandler):
+        def handle(self):
+            serve_stream(batcher, self.rfile, self.wfile)
+
+    if isinstance(address, tuple):
+        server_class = _socketserver.ThreadingTCPServer
+    else:
+        server_class = _socketserver.ThreadingUnixStreamServer
+
+    server_class.daemon_threads = True
+    server_class.allow_reuse_address = True
+
+    return server_class(address, Handler)
+
+
+def benchmark(function, queries, batch_sizes=(1, 16, 256), max_latency=0.002,
+              num_clients=32):
+    """
+    Measure the latency and throughput of micro-batched requests, with a
+    local load generator. For each batch size, 'num_clients' threads send the
+    rows of 'queries' one at a time to a `MicroBatcher`, each waiting for the
+    answer before sending the next request.
+
+    Parameters
+    ----------
+    function : function
+        Vectorized function to serve, e.g. a `TreeAssigner`.
+
+    queries : numpy array
+        Requests, one per row.
+
+    batch_sizes : list [int], optional
+        Maximum batch sizes to test.
+
+    max_latency : float, optional
+        Maximum time in seconds that a request waits for its batch to fill.
+
+    num_clients : int, optional
+        Number of concurrent clients.
+
+    Returns
+    -------
+    results : list [dict]
+        For each batch size, the 'batch_size', the median and 99th percentile
+        latency in seconds ('p50' and 'p99'), and the 'throughput' in
+        requests per second.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(1000, 2)
+    >>> tree = debacl.construct_tree(X, k=8, prune_threshold=5)
+    >>> results = debacl.benchmark(debacl.TreeAssigner(tree, X, k=8),
+    ...                            numpy.random.rand(5000, 2))
+    """
+    results = []
+
+    for batch_size in batch_sizes:
+        latencies = _np.empty(len(queries), dtype=_np.float)
+
+        with MicroBatcher(function, max_batch_size=batch_size,
+                          max_latency=max_latency) as batcher:
+
+            def client(rows):
+                for i in rows:
+                    start = _time.time()
+                    batcher.submit(queries[i]).result()
+                    latencies[i] = _time.time() - start
+
+            clients = [_threading.Thread(target=client, args=(rows,))
+                       for rows in _np.array_split(_np.arange(len(queries)),
+                                                   num_clients)]
+            start = _time.time()
+
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+
+            elapsed = _time.time() - start
+
+        results.append({'batch_size': batch_size,
+                        'p50': _np.percentile(latencies, 50),
+                        'p99': _np.percentile(latencies, 99),
+                        'throughput': len(queries) / elapsed})
+
+    return results
+
+
+def _json_default(obj):
+    """
+    Convert numpy values for JSON output. This function is not meant to be
+    called by the user.
+    """
+    return _np.asarray(obj).tolist()
@@ -0,0 +1,154 @@
+
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import os
+import time
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import scipy.sparse as sps
+from numpy.testing import assert_array_equal
+
+import debacl as dcl
+
+
+class TestNeighborCache(unittest.TestCase):
+    """
+    Unit test class for the on-disk cache of neighbor graphs and density
+    estimates.
+    """
+
+    def setUp(self):
+        np.random.seed(451)
+        self.X = np.random.rand(100, 2)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def test_key(self):
+        """
+        Test that cache keys depend on the contents of the data and the
+        values of the parameters, and nothing else.
+        """
+        cache = dcl.NeighborCache(self.directory)
+
+        key = cache.key(self.X, 5, metric='euclidean')
+        self.assertEqual(key, cache.key(self.X.copy(), 5, metric='euclidean'))
+        self.assertEqual(key, cache.key(np.asfortranarray(self.X), 5,
+                                        metric='euclidean'))
+
+        Y = self.X.copy()
+        Y[0, 0] += 1e-12
+        self.assertNotEqual(key, cache.key(Y, 5, metric='euclidean'))
+        self.assertNotEqual(key, cache.key(self.X, 6, metric='euclidean'))
+        self.assertNotEqual(key, cache.key(self.X, 5, metric='cosine'))
+        self.assertNotEqual(key, cache.key(self.X.astype(np.float32), 5,
+                                           metric='euclidean'))
+
+        ## Sparse matrices are hashed by content, in any format.
+        S = sps.csr_matrix(self.X)
+        self.assertEqual(cache.key(S), cache.key(sps.coo_matrix(self.X)))
+        self.assertNotEqual(cache.key(S), cache.key(self.X))
+
+        ## Types are hashed by name, but functions can't be hashed.
+        self.assertEqual(cache.key(dtype=np.float32),
+                         cache.key(dtype=np.float32))
+
+        with self.assertRaises(TypeError):
+            cache.key(metric=lambda X, Y: X.dot(Y.T))
+
+    def test_put_get(self):
+        """
+        Test that stored arrays are retrieved unchanged, as memory maps.
+        """
+        cache = dcl.NeighborCache(self.directory)
+        key = cache.key(self.X)
+        self.assertIsNone(cache.get(key))
+
+        neighbors = np.arange(20).reshape((10, 2))
+        cache.put(key, neighbors=neighbors, radii=self.X[:, 0])
+
+        entry = cache.get(key)
+        self.assertEqual(sorted(entry.keys()), ['neighbors', 'radii'])
+        self.assertTrue(isinstance(entry['neighbors'], np.memmap))
+        assert_array_equal(entry['neighbors'], neighbors)
+        assert_array_equal(entry['radii'], self.X[:, 0])
+
+        cache.clear()
+        self.assertIsNone(cache.get(key))
+
+    def test_eviction(self):
+        """
+        Test that the least recently used entries are removed when the cache
+        exceeds its size budget.
+        """
+        cache = dcl.NeighborCache(self.directory)
+        for key in ['a', 'b', 'c']:
+            cache.put(key, values=np.zeros(1000))
+
+        ## Make 'a' the most recently used entry.
+        now = time.time()
+        for age, key in zip([1, 3, 2], ['a', 'b', 'c']):
+            path = os.path.join(self.directory, key)
+            os.utime(path, (now - age, now - age))
+
+        cache.max_bytes = 2 * 8500
+        cache.evict()
+
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+        ## The entry just stored is never evicted.
+        cache.max_bytes = 1
+        cache.put('d', values=np.zeros(1000))
+        self.assertEqual(os.listdir(self.directory), ['d'])
+
+    def test_construct_tree(self):
+        """
+        Test that trees built from cached neighbor graphs and densities match
+        the trees built from scratch.
+        """
+        X = np.vstack((self.X, self.X[:10]))
+
+        for kwargs in [{}, {'num_components': 1, 'random_state': 19}]:
+            ans = dcl.construct_tree(X, k=8, prune_threshold=5, **kwargs)
+
+            tree = dcl.construct_tree(X, k=8, prune_threshold=5,
+                                      cache=self.directory, **kwargs)
+            self.assertEqual(len(os.listdir(self.directory)), 1)
+
+            ## The neighbor radii of the unique rows are cached too.
+            key = os.listdir(self.directory)[0]
+            entry = dcl.NeighborCache(self.directory).get(key)
+            self.assertEqual(entry['radii'].shape, (len(self.X),))
+            self.assertTrue(np.all(entry['radii'] > 0))
+
+            cached = dcl.construct_tree(X, k=8, prune_threshold=5,
+                                        cache=self.directory, **kwargs)
+
+            for t in [tree, cached]:
+                assert_array_equal(t.density, ans.density)
+                self.assertEqual(sorted(t.nodes.keys()),
+                                 sorted(ans.nodes.keys()))
+                for idx, node in ans.nodes.items():
+                    assert_array_equal(t.nodes[idx].members, node.members)
+
+            dcl.NeighborCache(self.directory).clear()
+
+        ## Unseeded random results are not cached.
+        dcl.construct_tree(X, k=8, num_components=1, cache=self.directory)
+        self.assertEqual(os.listdir(self.directory), [])
+
+        ## Results for a function metric are cached only with a key.
+        def metric(A, B):
+            return np.abs(A[:, :1] - B[:, 0])
+
+        for cache_key, num_entries in [(None, 0), ('first-coordinate', 1)]:
+            for _ in range(2):
+                dcl.construct_tree(self.X, k=8, metric=metric,
+                                   cache=self.directory, cache_key=cache_key)
+            self.assertEqual(len(os.listdir(self.directory)), num_entries)
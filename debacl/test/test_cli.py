@@ -0,0 +1,138 @@
+
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import io
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import debacl as dcl
+import debacl.cli as cli
+
+
+class TestCommandLine(unittest.TestCase):
+    """
+    Unit test class for the command line interface.
+    """
+
+    def setUp(self):
+        np.random.seed(451)
+        self.X = np.random.rand(100, 2)
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def test_read_data(self):
+        """
+        Test that text files parsed in chunks match the data.
+        """
+        with open(self.path('data.csv'), 'w') as f:
+            f.write("x,y\n")
+            for row in self.X:
+                f.write("{!r},{!r}\n".format(row[0], row[1]))
+
+        X, temp_file = cli._read_data(self.path('data.csv'), skip_header=1,
+                                      chunk_size=7)
+        self.assertEqual(X.shape, (100, 2))
+        assert_array_equal(X, self.X)
+        del X
+        os.remove(temp_file)
+
+        np.save(self.path('data.npy'), self.X)
+        X, temp_file = cli._read_data(self.path('data.npy'))
+        self.assertIsNone(temp_file)
+        self.assertTrue(isinstance(X, np.memmap))
+        assert_array_equal(X, self.X)
+
+    def test_build_prune_labels(self):
+        """
+        Test that the commands reproduce building, pruning, and labeling a
+        tree in Python.
+        """
+        np.savetxt(self.path('data.csv'), self.X, delimiter=',')
+        ans = dcl.construct_tree(self.X, k=8, prune_threshold=5)
+
+        status = cli.main(['build', self.path('data.csv'),
+                           self.path('tree.pkl'), '--k', '8',
+                           '--prune-threshold', '5', '--profile',
+                           '--cache-dir', self.path('cache')])
+        self.assertEqual(status, 0)
+        self.assertEqual(len(os.listdir(self.path('cache'))), 1)
+
+        tree = dcl.load_tree(self.path('tree.pkl'))
+        assert_array_equal(tree.density, ans.density)
+        self.assertEqual(sorted(tree.nodes.keys()), sorted(ans.nodes.keys()))
+
+        status = cli.main(['prune', self.path('tree.pkl'),
+                           self.path('pruned.pkl'), '--threshold', '20'])
+        self.assertEqual(status, 0)
+        ans = ans.prune(20)
+
+        status = cli.main(['labels', self.path('pruned.pkl'),
+                           self.path('labels.npy'), '--method', 'first-k',
+                           '--k', '2'])
+        self.assertEqual(status, 0)
+
+        labels = np.load(self.path('labels.npy'))
+        assert_array_equal(labels, ans.get_clusters(
+            'first-k', fill_background=True, k=2)[:, 1])
+
+        ## Missing method parameters are reported, not raised.
+        status = cli.main(['labels', self.path('pruned.pkl'),
+                           self.path('labels.npy'), '--method', 'k-level'])
+        self.assertEqual(status, 1)
+
+    def test_profiler(self):
+        """
+        Test that each phase reports its own memory, not only the process
+        peak.
+        """
+        profiler = cli._Profiler(enabled=True)
+
+        with profiler.phase('allocate'):
+            x = np.ones(2**24)
+        with profiler.phase('nothing'):
+            pass
+        del x
+
+        (_, _, peak, increase), (_, _, _, no_increase) = profiler.phases
+        self.assertGreaterEqual(peak, 2**27)
+
+        ## Without tracemalloc, the increase of the process peak.
+        if increase is not None:
+            self.assertTrue(0 <= increase <= peak)
+            self.assertLess(no_increase, 2**20)
+
+        stream = io.StringIO() if sys.version_info[0] > 2 else io.BytesIO()
+        profiler.report(stream)
+        self.assertEqual(len(stream.getvalue().splitlines()), 2)
+
+    def test_import(self):
+        """
+        Test that importing DeBaCl doesn't load plotting, graph, scipy, or
+        scikit-learn libraries, or configure logging.
+        """
+        import_times, process_times, loaded = cli._measure_import('debacl',
+                                                                  repeats=1)
+        self.assertEqual(len(import_times), 1)
+        self.assertTrue(import_times[0] < process_times[0])
+        self.assertTrue('numpy' in loaded)
+        for module in ['matplotlib', 'networkx', 'prettytable', 'scipy',
+                       'sklearn']:
+            self.assertFalse(module in loaded)
+
+        output = subprocess.check_output(
+            [sys.executable, '-c', "import sys, logging, debacl; " +
+             "print(len(logging.getLogger().handlers)); " +
+             "print('scipy' in sys.modules)"])
+        self.assertEqual(output.decode().split(), ['0', 'False'])
@@ -0,0 +1,112 @@
+
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import unittest
+import numpy as np
+from numpy.testing import assert_array_equal
+
+import debacl as dcl
+
+
+class TestEstimator(unittest.TestCase):
+    """
+    Unit test class for the scikit-learn style clustering estimator.
+    """
+
+    def setUp(self):
+        np.random.seed(451)
+        self.X = np.vstack((np.random.randn(150, 2),
+                            np.random.randn(150, 2) + 5))
+
+    def test_fit(self):
+        """
+        Test that the estimator's labels match the labels of the level set
+        tree, and that new points get the labels of their clusters.
+        """
+        tree = dcl.construct_tree(self.X, k=10, prune_threshold=20)
+        ans = tree.get_clusters(fill_background=True)[:, 1]
+
+        model = dcl.DeBaClClustering(k=10, prune_threshold=20)
+        assert_array_equal(model.fit_predict(self.X), ans)
+        assert_array_equal(model.labels_, ans)
+        assert_array_equal(model.predict(self.X), ans)
+
+        ## Parallel neighbor search gives the same labels.
+        model = dcl.DeBaClClustering(k=10, prune_threshold=20, n_jobs=2)
+        assert_array_equal(model.fit_predict(self.X), ans)
+        assert_array_equal(model.predict(self.X), ans)
+
+        ## The assigner is reused until the next fit.
+        assigner = model._assigner
+        self.assertEqual(assigner.n_jobs, 2)
+        model.predict(self.X[:10])
+        self.assertIs(model._assigner, assigner)
+        model.fit(self.X)
+        self.assertIsNone(model._assigner)
+
+        model = dcl.DeBaClClustering(k=10, prune_threshold=20,
+                                     method='first-k',
+                                     method_params={'k': 2})
+        labels = model.fit_predict(self.X)
+        self.assertEqual(len(np.unique(labels[labels >= 0])), 2)
+        assert_array_equal(model.predict(self.X), labels)
+
+        with self.assertRaises(ValueError):
+            dcl.DeBaClClustering().predict(self.X)
+
+    def test_params(self):
+        """
+        Test the scikit-learn parameter interface.
+        """
+        model = dcl.DeBaClClustering(k=7, warm_start=True)
+        params = model.get_params()
+        self.assertEqual(params['k'], 7)
+        self.assertTrue(params['warm_start'])
+
+        model.set_params(prune_threshold=5, method='k-level')
+        self.assertEqual(model.prune_threshold, 5)
+        self.assertEqual(model.method, 'k-level')
+
+        with self.assertRaises(ValueError):
+            model.set_params(num_neighbors=5)
+
+        ## Scikit-learn's clone works without the estimator base class.
+        from sklearn.base import clone
+        copy = clone(model)
+        self.assertIsNot(copy, model)
+        self.assertEqual(copy.get_params(), model.get_params())
+        self.assertEqual(repr(copy), repr(model))
+
+    def test_warm_start(self):
+        """
+        Test that a warm start reuses the neighbor graph and tree when only
+        the pruning or labeling parameters change, and gives the same labels
+        as a cold start.
+        """
+        model = dcl.DeBaClClustering(k=10, prune_threshold=5, warm_start=True)
+        model.fit(self.X)
+        graph, tree = model.graph_, model._full_tree
+
+        for params in [dict(prune_threshold=30),
+                       dict(method='upper-level-set',
+                            method_params={'threshold': 0.5, 'form': 'mass'})]:
+            model.set_params(**params)
+            labels = model.fit_predict(self.X)
+            self.assertIs(model.graph_, graph)
+            self.assertIs(model._full_tree, tree)
+
+            cold = dcl.DeBaClClustering(**model.get_params())
+            cold.set_params(warm_start=False)
+            assert_array_equal(cold.fit_predict(self.X), labels)
+
+        ## New levels rebuild the tree, but not the graph.
+        model.set_params(num_levels=50).fit(self.X)
+        self.assertIs(model.graph_, graph)
+        self.assertIsNot(model._full_tree, tree)
+        self.assertLessEqual(len(model.tree_.levels), 50)
+
+        ## New data or neighbor parameters start over.
+        model.fit(self.X[:200])
+        self.assertIsNot(model.graph_, graph)
+        self.assertEqual(len(model.labels_), 200)
@@ -4,10 +4,12 @@ from __future__ import absolute_import as _absolute_import
 
 import os
 import unittest
+import threading
 import tempfile
 import numpy as np
+import scipy.sparse as sps
 import debacl as dcl
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 
 class TestLSTConstructors(unittest.TestCase):
@@ -197,6 +199,460 @@ class TestLSTConstructors(unittest.TestCase):
         self._check_tree_viability(tree2)
         self._check_tree_correctness(tree)
 
+    def test_construct_from_spanning_forest(self):
+        """
+        Check that a density-weighted spanning forest of the similarity graph
+        yields the same LST as the full graph.
+        """
+        forest = dcl.utils.density_spanning_forest(self.knn_graph,
+                                                   self.density)
+        tree = dcl.construct_tree_from_graph(forest, self.density,
+                                             prune_threshold=self.gamma)
+
+        self._check_tree_viability(tree)
+        self._check_tree_correctness(tree)
+
+    def test_resume(self):
+        """
+        Check that a tree construction interrupted after a checkpoint and
+        resumed from it yields the same tree as an uninterrupted construction.
+        """
+        save_checkpoint = dcl.level_set_tree._save_checkpoint
+
+        def interrupt(T, filename, start, *args):
+            if start == 600:
+                save_checkpoint(T, filename, start, *args)
+                raise KeyboardInterrupt
+
+        weights = np.random.randint(1, 4, size=self.n)
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, 'checkpoint')
+
+        for w, gamma in [(None, self.gamma), (weights, None)]:
+            ans = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                                prune_threshold=gamma,
+                                                weights=w)
+
+            dcl.level_set_tree._save_checkpoint = interrupt
+            try:
+                with self.assertRaises(KeyboardInterrupt):
+                    dcl.construct_tree_from_graph(
+                        self.knn_graph, self.density, prune_threshold=gamma,
+                        weights=w, checkpoint=filename, checkpoint_interval=0)
+            finally:
+                dcl.level_set_tree._save_checkpoint = save_checkpoint
+
+            ## A different graph is rejected.
+            other_graph = [neighbors[:10] for neighbors in self.knn_graph]
+            for graph in [self.knn_graph[:-1], other_graph]:
+                with self.assertRaises(ValueError):
+                    dcl.resume_tree(filename, graph)
+
+            tree = dcl.resume_tree(filename, self.knn_graph)
+
+            self.assertEqual(tree.prune_threshold, ans.prune_threshold)
+            self.assertEqual(sorted(tree.nodes.keys()),
+                             sorted(ans.nodes.keys()))
+
+            for ix, node in ans.nodes.items():
+                self.assertEqual(tree.nodes[ix].members, node.members)
+                self.assertEqual(tree.nodes[ix].children, node.children)
+                self.assertEqual(tree.nodes[ix].parent, node.parent)
+                self.assertEqual(tree.nodes[ix].end_level, node.end_level)
+                self.assertEqual(tree.nodes[ix].end_mass, node.end_mass)
+
+        os.remove(filename)
+        os.rmdir(directory)
+
+    def test_time_budget(self):
+        """
+        Check that trees built with a time budget are refined up to the
+        requested resolution, and that construction can be cancelled.
+        """
+        ans = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                            prune_threshold=self.gamma)
+        self.assertTrue(ans.build_info['complete'])
+
+        ## With no time, only the coarsest tree is built.
+        tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                             prune_threshold=self.gamma,
+                                             time_budget=0)
+        self.assertEqual(tree.build_info['num_levels'], 16)
+        self.assertEqual(tree.build_info['target_levels'], self.n)
+        self.assertFalse(tree.build_info['complete'])
+        self.assertLessEqual(len(tree.levels), 16)
+
+        ## With enough time, the tree is the same as the full tree.
+        tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                             prune_threshold=self.gamma,
+                                             time_budget=1e6)
+        self.assertTrue(tree.build_info['complete'])
+        self._check_tree_viability(tree)
+        self._check_tree_correctness(tree)
+        self.assertEqual(sorted(tree.nodes.keys()), sorted(ans.nodes.keys()))
+
+        ## Cancel after the coarsest tree, or before any tree is finished.
+        calls = []
+
+        def cancel():
+            calls.append(1)
+            return len(calls) > 20
+
+        tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                             cancel=cancel)
+        self.assertEqual(tree.build_info['num_levels'], 16)
+
+        tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                             cancel=lambda: True)
+        self.assertIsNone(tree)
+
+    def test_memory_limit(self):
+        """
+        Check that construction fails before the neighbor search if the
+        estimated memory exceeds the limit.
+        """
+        with self.assertRaises(MemoryError):
+            dcl.construct_tree(self.dataset, self.k, memory_limit=2**16)
+
+        tree = dcl.construct_tree(self.dataset, self.k,
+                                  prune_threshold=self.gamma,
+                                  memory_limit=2**30)
+        self._check_tree_correctness(tree)
+
+    def test_construct_weighted(self):
+        """
+        Check that duplicate rows are collapsed and weighted, so that doubling
+        every row of the dataset yields the same tree with twice the node
+        sizes.
+        """
+        tree = dcl.construct_tree(np.repeat(self.dataset, 2, axis=0), self.k,
+                                  prune_threshold=2 * self.gamma)
+
+        self.assertEqual(len(tree.density), 2 * self.n)
+        self.assertTrue(np.all(np.isfinite(tree.density)))
+
+        summary = lambda t, c: sorted((round(v.start_level, 9),
+                                       round(v.end_level, 9), v.start_mass,
+                                       v.end_mass, len(v.members) // c)
+                                      for v in t.nodes.values())
+
+        ans_tree = dcl.construct_tree(self.dataset, self.k,
+                                      prune_threshold=self.gamma)
+        self.assertEqual(summary(tree, 2), summary(ans_tree, 1))
+
+        ## Duplicates of a point share its cluster label.
+        labels = tree.get_clusters(method='leaf', fill_background=True)
+        assert_array_equal(labels[::2, 1], labels[1::2, 1])
+
+        ## Explicit weights give the same tree on the unique rows.
+        weighted_tree = dcl.construct_tree(self.dataset, self.k,
+                                           prune_threshold=2 * self.gamma,
+                                           weights=2 * np.ones(self.n))
+        self.assertEqual(
+            [(v.start_mass, v.end_mass) for v in weighted_tree.nodes.values()],
+            [(v.start_mass, v.end_mass) for v in ans_tree.nodes.values()])
+
+    def test_construct_landmarks(self):
+        """
+        Check the landmark density stage: with every observation as a
+        landmark it matches the exact kNN density, and with a subsample of
+        landmarks the tree still finds the three modes.
+        """
+        tree = dcl.construct_tree(self.dataset, self.k,
+                                  prune_threshold=self.gamma,
+                                  landmarks=self.dataset)
+        ans_tree = dcl.construct_tree(self.dataset, self.k,
+                                      prune_threshold=self.gamma)
+
+        self._check_tree_viability(tree)
+        assert_array_almost_equal(tree.density, ans_tree.density)
+
+        np.random.seed(0)
+        tree = dcl.construct_tree(self.dataset, self.k, prune_threshold=50,
+                                  landmarks=500)
+        self.assertEqual(len(tree.density), self.n)
+        self.assertEqual(len(tree.get_leaf_nodes()), 3)
+
+    def test_construct_low_precision(self):
+        """
+        Check that single precision neighbor search gives the same tree.
+        """
+        tree = dcl.construct_tree(self.dataset, self.k,
+                                  prune_threshold=self.gamma,
+                                  dtype=np.float32)
+        ans_tree = dcl.construct_tree(self.dataset, self.k,
+                                      prune_threshold=self.gamma)
+
+        summary = lambda t: sorted((round(v.start_level, 9),
+                                    round(v.end_level, 9), v.start_mass,
+                                    v.end_mass, len(v.members))
+                                   for v in t.nodes.values())
+        self.assertEqual(summary(tree), summary(ans_tree))
+
+    def test_construct_sparse(self):
+        """
+        Check that a sparse copy of the dataset gives the same tree, and that
+        the cosine metric is accepted.
+        """
+        X = sps.csr_matrix(np.repeat(self.dataset, 2, axis=0))
+        tree = dcl.construct_tree(X, self.k, prune_threshold=2 * self.gamma)
+        ans_tree = dcl.construct_tree(X.toarray(), self.k,
+                                      prune_threshold=2 * self.gamma)
+
+        summary = lambda t: sorted((round(v.start_level, 9),
+                                    round(v.end_level, 9), v.start_mass,
+                                    v.end_mass, len(v.members))
+                                   for v in t.nodes.values())
+        self.assertEqual(summary(tree), summary(ans_tree))
+
+        X = np.hstack((self.dataset, np.ones((self.n, 1))))
+        tree = dcl.construct_tree(X, self.k, prune_threshold=self.gamma,
+                                  metric='cosine')
+        self.assertEqual(len(tree.density), self.n)
+
+    def test_construct_precomputed(self):
+        """
+        Check that square and condensed distance matrices give the same tree
+        as the dataset, and that duplicate points are accepted.
+        """
+        D = np.abs(self.dataset - self.dataset.T)
+        upper = np.triu_indices(self.n, 1)
+
+        for distances in [D, D[upper]]:
+            tree = dcl.construct_tree(distances, self.k,
+                                      prune_threshold=self.gamma,
+                                      metric='precomputed')
+            self._check_tree_correctness(tree)
+
+        X = np.vstack((self.dataset, self.dataset[:3]))
+        D = np.abs(X - X.T)
+        tree = dcl.construct_tree(D, self.k, metric='precomputed')
+        self.assertEqual(len(tree.density), self.n + 3)
+        self.assertTrue(np.all(np.isfinite(tree.density)))
+
+        ## Weighted distances give the same tree as weighted points.
+        weights = np.random.randint(1, 4, size=self.n)
+        D = np.abs(self.dataset - self.dataset.T)
+        ans = dcl.construct_tree(self.dataset, self.k, weights=weights,
+                                 prune_threshold=self.gamma)
+        tree = dcl.construct_tree(D, self.k, weights=weights,
+                                  prune_threshold=self.gamma,
+                                  metric='precomputed')
+        np.testing.assert_allclose(tree.density, ans.density)
+        self.assertEqual(sorted(tree.nodes.keys()), sorted(ans.nodes.keys()))
+
+        for ix, node in ans.nodes.items():
+            self.assertEqual(tree.nodes[ix].members, node.members)
+            self.assertEqual(tree.nodes[ix].end_mass, node.end_mass)
+
+        ## Rows of distances aren't points, so landmarks aren't supported.
+        for landmarks in [10, self.dataset[:10]]:
+            with self.assertRaises(ValueError):
+                dcl.construct_tree(D, self.k, metric='precomputed',
+                                   landmarks=landmarks)
+
+    def test_construct_reduced(self):
+        """
+        Check that projecting the data before the neighbor search, with exact
+        refinement, gives the same tree as the full neighbor search.
+        """
+        np.random.seed(19)
+        X = np.hstack((self.dataset, 1e-5 * np.random.randn(self.n, 30)))
+        ans_tree = dcl.construct_tree(X, self.k, prune_threshold=self.gamma)
+
+        summary = lambda t: sorted((v.start_mass, v.end_mass, len(v.members))
+                                   for v in t.nodes.values())
+
+        tree = dcl.construct_tree(X, self.k, prune_threshold=self.gamma,
+                                  num_components=5, reduction='pca',
+                                  random_state=19)
+        self.assertEqual(summary(tree), summary(ans_tree))
+        np.testing.assert_allclose(tree.density, ans_tree.density)
+
+        tree = dcl.construct_tree(X, self.k, prune_threshold=self.gamma,
+                                  num_components=10, refine=False,
+                                  random_state=19)
+        self.assertEqual(len(tree.density), self.n)
+
+    def test_construct_binned(self):
+        """
+        Check viability of an LST constructed from binned data, and that it
+        finds the three modes of the simulated dataset.
+        """
+        gamma = 50
+        full_tree = dcl.construct_tree_binned(self.dataset, bin_width=0.1)
+        tree = full_tree.prune(gamma)
+
+        self.assertTrue(isinstance(tree, dcl.level_set_tree.LevelSetTree))
+        self.assertEqual(len(tree.density), self.n)
+        self.assertEqual(len(tree.get_leaf_nodes()), 3)
+
+        root_sizes = [len(node.members) for node in full_tree.nodes.values()
+                      if node.parent is None]
+        self.assertEqual(sum(root_sizes), self.n)
+
+        end_masses = [node.end_mass for node in tree.nodes.values()]
+        self.assertAlmostEqual(max(end_masses), 1.)
+
+        for node in tree.nodes.values():
+            self.assertLessEqual(gamma, len(node.members))
+            self.assertLess(node.start_mass, node.end_mass)
+
+            for child in node.children:
+                self.assertTrue(tree.nodes[child].members.issubset(
+                    node.members))
+
+    def test_construct_sampled(self):
+        """
+        Check that a tree built on a subsample extends to every observation,
+        and that sampling every observation gives the full tree.
+        """
+        tree, agreement = dcl.construct_tree_sampled(
+            self.dataset, self.k, sample_size=self.n,
+            prune_threshold=self.gamma, validation_size=self.n,
+            random_state=19)
+        ans_tree = dcl.construct_tree(self.dataset, self.k,
+                                      prune_threshold=self.gamma)
+
+        summary = lambda t: sorted((v.start_level, v.end_level, v.start_mass,
+                                    v.end_mass, len(v.members))
+                                   for v in t.nodes.values())
+        self.assertEqual(summary(tree), summary(ans_tree))
+        self.assertAlmostEqual(agreement, 1.)
+
+        ## Extend from a subsample, drawn uniformly or by density strata.
+        for stratify in [None, 'density']:
+            tree, agreement = dcl.construct_tree_sampled(
+                self.dataset, k=20, sample_size=300, prune_threshold=50,
+                stratify=stratify, random_state=19)
+
+            self.assertIsNone(agreement)
+            self.assertEqual(len(tree.density), self.n)
+            self.assertEqual(len(tree.get_leaf_nodes()), 3)
+
+            root_sizes = [len(node.members) for node in tree.nodes.values()
+                          if node.parent is None]
+            self.assertEqual(sum(root_sizes), self.n)
+
+            for node in tree.nodes.values():
+                self.assertLess(node.start_mass, node.end_mass)
+
+                for child in node.children:
+                    self.assertTrue(tree.nodes[child].members.issubset(
+                        node.members))
+
+    def test_coarsen(self):
+        """
+        Check that coarsening a full-resolution tree gives the same tree as
+        building directly on the coarse grid.
+        """
+        num_levels = 40
+        fine_tree = dcl.construct_tree_from_graph(self.knn_graph, self.density)
+        coarse_tree = fine_tree.coarsen(num_levels=num_levels)
+        ans_tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                                 num_levels=num_levels)
+
+        self.assertLessEqual(coarse_tree.num_levels, num_levels)
+        self._check_tree_viability(coarse_tree.prune(self.gamma))
+
+        summary = lambda t: sorted((v.start_level, v.end_level, v.start_mass,
+                                    v.end_mass, len(v.members))
+                                   for v in t.nodes.values())
+        self.assertEqual(summary(coarse_tree), summary(ans_tree))
+        self.assertEqual(summary(coarse_tree.prune(self.gamma)),
+                         summary(ans_tree.prune(self.gamma)))
+
+        ## Weighted trees keep their weights, masses, and weighted pruning.
+        weights = np.random.randint(1, 4, size=self.n)
+        fine_tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                                  prune_threshold=self.gamma,
+                                                  weights=weights)
+        coarse_tree = fine_tree.coarsen(num_levels=num_levels)
+        ans_tree = dcl.construct_tree_from_graph(self.knn_graph, self.density,
+                                                 prune_threshold=self.gamma,
+                                                 num_levels=num_levels,
+                                                 weights=weights)
+
+        assert_array_equal(coarse_tree.weights, fine_tree.weights)
+        self.assertEqual(coarse_tree.build_info, fine_tree.build_info)
+        self.assertEqual(summary(coarse_tree), summary(ans_tree))
+
+
+class TestLatticeConstructor(unittest.TestCase):
+    """
+    Test that the lattice constructor matches the similarity graph
+    constructor, on a graph with the same neighbors.
+    """
+
+    def setUp(self):
+        """
+        Create a noisy 2D density raster with three modes.
+        """
+        np.random.seed(451)
+        x, y = np.mgrid[-2:2:0.2, -2:2:0.2]
+        self.density = (np.exp(-4 * ((x - 1)**2 + y**2)) +
+                        np.exp(-4 * ((x + 1)**2 + (y - 1)**2)) +
+                        0.5 * np.exp(-4 * ((x + 1)**2 + (y + 1)**2)) +
+                        0.05 * np.random.rand(*x.shape))
+
+    def _lattice_graph(self, shape, offsets):
+        """
+        Build an explicit adjacency list for a 2D lattice.
+        """
+        index = np.arange(np.prod(shape)).reshape(shape)
+        adjacency_list = []
+
+        for i, j in zip(*np.unravel_index(index.ravel(), shape)):
+            neighbors = [index[i + a, j + b] for a, b in offsets
+                         if 0 <= i + a < shape[0] and 0 <= j + b < shape[1]]
+            adjacency_list.append(neighbors)
+
+        return adjacency_list
+
+    def test_construct_from_lattice(self):
+        """
+        Check 4- and 8-neighbor lattice trees against the graph constructor.
+        """
+        stencils = {1: [(-1, 0), (1, 0), (0, -1), (0, 1)],
+                    2: [(a, b) for a in (-1, 0, 1) for b in (-1, 0, 1)
+                        if (a, b) != (0, 0)]}
+
+        summary = lambda t: sorted((v.start_level, v.end_level, v.start_mass,
+                                    v.end_mass, sorted(v.members))
+                                   for v in t.nodes.values())
+
+        for connectivity, offsets in stencils.items():
+            tree = dcl.construct_tree_from_lattice(
+                self.density, connectivity=connectivity, prune_threshold=3)
+
+            graph = self._lattice_graph(self.density.shape, offsets)
+            ans_tree = dcl.construct_tree_from_graph(
+                graph, self.density.ravel(), prune_threshold=3)
+
+            self.assertGreater(len(tree.get_leaf_nodes()), 1)
+            self.assertEqual(summary(tree), summary(ans_tree))
+
+        ## Tied density values on a 3D lattice, with the neighbors from the
+        #  histogram cell graph.
+        density = np.round(np.random.rand(6, 5, 4), 1)
+        cells = np.indices(density.shape).reshape((3, -1)).T
+
+        for connectivity in [1, 2, 3]:
+            tree = dcl.construct_tree_from_lattice(
+                density, connectivity=connectivity, num_levels=8)
+            graph = dcl.utils.cell_graph(cells, connectivity)
+            ans_tree = dcl.construct_tree_from_graph(
+                graph, density.ravel(), num_levels=8)
+
+            self.assertEqual(summary(tree), summary(ans_tree))
+
+        ## Bogus input
+        with self.assertRaises(ValueError):
+            dcl.construct_tree_from_lattice(self.density, connectivity=3)
+
+        with self.assertRaises(TypeError):
+            dcl.construct_tree_from_lattice(self.density.tolist())
+
 
 class TestBackwardCompatibility(unittest.TestCase):
     """
@@ -490,6 +946,180 @@ class TestLevelSetTree(unittest.TestCase):
         assert_array_equal(leaf_labels[:, 1],
                            full_labels[leaf_labels[:, 0], 1])
 
+    def test_cluster_cache(self):
+        """
+        Test that cached cluster labels match the labels computed from
+        scratch, and that the cache is bounded and not shared with pruned or
+        copied trees.
+        """
+        queries = [dict(method='leaf'),
+                   dict(method='leaf', fill_background=True),
+                   dict(method='first-k', k=3),
+                   dict(method='k-level', k=2),
+                   dict(method='upper-level-set', threshold=0.6, form='mass')]
+
+        for query in queries:
+            fill_background = query.pop('fill_background', False)
+            method = query.pop('method')
+            ans = self.tree._cluster_labels(method, fill_background, **query)
+
+            for _ in range(2):
+                labels = self.tree.get_clusters(method, fill_background,
+                                                **query)
+                assert_array_equal(labels, ans)
+                labels[:, 1] = -2  # callers' changes don't affect the cache
+
+        ## Upper level set labels match the members of the active nodes.
+        for threshold in np.linspace(0., 1., 11):
+            labels = self.tree.get_clusters('upper-level-set',
+                                            threshold=threshold, form='mass')
+            level = self.tree._mass_to_density(threshold)
+            self.assertTrue((self.tree.density[labels[:, 0]] > level).all())
+
+            for point, node in labels:
+                self.assertTrue(point in self.tree.nodes[node].members)
+
+        self.assertLessEqual(len(self.tree._cache), self.tree._cache_size)
+
+        pruned_tree = self.tree.prune(threshold=50)
+        self.assertIsNone(pruned_tree._cache)
+        self.assertItemsEqual(
+            np.unique(pruned_tree.get_clusters()[:, 1]),
+            pruned_tree.get_leaf_nodes())
+
+        with tempfile.NamedTemporaryFile() as f:
+            self.tree.save(f.name)
+            self.assertIsNone(dcl.load_tree(f.name)._cache)
+
+    def test_cluster_cache_threads(self):
+        """
+        Test that concurrent queries on one tree, which evict each other's
+        cache entries, return the same labels as serial queries.
+        """
+        tree = self.tree
+        tree._cache_size = 4
+        thresholds = np.linspace(0.05, 0.95, 16)
+        ans = [tree._cluster_labels('upper-level-set', False,
+                                    threshold=t, form='mass')
+               for t in thresholds]
+        errors = []
+
+        def query():
+            try:
+                for _ in range(5):
+                    for t, labels in zip(thresholds, ans):
+                        assert_array_equal(
+                            tree.get_clusters('upper-level-set',
+                                              threshold=t, form='mass'),
+                            labels)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=query) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(tree._cache), tree._cache_size)
+        self.assertFalse('_cache_lock' in tree.__getstate__())
+
+    def test_plot_layout(self):
+        """
+        Test the dendrogram layout: leaves are spread across the canvas,
+        parents are centered over their children, subtrees are contiguous in
+        depth-first order, and deep trees don't hit the recursion limit.
+        """
+        for form, spacing in [('mass', 'uniform'), ('density', 'uniform'),
+                              ('branch-mass', 'proportional')]:
+            layout = self.tree._plot_layout(form, spacing)
+            self.assertIs(layout, self.tree._plot_layout(form, spacing))
+
+            ids, parent, x = layout['ids'], layout['parent'], layout['x']
+            index = {ix: i for i, ix in enumerate(ids)}
+            self.assertTrue(((x > 0) & (x < 1)).all())
+
+            for ix, node in self.tree.nodes.items():
+                i = index[ix]
+                self.assertEqual(layout['size'][i], len(node.members))
+                self.assertEqual(layout['num_descendants'][i],
+                                 len(self.tree._make_subtree(ix).nodes))
+
+                if len(node.children) > 0:
+                    children = [index[c] for c in node.children]
+                    self.assertAlmostEqual(x[i], np.mean(x[children]))
+                    self.assertTrue(all(parent[c] == i for c in children))
+
+                    preorder = layout['preorder']
+                    self.assertTrue((preorder[children] > preorder[i]).all())
+
+                if form == 'mass':
+                    self.assertEqual(layout['bottom'][i], node.start_mass)
+                    self.assertEqual(layout['top'][i], node.end_mass)
+
+            if form == 'branch-mass':
+                self.assertAlmostEqual(
+                    (layout['top'] - layout['bottom']).sum(),
+                    sum(len(v.members) for v in self.tree.nodes.values()
+                        if v.parent is None) / float(self.n))
+
+            self.assertItemsEqual(layout['preorder'], range(len(ids)))
+
+        ## A chain of nodes deeper than the recursion limit.
+        depth = 1500
+        tree = dcl.level_set_tree.LevelSetTree(
+            density=np.linspace(1., 2., depth),
+            levels=np.linspace(0., 2., depth))
+        for i in range(depth):
+            tree.nodes[i] = dcl.level_set_tree.ConnectedComponent(
+                i, None if i == 0 else i - 1,
+                [] if i == depth - 1 else [i + 1], i, i + 1.,
+                i / float(depth), (i + 1.) / depth, set(range(i, depth)))
+
+        layout = tree._plot_layout('mass', 'uniform')
+        assert_array_equal(layout['x'], 0.5)
+        assert_array_equal(layout['preorder'], np.arange(depth))
+        assert_array_equal(layout['size'], np.arange(depth, 0, -1))
+
+    def test_detail_view(self):
+        """
+        Test that the level-of-detail view draws each visible subtree exactly
+        once, either as segments or as a single glyph.
+        """
+        detail_view = dcl.level_set_tree._detail_view
+        layout = self.tree._plot_layout('mass', 'uniform')
+        parent = layout['parent']
+        is_root = parent < 0
+        self.assertTrue(np.all(layout['low'] <= layout['x']))
+        self.assertTrue(np.all(layout['x'] <= layout['high']))
+        self.assertTrue(np.all(layout['subtree_top'] >= layout['top']))
+
+        ## Fully zoomed in, every node is a segment.
+        drawn, collapsed = detail_view(layout, (0., 1.), 1e9, 2., 0.)
+        self.assertTrue(drawn.all())
+        self.assertFalse(collapsed.any())
+
+        ## Fully zoomed out, each tree is a single glyph.
+        drawn, collapsed = detail_view(layout, (0., 1.), 1e-9, 2., 0.)
+        self.assertFalse(drawn.any())
+        assert_array_equal(collapsed, is_root)
+
+        ## Small subtrees are collapsed into glyphs below drawn nodes.
+        drawn, collapsed = detail_view(layout, (0., 1.), 1e9, 2., 0.1)
+        self.assertTrue(collapsed.any())
+        self.assertFalse((drawn & collapsed).any())
+        self.assertTrue(np.all(drawn[parent[collapsed & ~is_root]]))
+        self.assertTrue(np.all(layout['size'][collapsed] <
+                               0.1 * layout['size'][is_root].sum()))
+
+        ## Nodes outside the view are skipped.
+        xlim = (0., 0.3)
+        drawn, collapsed = detail_view(layout, xlim, 1e9, 2., 0.)
+        visible = (layout['high'] >= xlim[0]) & (layout['low'] <= xlim[1])
+        self.assertFalse(visible.all())
+        assert_array_equal(drawn, visible)
+
     def test_leaf_node_getter(self):
         """
         Test that the nodes returned by the leaf node getter are actually
@@ -0,0 +1,281 @@
+
+from __future__ import print_function as _print_function
+from __future__ import absolute_import as _absolute_import
+
+import os
+import io
+import json
+import pickle
+import shutil
+import socket
+import tempfile
+import unittest
+import threading
+import numpy as np
+import concurrent.futures as futures
+from numpy.testing import assert_array_equal
+
+import debacl as dcl
+
+
+class TestServing(unittest.TestCase):
+    """
+    Unit test class for background tree construction and the tree holder.
+    """
+
+    def setUp(self):
+        np.random.seed(451)
+        self.X = np.random.rand(200, 2)
+        self.tree = dcl.construct_tree(self.X, k=10, prune_threshold=5)
+
+    def test_build_async(self):
+        """
+        Test that trees built in another process match trees built directly.
+        """
+        future = dcl.build_async(self.X, k=10, prune_threshold=5)
+        tree = future.result()
+
+        assert_array_equal(tree.density, self.tree.density)
+        self.assertEqual(sorted(tree.nodes.keys()),
+                         sorted(self.tree.nodes.keys()))
+
+        for idx, node in self.tree.nodes.items():
+            self.assertEqual(tree.nodes[idx].members, node.members)
+
+    def test_holder(self):
+        """
+        Test that the holder swaps in finished builds, in the order they were
+        registered, and keeps its tree when a build fails.
+        """
+        holder = dcl.TreeHolder()
+        self.assertEqual(holder.version, 0)
+
+        with self.assertRaises(ValueError):
+            holder.get_clusters()
+
+        old = futures.Future()
+        new = futures.Future()
+        holder.update(old)
+        holder.update(new)
+
+        ## The newer build finishes first; the older one is discarded.
+        new.set_result(self.tree)
+        self.assertIs(holder.tree, self.tree)
+        old.set_result(self.tree.prune(50))
+        self.assertIs(holder.tree, self.tree)
+        self.assertEqual(holder.version, 1)
+
+        assert_array_equal(holder.get_clusters(method='leaf'),
+                           self.tree.get_clusters(method='leaf'))
+
+        failed = futures.Future()
+        swapped = holder.update(failed)
+        failed.set_exception(ValueError("bad input"))
+        self.assertIs(holder.tree, self.tree)
+        self.assertTrue(isinstance(holder.error, ValueError))
+        self.assertIs(swapped.exception(), holder.error)
+
+        ## A stale failure doesn't overwrite the state of a newer success.
+        stale = futures.Future()
+        fresh = futures.Future()
+        holder.update(stale)
+        holder.update(fresh)
+        fresh.set_result(self.tree)
+        stale.set_exception(ValueError("stale"))
+        self.assertIsNone(holder.error)
+        self.assertEqual(holder.version, 2)
+
+        ## A manual swap overrides pending builds.
+        pending = futures.Future()
+        holder.update(pending)
+        pruned = self.tree.prune(50)
+        self.assertIs(holder.swap(pruned), self.tree)
+        pending.set_result(self.tree)
+        self.assertIs(holder.tree, pruned)
+
+        ## Builds in a thread pool.
+        executor = futures.ThreadPoolExecutor(max_workers=1)
+        tree = holder.rebuild(self.X, k=10, prune_threshold=5,
+                              executor=executor).result()
+        executor.shutdown()
+        self.assertIs(holder.tree, tree)
+        self.assertEqual(holder.version, 4)
+        self.assertIsNone(holder.error)
+
+        ## The returned future is done only after the swap, even if the
+        #  build's own waiters wake up first.
+        for _ in range(20):
+            build = futures.Future()
+            swapped = holder.update(build)
+            tree = self.tree.prune(50)
+            threading.Timer(0.001, build.set_result, [tree]).start()
+            self.assertIs(swapped.result(), tree)
+            self.assertIs(holder.tree, tree)
+
+    def test_publish_attach(self):
+        """
+        Test that an attached tree has the same nodes and clusters as the
+        published tree, backed by memory-mapped arrays.
+        """
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'tree')
+
+        weights = np.random.randint(1, 4, size=len(self.X))
+
+        for w in [None, weights]:
+            tree = dcl.construct_tree(self.X, k=10, prune_threshold=5,
+                                      weights=w)
+            dcl.publish_tree(tree, path)
+            shared = dcl.attach_tree(path)
+
+            self.assertTrue(isinstance(shared.density, np.memmap))
+            assert_array_equal(shared.density, tree.density)
+            assert_array_equal(shared.levels, tree.levels)
+            self.assertEqual(shared.prune_threshold, 5)
+
+            for idx, node in tree.nodes.items():
+                shared_node = shared.nodes[idx]
+                self.assertEqual(shared_node.members, node.members)
+                self.assertEqual(len(shared_node.members), len(node.members))
+                self.assertEqual(shared_node.parent, node.parent)
+                self.assertEqual(shared_node.children, node.children)
+                self.assertEqual(shared_node.end_mass, node.end_mass)
+
+            self.assertFalse(-1 in shared.nodes[0].members)
+            self.assertFalse(len(self.X) in shared.nodes[0].members)
+
+            ## Labels are the same up to the order of the rows.
+            for kwargs in [dict(method='leaf', fill_background=True),
+                           dict(method='first-k', k=2),
+                           dict(method='upper-level-set', threshold=0.5,
+                                form='mass')]:
+                labels = shared.get_clusters(**kwargs)
+                ans = tree.get_clusters(**kwargs)
+                self.assertEqual(sorted(map(tuple, labels)),
+                                 sorted(map(tuple, ans)))
+
+            ## Derived trees and pickles hold regular sets.
+            pruned = shared.prune(50)
+            self.assertTrue(isinstance(pruned.nodes[0].members, set))
+
+            loaded = pickle.loads(pickle.dumps(shared, 2))
+            self.assertTrue(isinstance(loaded.nodes[0].members, set))
+            self.assertEqual(loaded.nodes[0].members, tree.nodes[0].members)
+
+            shutil.rmtree(path)
+
+        os.rmdir(directory)
+
+    def test_assigner(self):
+        """
+        Test that the tree's own points are assigned to their clusters, and
+        that requests are answered in batches.
+        """
+        assigner = dcl.TreeAssigner(self.tree, self.X, k=10)
+        labels = self.tree.get_clusters(fill_background=True)
+        assert_array_equal(assigner(self.X), labels[:, 1])
+
+        ## A point held out of the neighbor search gets the same density as
+        #  in the tree.
+        held_out = dcl.TreeAssigner(self.tree, self.X[1:], k=10)
+        _, density = held_out._estimate(self.X[:1])
+        self.assertAlmostEqual(density[0], self.tree.density[0])
+
+        batch_sizes = []
+
+        def function(points):
+            batch_sizes.append(len(points))
+            return assigner(points)
+
+        with dcl.MicroBatcher(function, max_batch_size=50,
+                              max_latency=1.) as batcher:
+            futures_ = [batcher.submit(x) for x in self.X]
+            results = [f.result() for f in futures_]
+
+        assert_array_equal(results, labels[:, 1])
+        self.assertEqual(batch_sizes, [50] * 4)
+
+        ## A bad request fails without failing the rest of its batch.
+        with dcl.MicroBatcher(assigner, max_batch_size=3,
+                              max_latency=1.) as batcher:
+            good = batcher.submit(self.X[0])
+            bad = batcher.submit(np.zeros(3))
+            other = batcher.submit(self.X[1])
+
+            with self.assertRaises(ValueError):
+                bad.result()
+
+            self.assertEqual(good.result(), labels[0, 1])
+            self.assertEqual(other.result(), labels[1, 1])
+
+        ## A function with the wrong number of results fails the whole batch.
+        with dcl.MicroBatcher(lambda points: points[1:], max_batch_size=2,
+                              max_latency=1.) as batcher:
+            futures_ = [batcher.submit(x) for x in self.X[:2]]
+
+            for f in futures_:
+                with self.assertRaises(ValueError):
+                    f.result(timeout=5)
+
+        ## A closed batcher takes no new requests.
+        with self.assertRaises(RuntimeError):
+            batcher.submit(self.X[0])
+
+        batcher.close()
+
+    def test_serve(self):
+        """
+        Test the stream and socket servers, and the load generator.
+        """
+        assigner = dcl.TreeAssigner(self.tree, self.X, k=10)
+        queries = np.random.rand(20, 2)
+        ans = assigner(queries).tolist()
+
+        requests = u''.join(u'[{}, {}]\n'.format(*x) for x in queries)
+        output = io.BytesIO()
+
+        with dcl.MicroBatcher(assigner) as batcher:
+            dcl.serve_stream(batcher, io.StringIO(requests), output)
+
+            directory = tempfile.mkdtemp()
+            address = os.path.join(directory, 'socket')
+            server = dcl.socket_server(batcher, address)
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            client = socket.socket(socket.AF_UNIX)
+            client.connect(address)
+            client.sendall(requests.encode('utf-8'))
+            stream = client.makefile('r')
+            answers = [int(stream.readline()) for _ in ans]
+            stream.close()
+            client.close()
+
+            server.shutdown()
+            server.server_close()
+            thread.join()
+            shutil.rmtree(directory)
+
+        self.assertEqual([int(x) for x in output.getvalue().split()], ans)
+        self.assertEqual(answers, ans)
+
+        ## Bad lines are answered with errors, in order.
+        requests = u'[0.5, 0.5]\n[0.5, oops\n[1, 2, 3]\n[0.5, 0.5]\n'
+        output = io.BytesIO()
+
+        with dcl.MicroBatcher(assigner, max_latency=0.1) as batcher:
+            dcl.serve_stream(batcher, io.StringIO(requests), output)
+
+        lines = [json.loads(x) for x in output.getvalue().splitlines()]
+        self.assertEqual(len(lines), 4)
+        self.assertTrue('error' in lines[1] and 'error' in lines[2])
+        self.assertEqual(lines[0], assigner([0.5, 0.5])[0])
+        self.assertEqual(lines[3], lines[0])
+
+        results = dcl.benchmark(assigner, np.random.rand(200, 2),
+                                batch_sizes=[1, 16], num_clients=4)
+        self.assertEqual([r['batch_size'] for r in results], [1, 16])
+
+        for r in results:
+            self.assertLessEqual(r['p50'], r['p99'])
+            self.assertGreater(r['throughput'], 0)
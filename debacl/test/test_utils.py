@@ -2,10 +2,14 @@
 from __future__ import print_function as _print_function
 from __future__ import absolute_import as _absolute_import
 
+import os
+import tempfile
 import unittest
 import scipy.special as spspec
+import scipy.sparse as sps
+import scipy.spatial.distance as spd
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import assert_array_equal, assert_array_almost_equal
 
 import debacl.utils as utl
 
@@ -36,11 +40,46 @@ class TestDensityEstimates(unittest.TestCase):
         fhat = utl.knn_density(r_k, n, p, k)
         self.assertEqual(fhat, answer)
 
+        ## Weighted neighbors scale the estimate.
+        fhat = utl.knn_density(np.array([1., 1.]), n, p, np.array([k, 2 * k]))
+        assert_array_equal(fhat, np.array([answer[0], 2 * answer[0]]))
+
         ## Check that undefined density estimates raise an error.
         with self.assertRaises(ArithmeticError):
             r_k = np.array([10., 10.])
             fhat = utl.knn_density(r_k, n=1000, p=350, k=10)
 
+        ## Unit ball volumes for other metrics, in two dimensions.
+        r_k = np.array([1.])
+        volumes = [('manhattan', None, 2.),
+                   ('chebyshev', None, 4.),
+                   ('minkowski', {'p': 2}, np.pi),
+                   ('mahalanobis', {'VI': np.diag([4., 1.])}, np.pi / 2),
+                   ('haversine', None, 2 * np.pi * (1 - np.cos(1.)))]
+
+        for metric, params, volume in volumes:
+            fhat = utl.knn_density(r_k, n=1, p=2, k=1, metric=metric,
+                                   metric_params=params)
+            self.assertAlmostEqual(fhat[0], 1. / volume)
+
+    def test_landmark_density(self):
+        """
+        Test that using every point as a landmark gives the exact kNN density,
+        and that landmark weights scale the neighbor counts.
+        """
+        np.random.seed(19)
+        X = np.random.rand(100, 2)
+        k = 5
+
+        knn, radii = utl.knn_graph(X, k, method='brute_force')
+        ans_density = utl.knn_density(radii, n=100, p=2, k=k)
+
+        density = utl.landmark_density(X, X, k, block_size=30)
+        assert_array_almost_equal(density, ans_density)
+
+        density = utl.landmark_density(X, X, k, weights=2 * np.ones(100))
+        assert_array_almost_equal(density, ans_density)
+
 
 class TestSimilarityGraphs(unittest.TestCase):
     """
@@ -69,9 +108,11 @@ class TestSimilarityGraphs(unittest.TestCase):
                               [4, 3, 2]])
 
         ## DeBaCl knn similarity graph
-        for method in ['brute_force', 'kd_tree', 'ball_tree']:
+        for method, block_size in [('brute_force', None), ('brute_force', 2),
+                                   ('kd_tree', None), ('ball_tree', None)]:
 
-            knn, radii = utl.knn_graph(self.X, k=k, method=method)
+            knn, radii = utl.knn_graph(self.X, k=k, method=method,
+                                       block_size=block_size)
 
             ## Test
             assert_array_equal(radii, ans_radii)
@@ -79,6 +120,175 @@ class TestSimilarityGraphs(unittest.TestCase):
             for neighbors, ans_neighbors in zip(knn, ans_graph):
                 self.assertItemsEqual(neighbors, ans_neighbors)
 
+    def test_knn_query(self):
+        """
+        Test the k-nearest neighbor search against a separate reference set.
+        """
+        queries = self.X + 0.25
+
+        ans_distances = np.array([[0.25, 0.75]] * 4 + [[0.25, 1.25]])
+        ans_neighbors = np.array([[0, 1],
+                                  [1, 2],
+                                  [2, 3],
+                                  [3, 4],
+                                  [4, 3]])
+
+        for block_size, n_jobs in [(2, 1), (1000, 1), (2, 3)]:
+            distances, neighbors = utl.knn_query(queries, self.X, k=2,
+                                                 block_size=block_size,
+                                                 n_jobs=n_jobs)
+            assert_array_almost_equal(distances, ans_distances)
+            assert_array_equal(neighbors, ans_neighbors)
+
+    def test_low_precision(self):
+        """
+        Test that single precision graphs with float64 re-ranking match the
+        double precision graphs.
+        """
+        np.random.seed(19)
+        X = np.random.randn(200, 10)
+        k = 6
+
+        ans_knn, ans_radii = utl.knn_graph(X, k, method='brute_force')
+        knn, radii = utl.knn_graph(X, k, method='brute_force',
+                                   dtype=np.float32)
+        assert_array_equal(knn, ans_knn)
+        assert_array_almost_equal(radii, ans_radii)
+        self.assertEqual(radii.dtype, np.float64)
+
+        knn, radii = utl.knn_graph(X, k, method='brute_force',
+                                   dtype=np.float32, rerank=False)
+        self.assertEqual(radii.dtype, np.float32)
+
+        ans_graph = utl.epsilon_graph(X, epsilon=3.)
+        graph = utl.epsilon_graph(X, epsilon=3., dtype=np.float32)
+
+        for neighbors, ans_neighbors in zip(graph, ans_graph):
+            assert_array_equal(neighbors, ans_neighbors)
+
+        ## Data far from the origin.
+        X = 1e4 + np.random.rand(500, 3) * 1e-2
+        ans_knn, ans_radii = utl.knn_graph(X, k, method='brute_force')
+        knn, radii = utl.knn_graph(X, k, method='brute_force',
+                                   dtype=np.float32)
+        assert_array_equal(knn, ans_knn)
+        assert_array_almost_equal(radii, ans_radii)
+
+        ## Blocked double precision search on the same data.
+        D = spd.cdist(X, X)
+        ans_neighbors = np.argsort(D, axis=1, kind='mergesort')[:, :k]
+        distances, neighbors = utl.knn_query(X, X, k, block_size=100)
+        assert_array_equal(neighbors, ans_neighbors)
+        assert_array_almost_equal(distances, np.sort(D, axis=1)[:, :k])
+
+    def test_sparse_metrics(self):
+        """
+        Test that sparse inputs give the same neighbors as dense inputs, for
+        each metric, and check the cosine distances against scipy.
+        """
+        np.random.seed(19)
+        X = np.random.randn(200, 30)
+        X[X < 0.] = 0.
+        k = 6
+
+        for metric in ['euclidean', 'cosine', 'inner_product']:
+            Y = X / np.linalg.norm(X, axis=1)[:, np.newaxis] \
+                if metric == 'inner_product' else X
+            ans_knn, ans_radii = utl.knn_graph(Y, k, metric=metric)
+            knn, radii = utl.knn_graph(sps.csr_matrix(Y), k, metric=metric)
+
+            assert_array_equal(knn, ans_knn)
+            assert_array_almost_equal(radii, ans_radii)
+
+        ## Inner product distances need rows with unit norm.
+        for Y in [X, sps.csr_matrix(X)]:
+            with self.assertRaises(ValueError):
+                utl.knn_graph(Y, k, metric='inner_product')
+
+        with self.assertRaises(ValueError):
+            utl.epsilon_graph(X, metric='inner_product')
+
+        ## Cosine distances, with a row of zeros at distance 1.
+        D = spd.cdist(X, X, metric='cosine')
+        distances, neighbors = utl.knn_query(sps.csr_matrix(X), X, k,
+                                             metric='cosine', block_size=50)
+        assert_array_almost_equal(distances, np.sort(D, axis=1)[:, :k])
+
+        distances, neighbors = utl.knn_query(np.zeros((1, 30)), X, k,
+                                             metric='cosine')
+        assert_array_almost_equal(distances, np.ones((1, k)))
+
+    def test_metrics(self):
+        """
+        Test that every neighbor search method gives the k'th neighbor
+        distances of each metric, against scipy's pairwise distances.
+        """
+        np.random.seed(19)
+        X = np.random.randn(100, 3)
+        k = 5
+        VI = np.linalg.inv(np.diag([1., 4., 9.]))
+
+        metrics = [('manhattan', None, {'metric': 'cityblock'}),
+                   ('chebyshev', None, {'metric': 'chebyshev'}),
+                   ('minkowski', {'p': 3}, {'metric': 'minkowski', 'p': 3}),
+                   ('mahalanobis', {'VI': VI},
+                    {'metric': 'mahalanobis', 'VI': VI}),
+                   (lambda A, B: spd.cdist(A, B, 'cityblock'), None,
+                    {'metric': 'cityblock'})]
+
+        for metric, params, scipy_params in metrics:
+            D = spd.cdist(X, X, **scipy_params)
+            ans_radii = np.sort(D, axis=1)[:, k - 1]
+
+            for method in ['brute_force', 'kd_tree', 'ball_tree']:
+                knn, radii = utl.knn_graph(X, k, method=method, metric=metric,
+                                           metric_params=params)
+                assert_array_almost_equal(radii, ans_radii)
+
+            neighbors = utl.epsilon_graph(X, epsilon=1., metric=metric,
+                                          metric_params=params)
+            for row, ans_row in zip(neighbors, D <= 1.):
+                assert_array_equal(row, np.flatnonzero(ans_row))
+
+        ## Haversine distances, by brute force and the ball tree.
+        Y = np.column_stack((np.random.uniform(-1.5, 1.5, 100),
+                             np.random.uniform(-3., 3., 100)))
+        ans_knn, ans_radii = utl.knn_graph(Y, k, method='ball_tree',
+                                           metric='haversine')
+        knn, radii = utl.knn_graph(Y, k, metric='haversine')
+        assert_array_almost_equal(radii, ans_radii)
+
+        with self.assertRaises(ValueError):
+            utl.knn_graph(X, k, metric='minkowski')
+
+    def test_precomputed(self):
+        """
+        Test that condensed, square, and memory-mapped distance matrices give
+        the same graphs as the data.
+        """
+        np.random.seed(19)
+        X = np.random.randn(100, 3)
+        k = 5
+
+        ans_knn, ans_radii = utl.knn_graph(X, k, method='brute_force')
+        ans_graph = utl.epsilon_graph(X)
+
+        d = spd.pdist(X)
+        filename = os.path.join(tempfile.mkdtemp(), 'distances.npy')
+        np.save(filename, d)
+
+        for D in [d, spd.squareform(d), np.load(filename, mmap_mode='r')]:
+            knn, radii = utl.knn_graph(D, k, metric='precomputed')
+            assert_array_equal(knn, ans_knn)
+            assert_array_almost_equal(radii, ans_radii)
+
+            graph = utl.epsilon_graph(D, metric='precomputed')
+            for neighbors, ans_neighbors in zip(graph, ans_graph):
+                assert_array_equal(neighbors, ans_neighbors)
+
+        with self.assertRaises(ValueError):
+            utl.knn_graph(d[:-1], k, metric='precomputed')
+
     def test_epsilon_graph(self):
         """
         Test construction of the epsilon-nearest neighbor graph.
@@ -97,6 +307,217 @@ class TestSimilarityGraphs(unittest.TestCase):
         for neighbors, ans_neighbors in zip(enn, ans_graph):
             self.assertItemsEqual(neighbors, ans_neighbors)
 
+    def test_spanning_forest(self):
+        """
+        Test reduction of a similarity graph to a density-weighted spanning
+        forest.
+        """
+        knn, radii = utl.knn_graph(self.X, k=3)
+        density = np.array([1., 3., 2., 5., 4.])
+
+        forest = utl.density_spanning_forest(knn, density)
+
+        ## A spanning tree on a connected graph has n - 1 edges, kept in
+        #  both directions.
+        self.assertEqual(len(forest), len(self.X))
+        self.assertEqual(sum(len(x) for x in forest), 2 * (len(self.X) - 1))
+
+        ## Each forest edge is a graph edge, and the forest has the largest
+        #  possible total weight (the minimum endpoint density of each edge).
+        weight = 0.
+
+        for i, neighbors in enumerate(forest):
+            for j in neighbors:
+                self.assertTrue(j in knn[i] or i in knn[j])
+                weight += min(density[i], density[j]) / 2.
+
+        self.assertEqual(weight, 9.)
+
+
+class TestResourcePlanning(unittest.TestCase):
+    """
+    Unit test class for estimating the memory and time of tree construction.
+    """
+
+    def test_plan_resources(self):
+        """
+        Test that the plan avoids the full distance matrix when it doesn't fit
+        in memory, and chooses the block size to fit.
+        """
+        limit = 4 * 2**30
+        plan = utl.plan_resources(100000, 50, 10, memory_limit=limit)
+
+        full = [opt for opt in plan['graph']
+                if opt['method'] == 'brute_force' and
+                opt['block_size'] is None][0]
+        self.assertTrue(full['memory'] > 100 * 2**30)
+        self.assertFalse(full['feasible'])
+
+        self.assertEqual(plan['memory_limit'], limit)
+        self.assertEqual(plan['method'], 'brute_force')
+        self.assertTrue(1 <= plan['block_size'] < 1000)
+        self.assertTrue(plan['memory'] <= limit)
+        self.assertEqual(sorted(opt['method'] for opt in plan['engine']),
+                         ['construct_tree', 'construct_tree_sampled'])
+
+        ## Every method fits for small data, and the exact full distance
+        #  matrix is preferred.
+        plan = utl.plan_resources(100, 2, 5, memory_limit=limit)
+        self.assertTrue(all(opt['feasible'] for opt in plan['graph']))
+        self.assertEqual(plan['method'], 'brute_force')
+        self.assertIsNone(plan['block_size'])
+
+        ## Sparse data only supports the blocked search.
+        plan = utl.plan_resources(1000, 20, 5, sparse=True)
+        self.assertEqual([opt['method'] for opt in plan['graph']],
+                         ['brute_force'])
+        self.assertIsNotNone(plan['block_size'])
+
+        ## Nothing fits.
+        plan = utl.plan_resources(100000, 50, 10, memory_limit=2**20)
+        self.assertIsNone(plan['method'])
+        self.assertIsNone(plan['block_size'])
+
+
+class TestBinning(unittest.TestCase):
+    """
+    Test aggregation of data into histogram cells, and the similarity graph
+    and density estimate on the cells.
+    """
+
+    def setUp(self):
+        self.X = np.array([[0.02, 0.02],
+                           [0.13, 0.03],
+                           [0.17, 0.06],
+                           [0.24, 0.15],
+                           [0.56, 0.04]])
+        self.bin_width = 0.1
+
+    def test_bin_data(self):
+        """
+        Test assignment of points to histogram cells.
+        """
+        cells, counts, assignment = utl.bin_data(self.X, self.bin_width)
+
+        assert_array_equal(cells, np.array([[0, 0], [1, 0], [2, 1], [5, 0]]))
+        assert_array_equal(counts, np.array([1, 2, 1, 1]))
+        assert_array_equal(assignment, np.array([0, 1, 1, 2, 3]))
+
+        with self.assertRaises(ValueError):
+            utl.bin_data(self.X, bin_width=0.)
+
+    def test_cell_graph(self):
+        """
+        Test construction of the neighbor graph on occupied cells, and the
+        density estimate on the cell windows.
+        """
+        cells, counts, assignment = utl.bin_data(self.X, self.bin_width)
+
+        ## Cells that share a corner are neighbors by default.
+        ans_graph = [[0, 1], [0, 1, 2], [1, 2], [3]]
+        graph = utl.cell_graph(cells)
+
+        for neighbors, ans_neighbors in zip(graph, ans_graph):
+            self.assertItemsEqual(neighbors, ans_neighbors)
+
+        ## With connectivity 1, only cells that share a side are neighbors.
+        ans_graph = [[0, 1], [0, 1], [2], [3]]
+        graph = utl.cell_graph(cells, connectivity=1)
+
+        for neighbors, ans_neighbors in zip(graph, ans_graph):
+            self.assertItemsEqual(neighbors, ans_neighbors)
+
+        ## Density is the window count over the window volume.
+        density = utl.cell_density(cells, counts, graph, self.bin_width,
+                                   connectivity=1)
+        window_volume = 5 * self.bin_width**2
+        answer = np.array([3, 3, 1, 1]) / (5. * window_volume)
+        np.testing.assert_allclose(density, answer)
+
+
+class TestDuplicates(unittest.TestCase):
+    """
+    Test collapsing of duplicate rows.
+    """
+
+    def test_collapse_duplicates(self):
+        """
+        Test that duplicate rows are collapsed into unique rows with counts,
+        and that data without duplicates is unchanged.
+        """
+        X = np.array([[1, 2], [0, 1], [1, 2], [1, 2], [0, 1], [3, 3]])
+        unique_X, counts, assignment = utl.collapse_duplicates(X)
+
+        assert_array_equal(unique_X, np.array([[0, 1], [1, 2], [3, 3]]))
+        assert_array_equal(counts, np.array([2, 3, 1]))
+        assert_array_equal(unique_X[assignment], X)
+
+        X = np.array([[1, 2], [0, 1], [3, 3]])
+        unique_X, counts, assignment = utl.collapse_duplicates(X)
+
+        assert_array_equal(unique_X, X)
+        assert_array_equal(counts, np.ones(3))
+        assert_array_equal(assignment, np.arange(3))
+
+        ## Sparse rows are compared by their non-zero entries.
+        X = np.array([[1, 0], [0, 1], [1, 0], [1, 0], [0, 1], [3, 0]])
+        unique_X, counts, assignment = utl.collapse_duplicates(
+            sps.csr_matrix(X))
+
+        self.assertTrue(sps.issparse(unique_X))
+        assert_array_equal(counts, np.array([3, 2, 1]))
+        assert_array_equal(unique_X.toarray()[assignment], X)
+
+
+class TestDimensionReduction(unittest.TestCase):
+    """
+    Test the projection of data onto fewer dimensions, and the refinement
+    of neighbors found in the projected space.
+    """
+
+    def setUp(self):
+        np.random.seed(19)
+        latent = np.random.randn(500, 3)
+        self.X = (latent.dot(np.random.randn(3, 50)) +
+                  0.01 * np.random.randn(500, 50))
+
+    def test_reduce_dimension(self):
+        """
+        Test that both projections have the right shape, that sparse and
+        dense data give the same projection, and that PCA onto the latent
+        dimensions barely distorts distances.
+        """
+        for method in ['random_projection', 'pca']:
+            X_reduced, components = utl.reduce_dimension(
+                self.X, 10, method=method, random_state=19, chunk_size=70)
+            self.assertEqual(X_reduced.shape, (500, 10))
+
+            ## Principal components are unique only up to sign.
+            sparse_reduced, _ = utl.reduce_dimension(
+                sps.csr_matrix(self.X), 10, method=method, random_state=19)
+            assert_array_almost_equal(spd.pdist(sparse_reduced),
+                                      spd.pdist(X_reduced))
+
+        X_reduced, components = utl.reduce_dimension(self.X, 3, method='pca',
+                                                     random_state=19)
+        mean_error, max_error = utl.projection_distortion(self.X, X_reduced,
+                                                          random_state=19)
+        self.assertLess(max_error, 0.01)
+
+    def test_refine_neighbors(self):
+        """
+        Test that refining candidate neighbors gives the exact neighbors.
+        """
+        k = 5
+        ans_knn, ans_radii = utl.knn_graph(self.X, k)
+        candidates, _ = utl.knn_graph(self.X, 3 * k)
+        candidates = candidates[:, ::-1]
+
+        for X in [self.X, sps.csr_matrix(self.X)]:
+            knn, radii = utl.refine_neighbors(X, candidates, k)
+            assert_array_equal(knn, ans_knn)
+            assert_array_almost_equal(radii, ans_radii)
+
 
 class TestDensityGrids(unittest.TestCase):
     """
@@ -181,6 +602,25 @@ class TestDensityGrids(unittest.TestCase):
         levels = utl.define_density_mass_grid(self.uniform_density)
         self.assertItemsEqual(levels, [1.])
 
+        ## Test weighted input. Unit weights give the unweighted grid, and
+        #  integer weights give the grid of the repeated density values.
+        for num_levels in (None, 2, 5):
+            levels = utl.define_density_mass_grid(self.unique_density,
+                                                  num_levels=num_levels)
+            weighted_levels = utl.define_density_mass_grid(
+                self.unique_density, num_levels=num_levels,
+                weights=np.ones(self.n))
+            assert_array_equal(levels, weighted_levels)
+
+        weights = np.array([1, 1, 1, 1, 1, 1, 1, 1, 1, 91])
+        levels = utl.define_density_mass_grid(np.arange(10), num_levels=4,
+                                              weights=weights)
+        assert_array_equal(levels, np.array([0, 8, 9]))
+
+        with self.assertRaises(ValueError):
+            utl.define_density_mass_grid(self.unique_density,
+                                         weights=np.ones(3))
+
     def _check_level_grid_answer(self, density, levels):
         """
         Utility to check correctness of a num_levels=n density level grid.
@@ -6,10 +6,13 @@ Utility functions for the DEnsity-BAsed CLustering (DeBaCl) toolbox.
 from __future__ import print_function as _print_function
 from __future__ import absolute_import as _absolute_import
 
+import sys as _sys
 import logging as _logging
+import importlib as _importlib
+import multiprocessing as _multiprocessing
+from multiprocessing.pool import ThreadPool as _ThreadPool
 
-_logging.basicConfig(level=_logging.INFO, datefmt='%Y-%m-%d %I:%M:%S',
-                     format='%(levelname)s (%(asctime)s): %(message)s')
+_logger = _logging.getLogger(__name__)
 
 try:
     import numpy as _np
@@ -17,177 +20,2098 @@ except:
     raise ImportError("DeBaCl requires the numpy, networkx, and " +
                       "prettytable packages.")
 
-## Soft dependencies
-try:
-    import scipy.spatial.distance as _spd
-    import scipy.special as _spspec
-    _HAS_SCIPY = True
-except:
-    _HAS_SCIPY = False
 
-try:
-    import sklearn.neighbors as _sknbr
-    _HAS_SKLEARN = True
-except:
-    _HAS_SKLEARN = False
+class _LazyModule(object):
+    """
+    Stand-in for a module that is imported on first attribute access, so that
+    importing DeBaCl doesn't pay for dependencies a program never uses. This
+    class is not meant to be used directly.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = _importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+
+def _has_module(name):
+    """
+    Check if a top-level package can be imported, without importing it. This
+    function is not meant to be called by the user.
+    """
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        import imp
+        try:
+            imp.find_module(name)
+            return True
+        except ImportError:
+            return False
+
+    return find_spec(name) is not None
+
+
+def _issparse(X):
+    """
+    Check if 'X' is a scipy sparse matrix. If scipy.sparse hasn't been
+    imported yet, 'X' can't be one, so it isn't imported just to check. This
+    function is not meant to be called by the user.
+    """
+    return 'scipy.sparse' in _sys.modules and _sps.issparse(X)
+
+
+## Soft dependencies, imported on first use.
+_spd = _LazyModule('scipy.spatial.distance')
+_spspec = _LazyModule('scipy.special')
+_sps = _LazyModule('scipy.sparse')
+_csgraph = _LazyModule('scipy.sparse.csgraph')
+_HAS_SCIPY = _has_module('scipy')
+
+_sknbr = _LazyModule('sklearn.neighbors')
+_HAS_SKLEARN = _has_module('sklearn')
+
+## Distance metrics for each neighbor search method. Mahalanobis distance is
+## computed as Euclidean distance on whitened data, and user-supplied
+## callables always use the blocked brute-force search.
+_METRICS = ('euclidean', 'cosine', 'inner_product', 'manhattan', 'chebyshev',
+            'minkowski', 'mahalanobis', 'haversine', 'precomputed')
+_SPARSE_METRICS = ('euclidean', 'cosine', 'inner_product')
+_KD_TREE_METRICS = ('euclidean', 'manhattan', 'chebyshev', 'minkowski')
+_BALL_TREE_METRICS = _KD_TREE_METRICS + ('haversine',)
 
 
 #####################################
 ### SIMILARITY GRAPH CONSTRUCTION ###
 #####################################
-def knn_graph(X, k, method='brute_force', leaf_size=30):
+def knn_graph(X, k, method='brute_force', leaf_size=30, dtype=None,
+              rerank=True, metric='euclidean', metric_params=None, n_jobs=1,
+              block_size=None):
     """
     Compute the symmetric k-nearest neighbor graph for a set of points. Assume
-    a Euclidean distance metric.
+    a Euclidean distance metric, unless otherwise specified.
+
+    Parameters
+    ----------
+    X : numpy array | list [numpy arrays] | scipy sparse matrix
+        Data points, with each row as an observation. If 'metric' is
+        'precomputed', a condensed or square distance matrix instead, which
+        may be a `numpy.memmap`.
+
+    k : int
+        The number of points to consider as neighbors of any given observation.
+
+    method : {'brute-force', 'kd-tree', 'ball-tree'}, optional
+        Computing method.
+
+        - 'brute-force': computes the (Euclidean) distance between all O(n^2)
+          pairs of rows in 'X', then for every point finds the k-nearest. It is
+          limited to tens of thousands of observations (depending on available
+          RAM).
+
+        - 'kd-tree': partitions the data into axis-aligned rectangles to avoid
+          computing all O(n^2) pairwise distances. Much faster than
+          'brute-force', but only works for data in fewer than about 20
+          dimensions. Requires the scikit-learn library.
+
+        - 'ball-tree': partitions the data into balls and uses the metric
+          property of euclidean distance to avoid computing all O(n^2)
+          distances. Typically much faster than 'brute-force', and works with
+          up to a few hundred dimensions. Requires the scikit-learn library.
+
+        Underscores may be used in place of the hyphens.
+
+    leaf_size : int, optional
+        For the 'kd-tree' and 'ball-tree' methods, the number of observations
+        in the leaf nodes. Leaves are not split further, so distance
+        computations within leaf nodes are done by brute force. 'leaf_size' is
+        ignored for the 'brute-force' method.
+
+    dtype : numpy dtype, optional
+        Precision of the distance computations. If 'numpy.float32',
+        distances are computed in blocks by brute force, with half the
+        memory of the default float64 computation. See `knn_query`.
+
+    rerank : bool, optional
+        If True (default) and 'dtype' is lower precision than float64, the
+        candidate neighbors are re-ranked with exact float64 distances.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_query`. If the metric is not supported by
+        the 'kd-tree' or 'ball-tree' index, or 'X' is sparse, neighbors are
+        found by blocked brute force with `knn_query`. If 'precomputed', 'X'
+        is a distance matrix, which is read in blocks of rows, and 'method'
+        is ignored.
+
+    metric_params : dict, optional
+        Parameters of the distance metric. See `knn_query`.
+
+    n_jobs : int, optional
+        Number of threads that search for neighbors in parallel, or -1 for
+        one thread per CPU. With more than one thread, the brute force method
+        uses `knn_query` for every metric, so neighbors at exactly the same
+        distance may be ordered differently than with one thread.
+
+    block_size : int, optional
+        If specified, the 'brute-force' method computes distances for this
+        many rows at a time with `knn_query`, instead of computing the full
+        distance matrix, which needs about 20 * n^2 bytes. Also the number of
+        rows of a 'precomputed' distance matrix to read at once. See
+        `plan_resources` to choose the method and block size.
+
+    Returns
+    -------
+    neighbors : numpy array
+        Each row contains the nearest neighbors of the corresponding row in
+        'X', indicated by row indices.
+
+    radii : list[float]
+        For each row of 'X' the distance to its k'th nearest neighbor
+        (including itself).
+
+    See Also
+    --------
+    epsilon_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> knn, radii = debacl.utils.knn_graph(X, k=8, method='kd-tree')
+    """
+
+    metric, metric_params = _check_metric(metric, metric_params)
+
+    if metric == 'precomputed':
+        return _precomputed_knn_graph(X, k, block_size)
+
+    n, p = X.shape
+    method = method.replace('-', '_')
+
+    low_precision = dtype is not None and _np.dtype(dtype) != _np.float64
+    sparse = _issparse(X)
+
+    if metric == 'mahalanobis' and not sparse:
+        X = _whiten(X, metric_params)
+        metric = 'euclidean'
+
+    tree_params = {'p': metric_params['p']} if metric == 'minkowski' else {}
+
+    if method == 'kd_tree' and metric in _KD_TREE_METRICS and not sparse:
+        if _HAS_SKLEARN:
+            kdtree = _sknbr.KDTree(X, leaf_size=leaf_size, metric=metric,
+                                   **tree_params)
+            distances, neighbors = _tree_query(kdtree, X, k, n_jobs)
+            radii = distances[:, -1]
+        else:
+            raise ImportError("The scikit-learn library could not be loaded." +
+                              " It is required for the 'kd-tree' method.")
+
+    elif method == 'ball_tree' and metric in _BALL_TREE_METRICS and not sparse:
+        if _HAS_SKLEARN:
+            btree = _sknbr.BallTree(X, leaf_size=leaf_size, metric=metric,
+                                    **tree_params)
+            distances, neighbors = _tree_query(btree, X, k, n_jobs)
+            radii = distances[:, -1]
+        else:
+            raise ImportError("The scikit-learn library could not be loaded." +
+                              " It is required for the 'ball-tree' method.")
+
+    elif (metric == 'euclidean' and not sparse and not low_precision and
+          _num_threads(n_jobs) == 1 and block_size is None):
+        if not _HAS_SCIPY:
+            raise ImportError("The 'scipy' module could not be loaded. " +
+                              "It is required for the 'brute_force' method " +
+                              "for building a knn similarity graph.")
+
+        d = _spd.pdist(X, metric='euclidean')
+        D = _spd.squareform(d)
+        rank = _np.argsort(D, axis=1)
+        neighbors = rank[:, 0:k]
+
+        k_nbr = neighbors[:, -1]
+        radii = D[_np.arange(n), k_nbr]
+
+    else:  # blocked brute force
+        distances, neighbors = knn_query(X, X, k,
+                                         block_size=block_size or 1000,
+                                         dtype=dtype, rerank=rerank,
+                                         metric=metric,
+                                         metric_params=metric_params,
+                                         n_jobs=n_jobs)
+        radii = distances[:, -1]
+
+    return neighbors, radii
+
+
+def _tree_query(tree, X, k, n_jobs=1, block_size=1000):
+    """
+    Query a scikit-learn KDTree or BallTree for the k-nearest neighbors of
+    the rows of 'X', in blocks of rows processed by 'n_jobs' threads. This
+    function is not meant to be called by the user; it is a helper function
+    for `knn_graph`.
+    """
+    if _num_threads(n_jobs) == 1:
+        return tree.query(X, k=k, return_distance=True, sort_results=True)
+
+    distances = _np.empty((X.shape[0], k), dtype=_np.float)
+    neighbors = _np.empty((X.shape[0], k), dtype=_np.int)
+
+    def query(start):
+        block = slice(start, start + block_size)
+        distances[block], neighbors[block] = tree.query(
+            X[block], k=k, return_distance=True, sort_results=True)
+
+    _map_blocks(query, range(0, X.shape[0], block_size), n_jobs)
+
+    return distances, neighbors
+
+
+def _num_threads(n_jobs):
+    """
+    Convert the 'n_jobs' parameter to a number of threads, where -1 means one
+    thread per CPU, -2 all but one, and so on. This function is not meant to
+    be called by the user.
+    """
+    if n_jobs is None:
+        return 1
+    elif n_jobs < 0:
+        return max(_multiprocessing.cpu_count() + 1 + n_jobs, 1)
+    else:
+        return max(n_jobs, 1)
+
+
+def _map_blocks(function, starts, n_jobs=1):
+    """
+    Call 'function' on each block start index, with a pool of 'n_jobs'
+    threads. The function should write its results in place; numpy releases
+    the global interpreter lock in the distance computations and sorts, so
+    the blocks run in parallel. This function is not meant to be called by
+    the user.
+    """
+    num_threads = min(_num_threads(n_jobs), len(starts))
+
+    if num_threads <= 1:
+        for start in starts:
+            function(start)
+
+    else:
+        pool = _ThreadPool(num_threads)
+        try:
+            pool.map(function, starts)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def knn_query(X, reference, k, block_size=1000, dtype=None, rerank=True,
+              metric='euclidean', metric_params=None, n_jobs=1):
+    """
+    Find the k-nearest neighbors of each row of 'X' among the rows of
+    'reference'. Distances are computed by brute force, in blocks of rows of
+    'X', so memory use is proportional to 'block_size' times the number of
+    reference points.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Query points, with each row as an observation.
+
+    reference : 2-dimensional numpy array or scipy sparse matrix
+        Candidate neighbors, with the same number of columns as 'X'.
+
+    k : int
+        The number of neighbors to find for each query point.
+
+    block_size : int, optional
+        Number of query points to process at once.
+
+    dtype : numpy dtype, optional
+        Precision of the distance computations. If None (default), the
+        precision of 'X'.
+
+    rerank : bool, optional
+        If True (default) and 'dtype' is lower precision than float64, twice
+        as many candidate neighbors are found at the lower precision, then
+        re-ranked with exact float64 distances. Otherwise the distances are
+        returned at the lower precision. Only the 'euclidean', 'cosine', and
+        'inner_product' metrics are re-ranked, and sparse inputs are not.
+        The candidates almost always contain the float64 neighbors, but this
+        is not guaranteed when many points are nearly equidistant.
+
+    metric : str or callable, optional
+        Distance metric.
+
+        - 'euclidean': the default.
+
+        - 'cosine': one minus the cosine similarity of two points. Rows of
+          zeros are at distance 1 from every point.
+
+        - 'inner_product': one minus the inner product of two points. This
+          is the cosine distance for rows with unit norm (such as TF-IDF
+          features), without the cost of normalizing the rows. Rows must
+          have unit norm or be all zeros; other rows raise a ValueError.
+
+        - 'manhattan' (or 'cityblock'), 'chebyshev': the L1 and L-infinity
+          distances.
+
+        - 'minkowski': the Lq distance, with 'q' given as `metric_params`
+          entry 'p'.
+
+        - 'mahalanobis': Euclidean distance after the whitening transform
+          `X.dot(W)`. `metric_params` must contain either the transform
+          'W', or the inverse covariance matrix 'VI', in which case 'W' is
+          its Cholesky factor.
+
+        - 'haversine': great circle distance on the unit sphere. Each row is
+          a (latitude, longitude) pair in radians.
+
+        - callable: a function that takes two 2-dimensional arrays with 'a'
+          and 'b' rows and returns the 'a' x 'b' array of distances between
+          them. It is called on blocks of rows, so it should be vectorized.
+
+        Sparse inputs support only the 'euclidean', 'cosine', and
+        'inner_product' metrics.
+
+    metric_params : dict, optional
+        Parameters of the distance metric. See 'metric'.
+
+    n_jobs : int, optional
+        Number of threads that process blocks of query points in parallel, or
+        -1 for one thread per CPU. The output does not depend on 'n_jobs'.
+
+    Returns
+    -------
+    distances : 2-dimensional numpy array
+        Each row contains the distances from the corresponding row of 'X' to
+        its 'k' nearest reference points, in increasing order.
+
+    neighbors : 2-dimensional numpy array[int]
+        Each row contains the row indices in 'reference' of the nearest
+        neighbors of the corresponding row of 'X'.
+
+    See Also
+    --------
+    knn_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(1000, 2)
+    >>> reference = X[:100]
+    >>> distances, neighbors = debacl.utils.knn_query(X, reference, k=5)
+    """
+
+    metric, metric_params = _check_metric(metric, metric_params)
+
+    if metric == 'precomputed':
+        raise ValueError("Use 'knn_graph' for precomputed distances.")
+
+    n = X.shape[0]
+    k = min(k, reference.shape[0])
+    sparse = _issparse(X) or _issparse(reference)
+
+    if sparse:
+        if metric not in _SPARSE_METRICS:
+            raise ValueError("Sparse inputs support only the 'euclidean', " +
+                             "'cosine', and 'inner_product' metrics.")
+
+        X = _sps.csr_matrix(X)
+        reference = _sps.csr_matrix(reference)
+
+    if metric == 'cosine':
+        X = _normalize_rows(X)
+        reference = _normalize_rows(reference)
+
+    elif metric == 'inner_product':
+        _check_unit_norm(X)
+        _check_unit_norm(reference)
+
+    elif metric == 'mahalanobis':
+        X = _whiten(X, metric_params)
+        reference = _whiten(reference, metric_params)
+        metric = 'euclidean'
+
+    dtype = _np.dtype(X.dtype if dtype is None else dtype)
+    rerank = (rerank and dtype != _np.float64 and not sparse and
+              metric in _SPARSE_METRICS)
+    num_candidates = min(2 * k, reference.shape[0]) if rerank else k
+
+    if sparse:
+        X_low = X.astype(dtype)
+        ref_low = reference.astype(dtype)
+
+    ## Euclidean distances are computed from the norms of the points, which
+    #  cancel for data far from the origin, even in double precision, so the
+    #  data is centered first.
+    elif metric == 'euclidean':
+        center = _np.mean(reference, axis=0, dtype=_np.float64)
+        X_low = (X - center).astype(dtype)
+        ref_low = (reference - center).astype(dtype)
+
+    else:
+        X_low = X.astype(dtype, copy=False)
+        ref_low = reference.astype(dtype, copy=False)
+
+    ref_norms = _squared_norms(ref_low) if metric == 'euclidean' else None
+
+    distances = _np.empty((n, k), dtype=_np.float if rerank else dtype)
+    neighbors = _np.empty((n, k), dtype=_np.int)
+
+    def query(start):
+        block = X_low[start:start + block_size]
+        dist = _block_distances(block, ref_low, metric, ref_norms,
+                                metric_params)
+
+        ## Find the nearest candidates, then sort only those.
+        if num_candidates < reference.shape[0]:
+            nbrs = _np.argpartition(dist, num_candidates - 1,
+                                    axis=1)[:, :num_candidates]
+        else:
+            nbrs = _np.tile(_np.arange(num_candidates), (block.shape[0], 1))
+
+        rows = _np.arange(block.shape[0])[:, _np.newaxis]
+
+        if rerank:
+            dist = _exact_distances(X[start:start + block_size], reference,
+                                    nbrs, metric)
+            order = _np.argsort(dist, axis=1, kind='mergesort')[:, :k]
+            dist = dist[rows, order]
+            nbrs = nbrs[rows, order]
+        else:
+            order = _np.argsort(dist[rows, nbrs], axis=1)
+            nbrs = nbrs[rows, order]
+            dist = dist[rows, nbrs]
+
+        ## Euclidean distances are compared in squared form until the end.
+        if metric == 'euclidean':
+            dist = _np.sqrt(dist)
+
+        neighbors[start:start + block_size] = nbrs
+        distances[start:start + block_size] = dist
+
+    _map_blocks(query, range(0, n, block_size), n_jobs)
+
+    return distances, neighbors
+
+
+def _block_distances(X, Y, metric, Y_norms=None, metric_params=None):
+    """
+    Compute the distances between the rows of 'X' and the rows of 'Y'.
+    Euclidean, cosine, and inner product distances are computed in the
+    precision of the inputs, and Euclidean distances are squared. This
+    function is not meant to be called by the user; it is a helper function
+    for `knn_query`.
+
+    Parameters
+    ----------
+    X, Y : 2-dimensional numpy arrays or scipy sparse matrices
+        Points, with each row as an observation.
+
+    metric : str or callable
+        Distance metric, as returned by `_check_metric`. For 'cosine', the
+        rows are assumed to be normalized already, and 'mahalanobis' is not
+        accepted; use Euclidean distance on whitened data instead.
+
+    Y_norms : numpy array, optional
+        For the 'euclidean' metric, the squared norm of each row of 'Y'.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    Returns
+    -------
+    dist : 2-dimensional numpy array
+        Distance between each row of 'X' (rows) and each row of 'Y'
+        (columns).
+    """
+
+    if metric == 'euclidean':
+        return _squared_distances(X, Y, Y_norms)
+
+    elif metric in ('cosine', 'inner_product'):
+        dist = _dense_product(X, Y)
+        dist *= -1
+        dist += 1
+        return dist
+
+    elif metric == 'manhattan':
+        return _spd.cdist(X, Y, metric='cityblock')
+
+    elif metric == 'chebyshev':
+        return _spd.cdist(X, Y, metric='chebyshev')
+
+    elif metric == 'minkowski':
+        return _spd.cdist(X, Y, metric='minkowski', p=metric_params['p'])
+
+    elif metric == 'haversine':
+        return _haversine_distances(X, Y)
+
+    else:  # user-supplied callable
+        return _np.asarray(metric(X, Y), dtype=_np.float)
+
+
+def _haversine_distances(X, Y):
+    """
+    Compute great circle distances on the unit sphere between the rows of
+    'X' and the rows of 'Y', which are (latitude, longitude) pairs in
+    radians. This function is not meant to be called by the user.
+    """
+
+    lat_x = X[:, 0][:, _np.newaxis]
+    lat_y = Y[:, 0][_np.newaxis, :]
+    half_dlon = (X[:, 1][:, _np.newaxis] - Y[:, 1][_np.newaxis, :]) / 2.
+
+    h = (_np.sin((lat_x - lat_y) / 2.)**2 +
+         _np.cos(lat_x) * _np.cos(lat_y) * _np.sin(half_dlon)**2)
+
+    return 2 * _np.arcsin(_np.sqrt(_np.clip(h, 0., 1.)))
+
+
+def _check_metric(metric, metric_params=None):
+    """
+    Check that a distance metric is supported, and that it has the required
+    parameters. This function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    metric : str or callable
+        Distance metric. See `knn_query`.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    Returns
+    -------
+    metric : str or callable
+        Canonical name of the distance metric.
+
+    metric_params : dict
+        Parameters of the distance metric, empty if there are none.
+    """
+
+    metric_params = {} if metric_params is None else dict(metric_params)
+
+    if callable(metric):
+        return metric, metric_params
+
+    if metric == 'cityblock':
+        metric = 'manhattan'
+
+    if metric not in _METRICS:
+        raise ValueError("Metric not understood. Please use one of " +
+                         "{} or a callable.".format(", ".join(_METRICS)))
+
+    if metric == 'minkowski' and 'p' not in metric_params:
+        raise ValueError("The 'minkowski' metric requires the exponent 'p' " +
+                         "in 'metric_params'.")
+
+    if metric == 'mahalanobis' and not ('W' in metric_params or
+                                        'VI' in metric_params):
+        raise ValueError("The 'mahalanobis' metric requires the whitening " +
+                         "transform 'W' or the inverse covariance matrix " +
+                         "'VI' in 'metric_params'.")
+
+    return metric, metric_params
+
+
+def _whitening_transform(metric_params):
+    """
+    Get the whitening transform 'W' for the Mahalanobis distance, such that
+    the Mahalanobis distance between 'x' and 'y' is the Euclidean distance
+    between `x.dot(W)` and `y.dot(W)`. This function is not meant to be
+    called by the user.
+    """
+
+    if 'W' in metric_params:
+        return _np.asarray(metric_params['W'], dtype=_np.float)
+
+    return _np.linalg.cholesky(_np.asarray(metric_params['VI'],
+                                           dtype=_np.float))
+
+
+def _whiten(X, metric_params):
+    """
+    Apply the Mahalanobis whitening transform to the rows of 'X'. This
+    function is not meant to be called by the user.
+    """
+
+    return _np.dot(X, _whitening_transform(metric_params))
+
+
+def _exact_distances(X, reference, candidates, metric, chunk_size=2**20):
+    """
+    Compute float64 distances from each row of 'X' to its candidate
+    neighbors in 'reference'. Euclidean distances are squared, and computed
+    by direct differences. This function is not meant to be called by the
+    user; it is a helper function for `knn_query`.
+
+    Parameters
+    ----------
+    X, reference : 2-dimensional numpy arrays
+        Query and reference points, with each row as an observation.
+
+    candidates : 2-dimensional numpy array[int]
+        Row indices in 'reference' of the candidate neighbors of each row of
+        'X'.
+
+    metric : {'euclidean', 'cosine', 'inner_product'}
+        Distance metric. For 'cosine', the rows are assumed to be normalized
+        already.
+
+    chunk_size : int, optional
+        Maximum number of array elements in the differences computed at once.
+
+    Returns
+    -------
+    dist : 2-dimensional numpy array
+        Distance from each row of 'X' to each of its candidates.
+    """
+
+    dist = _np.empty(candidates.shape, dtype=_np.float64)
+    step = max(1, chunk_size // max(1, candidates.shape[1] * X.shape[1]))
+
+    for start in range(0, len(X), step):
+        rows = slice(start, start + step)
+        query = X[rows, _np.newaxis, :].astype(_np.float64)
+
+        if metric == 'euclidean':
+            dist[rows] = _np.sum((query - reference[candidates[rows]])**2,
+                                 axis=2)
+        else:
+            dist[rows] = 1 - _np.sum(query * reference[candidates[rows]],
+                                     axis=2)
+
+    return dist
+
+
+def _squared_distances(X, Y, Y_norms=None):
+    """
+    Compute the squared Euclidean distances between the rows of 'X' and the
+    rows of 'Y', in the precision of the inputs. This function is not meant
+    to be called by the user.
+
+    Parameters
+    ----------
+    X, Y : 2-dimensional numpy arrays or scipy sparse matrices
+        Points, with each row as an observation.
+
+    Y_norms : numpy array, optional
+        Squared norm of each row of 'Y', if already computed.
+
+    Returns
+    -------
+    sq_dist : 2-dimensional numpy array
+        Squared distance between each row of 'X' (rows) and each row of 'Y'
+        (columns). Small negative values from rounding are set to 0.
+    """
+
+    if Y_norms is None:
+        Y_norms = _squared_norms(Y)
+
+    sq_dist = _dense_product(X, Y)
+    sq_dist *= -2
+    sq_dist += _squared_norms(X)[:, _np.newaxis]
+    sq_dist += Y_norms
+    _np.maximum(sq_dist, 0, out=sq_dist)
+
+    return sq_dist
+
+
+def _dense_product(X, Y):
+    """
+    Compute the inner products between the rows of 'X' and the rows of 'Y',
+    as a dense array. Either input may be a scipy sparse matrix. This
+    function is not meant to be called by the user.
+    """
+
+    if _issparse(X) or _issparse(Y):
+        product = _sps.csr_matrix(X).dot(_sps.csr_matrix(Y).T)
+        return product.toarray()
+
+    return _np.dot(X, Y.T)
+
+
+def _squared_norms(X):
+    """
+    Compute the squared Euclidean norm of each row of a numpy array or scipy
+    sparse matrix. This function is not meant to be called by the user.
+    """
+
+    if _issparse(X):
+        return _sps.csr_matrix(X.multiply(X)).dot(_np.ones(X.shape[1]))
+
+    return _np.sum(X**2, axis=1)
+
+
+def _normalize_rows(X):
+    """
+    Scale each row of a numpy array or scipy sparse matrix to unit Euclidean
+    norm. Rows of zeros are left unchanged. This function is not meant to be
+    called by the user.
+    """
+
+    norms = _np.sqrt(_squared_norms(X).astype(_np.float64))
+    norms[norms == 0] = 1.
+
+    if _issparse(X):
+        return _sps.csr_matrix(_sps.diags(1. / norms).dot(X))
+
+    return X / norms[:, _np.newaxis]
+
+
+def _check_unit_norm(X, tol=1e-4):
+    """
+    Check that each row of a numpy array or scipy sparse matrix has unit
+    Euclidean norm or is all zeros, as the 'inner_product' metric requires.
+    Otherwise one minus the inner product can be negative. This function is
+    not meant to be called by the user.
+    """
+
+    norms = _squared_norms(X).astype(_np.float64)
+
+    if _np.any((norms > 0) & (_np.abs(norms - 1.) > tol)):
+        raise ValueError("The 'inner_product' metric requires rows with " +
+                         "unit norm. Normalize the rows or use the " +
+                         "'cosine' metric.")
+
+
+def epsilon_graph(X, epsilon=None, percentile=0.05, dtype=None,
+                  rerank=True, metric='euclidean', metric_params=None):
+    """
+    Construct an epsilon-neighborhood graph, represented by an adjacency list.
+    Two vertices are connected by an edge if they are within 'epsilon' distance
+    of each other, according to the Euclidean metric unless otherwise
+    specified. The implementation is a brute-force computation of all O(n^2)
+    pairwise distances of the rows in X.
+
+    Parameters
+    ----------
+    X : 2D numpy array
+        The rows of 'X' are the observations which become graph vertices. If
+        'metric' is 'precomputed', a condensed or square distance matrix
+        instead, which may be a `numpy.memmap`.
+
+    epsilon : float, optional
+        The distance threshold for neighbors.
+
+    percentile : float, optional
+        If 'epsilon' is unspecified, this determines the distance threshold.
+        'epsilon' is set to the desired percentile of all (n choose 2) pairwise
+        distances, where n is the number of rows in 'X'.
+
+    dtype : numpy dtype, optional
+        Precision of the Euclidean distance computations. If
+        'numpy.float32', the pairwise distances take half the memory of the
+        default float64 computation. Other metrics are computed in float64.
+
+    rerank : bool, optional
+        If True (default) and 'dtype' is lower precision than float64, pairs
+        whose low-precision distance is within rounding error of 'epsilon'
+        are checked with exact float64 distances.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_query`. If 'precomputed', 'X' is a
+        distance matrix, which is read in blocks, and never loaded into
+        memory in full.
+
+    metric_params : dict, optional
+        Parameters of the distance metric. See `knn_query`.
+
+    Returns
+    -------
+    neighbors : numpy array
+        Each row contains the nearest neighbors of the corresponding row in
+        'X', indicated by row indices.
+
+    See Also
+    --------
+    knn_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> neighbors = debacl.utils.epsilon_graph(X, epsilon=0.2)
+    """
+
+    if not _HAS_SCIPY:
+        raise ImportError("The 'scipy' module could not be loaded. " +
+                          "It is required for constructing an epsilon " +
+                          "neighborhood similarity graph.")
+
+    metric, metric_params = _check_metric(metric, metric_params)
+
+    if metric == 'precomputed':
+        return _precomputed_epsilon_graph(X, epsilon, percentile)
+
+    if metric == 'mahalanobis':
+        X = _whiten(X, metric_params)
+        metric = 'euclidean'
+
+    if metric == 'euclidean':
+        if dtype is not None and _np.dtype(dtype) != _np.float64:
+            return _epsilon_graph_low_precision(X, epsilon, percentile,
+                                                _np.dtype(dtype), rerank)
+
+        d = _spd.pdist(X, metric='euclidean')
+        D = _spd.squareform(d)
+
+    else:
+        D = _pairwise_distances(X, metric, metric_params)
+        d = _spd.squareform(D, checks=False) if epsilon is None else None
+
+    if epsilon is None:
+        epsilon = _np.percentile(d, round(percentile * 100))
+
+    adjacency_matrix = D <= epsilon
+    neighbors = [_np.where(row)[0] for row in adjacency_matrix]
+
+    return neighbors
+
+
+def _epsilon_graph_low_precision(X, epsilon, percentile, dtype, rerank,
+                                 block_size=1000):
+    """
+    Construct an epsilon-neighborhood graph with distances computed in
+    reduced precision. This function is not meant to be called by the user;
+    it is a helper function for `epsilon_graph`.
+
+    Parameters
+    ----------
+    X : 2D numpy array
+        The rows of 'X' are the observations which become graph vertices.
+
+    epsilon : float
+        The distance threshold for neighbors. If None, it is set to the
+        'percentile' of the pairwise distances.
+
+    percentile : float
+        Percentile of the pairwise distances to use for 'epsilon'.
+
+    dtype : numpy dtype
+        Precision of the distance computations.
+
+    rerank : bool
+        If True, pairs near the threshold are checked in float64.
+
+    block_size : int, optional
+        Number of rows of 'X' to process at once.
+
+    Returns
+    -------
+    neighbors : list [numpy array]
+        Neighbors of each row of 'X', including itself.
+    """
+
+    ## Center the data, so the norms don't cancel in low precision.
+    n = len(X)
+    X_low = (X - _np.mean(X, axis=0, dtype=_np.float64)).astype(dtype)
+    norms = _np.sum(X_low**2, axis=1)
+
+    if epsilon is None:
+        D = _np.sqrt(_squared_distances(X_low, X_low, norms))
+        _np.fill_diagonal(D, 0)
+        epsilon = _np.percentile(_spd.squareform(D, checks=False),
+                                 round(percentile * 100))
+        del D
+
+    ## Rounding error of the squared distances, for each pair of points.
+    tolerance = 4 * _np.finfo(dtype).eps
+
+    neighbors = []
+
+    for start in range(0, n, block_size):
+        block = X_low[start:start + block_size]
+        block_norms = norms[start:start + block_size]
+        sq_dist = _squared_distances(block, X_low, norms)
+
+        if rerank:
+            slack = tolerance * (block_norms[:, _np.newaxis] + norms)
+            candidates = sq_dist <= epsilon**2 + slack
+        else:
+            candidates = sq_dist <= epsilon**2
+
+        for i, row in enumerate(candidates):
+            nbrs = _np.flatnonzero(row)
+
+            if rerank:
+                exact = X[nbrs].astype(_np.float64) - X[start + i]
+                nbrs = nbrs[_np.sum(exact**2, axis=1) <= epsilon**2]
+
+            neighbors.append(nbrs)
+
+    return neighbors
+
+
+def _pairwise_distances(X, metric, metric_params=None, block_size=1000):
+    """
+    Compute the square matrix of distances between all pairs of rows of 'X',
+    in blocks of rows. This function is not meant to be called by the user;
+    it is a helper function for `epsilon_graph`.
+
+    Parameters
+    ----------
+    X : 2D numpy array
+        Data points, with each row as an observation.
+
+    metric : str or callable
+        Distance metric, other than 'euclidean' and 'mahalanobis'.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    block_size : int, optional
+        Number of rows of 'X' to process at once.
+
+    Returns
+    -------
+    D : 2D numpy array
+        Distance between each pair of rows of 'X', with zeros on the
+        diagonal.
+    """
+
+    if metric == 'cosine':
+        X = _normalize_rows(X)
+
+    elif metric == 'inner_product':
+        _check_unit_norm(X)
+
+    n = X.shape[0]
+    D = _np.empty((n, n), dtype=_np.float)
+
+    for start in range(0, n, block_size):
+        D[start:start + block_size] = _block_distances(
+            X[start:start + block_size], X, metric,
+            metric_params=metric_params)
+
+    _np.fill_diagonal(D, 0.)
+
+    return D
+
+
+def _precomputed_knn_graph(D, k, block_size=None):
+    """
+    Compute the k-nearest neighbor graph from a precomputed distance matrix,
+    reading it in blocks of rows. This function is not meant to be called by
+    the user; it is a helper function for `knn_graph`.
+
+    Parameters
+    ----------
+    D : numpy array or numpy.memmap
+        Condensed or square distance matrix.
+
+    k : int
+        The number of points to consider as neighbors of any given point.
+
+    block_size : int, optional
+        Number of rows to read at once. If None, enough rows for about four
+        million distances.
+
+    Returns
+    -------
+    neighbors : numpy array
+        Each row contains the nearest neighbors of the corresponding point.
+
+    radii : numpy array
+        For each point the distance to its k'th nearest neighbor (including
+        itself).
+    """
+
+    n = _precomputed_size(D)
+    k = min(k, n)
+
+    if block_size is None:
+        block_size = max(1, 2**22 // n)
+
+    neighbors = _np.empty((n, k), dtype=_np.int)
+    radii = _np.empty(n, dtype=_np.float)
+
+    for start in range(0, n, block_size):
+        block = _precomputed_rows(D, n, start, start + block_size)
+        rows = _np.arange(len(block))[:, _np.newaxis]
+
+        if k < n:
+            nbrs = _np.argpartition(block, k - 1, axis=1)[:, :k]
+        else:
+            nbrs = _np.tile(_np.arange(n), (len(block), 1))
+
+        order = _np.argsort(block[rows, nbrs], axis=1, kind='mergesort')
+        nbrs = nbrs[rows, order]
+
+        neighbors[start:start + block_size] = nbrs
+        radii[start:start + block_size] = block[rows[:, 0], nbrs[:, -1]]
+
+    return neighbors, radii
+
+
+def _precomputed_epsilon_graph(D, epsilon=None, percentile=0.05,
+                               block_size=None):
+    """
+    Construct an epsilon-neighborhood graph from a precomputed distance
+    matrix, reading it in blocks of rows. This function is not meant to be
+    called by the user; it is a helper function for `epsilon_graph`.
+
+    Parameters
+    ----------
+    D : numpy array or numpy.memmap
+        Condensed or square distance matrix.
+
+    epsilon : float, optional
+        The distance threshold for neighbors. If None, it is set to the
+        'percentile' of the pairwise distances.
+
+    percentile : float, optional
+        Percentile of the pairwise distances to use for 'epsilon'.
+
+    block_size : int, optional
+        Number of rows to read at once. If None, enough rows for about four
+        million distances.
+
+    Returns
+    -------
+    neighbors : list [numpy array]
+        Neighbors of each point, including itself.
+    """
+
+    n = _precomputed_size(D)
+
+    if block_size is None:
+        block_size = max(1, 2**22 // n)
+
+    if epsilon is None:
+        epsilon = _blocked_percentile(
+            lambda: _pairwise_chunks(D, n, block_size),
+            round(percentile * 100))
+
+    neighbors = []
+
+    for start in range(0, n, block_size):
+        block = _precomputed_rows(D, n, start, start + block_size)
+        neighbors.extend(_np.flatnonzero(row <= epsilon) for row in block)
+
+    return neighbors
+
+
+def _precomputed_size(D):
+    """
+    Find the number of points from a condensed or square distance matrix.
+    This function is not meant to be called by the user.
+    """
+
+    if D.ndim == 2:
+        if D.shape[0] != D.shape[1]:
+            raise ValueError("A precomputed distance matrix must be square " +
+                             "or condensed.")
+        return D.shape[0]
+
+    elif D.ndim == 1:
+        n = int(round((1 + _np.sqrt(1 + 8 * len(D))) / 2))
+        if n * (n - 1) // 2 != len(D):
+            raise ValueError("The length of a condensed distance matrix " +
+                             "must be n * (n - 1) / 2 for some n.")
+        return n
+
+    else:
+        raise ValueError("A precomputed distance matrix must be square or " +
+                         "condensed.")
+
+
+def _precomputed_rows(D, n, start, stop):
+    """
+    Read rows of the square form of a precomputed distance matrix, as a float
+    numpy array. For a memory-mapped matrix, only the requested distances are
+    read from disk. This function is not meant to be called by the user.
+
+    Parameters
+    ----------
+    D : numpy array or numpy.memmap
+        Condensed or square distance matrix.
+
+    n : int
+        Number of points.
+
+    start, stop : int
+        First row, and one past the last row, to read.
+
+    Returns
+    -------
+    rows : 2D numpy array
+        Rows 'start' to 'stop' of the square distance matrix.
+    """
+
+    stop = min(stop, n)
+
+    if D.ndim == 2:
+        return _np.array(D[start:stop], dtype=_np.float)
+
+    ## Condensed index of each pair (i, j) with i < j.
+    i = _np.arange(start, stop)[:, _np.newaxis]
+    j = _np.arange(n)[_np.newaxis, :]
+    lo = _np.minimum(i, j)
+    hi = _np.maximum(i, j)
+
+    index = n * lo - (lo * (lo + 1)) // 2 + (hi - lo - 1)
+    diagonal = (i == j)
+    index[diagonal] = 0
+
+    rows = _np.array(D[index], dtype=_np.float)
+    rows[diagonal] = 0.
+
+    return rows
+
+
+def _pairwise_chunks(D, n, block_size):
+    """
+    Read the distance between each pair of points exactly once, in chunks,
+    from a precomputed distance matrix. This function is not meant to be
+    called by the user.
+    """
+
+    if D.ndim == 1:
+        chunk_size = block_size * n
+        for start in range(0, len(D), chunk_size):
+            yield _np.asarray(D[start:start + chunk_size], dtype=_np.float)
+
+    else:
+        for start in range(0, n, block_size):
+            rows = _precomputed_rows(D, n, start, start + block_size)
+            yield _np.concatenate([row[start + i + 1:]
+                                   for i, row in enumerate(rows)])
+
+
+def _blocked_percentile(chunks, q, num_bins=2**16):
+    """
+    Compute a percentile of a set of values that is read in chunks, without
+    holding all of the values in memory. A histogram of the values locates
+    the order statistics needed for the percentile, then only the values in
+    their histogram bins are kept in a second pass. The result matches
+    `numpy.percentile` with linear interpolation. This function is not meant
+    to be called by the user.
+
+    Parameters
+    ----------
+    chunks : function
+        Returns an iterator over the chunks of values, as numpy arrays. It is
+        called twice.
+
+    q : float
+        Percentile, between 0 and 100.
+
+    num_bins : int, optional
+        Number of histogram bins.
+
+    Returns
+    -------
+    value : float
+        The percentile of the values.
+    """
+
+    ## First pass: the range of the values, then their histogram.
+    num_values = 0
+    low, high = _np.inf, -_np.inf
+
+    for chunk in chunks():
+        if len(chunk) > 0:
+            num_values += len(chunk)
+            low = min(low, chunk.min())
+            high = max(high, chunk.max())
+
+    if low == high:
+        return low
+
+    edges = _np.linspace(low, high, num_bins + 1)
+    counts = _np.zeros(num_bins, dtype=_np.int)
+
+    for chunk in chunks():
+        bins = _np.clip(_np.searchsorted(edges, chunk, side='right') - 1,
+                        0, num_bins - 1)
+        counts += _np.bincount(bins, minlength=num_bins)
+
+    ## Order statistics needed for linear interpolation.
+    position = (num_values - 1) * q / 100.
+    ranks = [int(_np.floor(position)), int(_np.ceil(position))]
+    cumulative = _np.cumsum(counts)
+    first_bin, last_bin = _np.searchsorted(cumulative, ranks, side='right')
+    num_below = cumulative[first_bin - 1] if first_bin > 0 else 0
+
+    ## Second pass: keep the values in the bins of the order statistics.
+    kept = []
+
+    for chunk in chunks():
+        bins = _np.clip(_np.searchsorted(edges, chunk, side='right') - 1,
+                        0, num_bins - 1)
+        kept.append(chunk[(bins >= first_bin) & (bins <= last_bin)])
+
+    kept = _np.sort(_np.concatenate(kept))
+    lower, upper = kept[ranks[0] - num_below], kept[ranks[1] - num_below]
+
+    return lower + (position - ranks[0]) * (upper - lower)
+
+
+def density_spanning_forest(adjacency_list, density):
+    """
+    Reduce a similarity graph to a maximum spanning forest, where each edge is
+    weighted by the smaller of the density values at its endpoints. The
+    forest has the same connected components as the original graph at every
+    upper level set of the density, so it yields exactly the same level set
+    tree, with at most n - 1 edges instead of roughly n * k.
+
+    Parameters
+    ----------
+    adjacency_list : list [list]
+        Adjacency list of a similarity graph, e.g. from `knn_graph` or
+        `epsilon_graph`. Each entry contains the indices of the neighbors of
+        the data point at the same row index.
+
+    density : list [float] or numpy array
+        Estimate of the density function, evaluated at the data points
+        represented by the entries of `adjacency_list`.
+
+    Returns
+    -------
+    neighbors : list [numpy array]
+        Adjacency list of the spanning forest. Each entry contains the indices
+        of the neighbors of the corresponding point in the forest. The
+        adjacency list is symmetric and contains no self-loops.
+
+    See Also
+    --------
+    knn_graph, epsilon_graph
+
+    Notes
+    -----
+    The edges are weighted by the rank of the minimum endpoint density rather
+    than the density itself, so ties and the scale of the density values do
+    not affect the result. The forest is computed with Kruskal's algorithm
+    from `scipy.sparse.csgraph`.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> knn, radii = debacl.utils.knn_graph(X, k=8)
+    >>> density = debacl.utils.knn_density(radii, n=100, p=2, k=8)
+    >>> forest = debacl.utils.density_spanning_forest(knn, density)
+    >>> tree = debacl.construct_tree_from_graph(forest, density)
+    """
+
+    if not _HAS_SCIPY:
+        raise ImportError("The 'scipy' module could not be loaded. " +
+                          "It is required for computing a spanning forest " +
+                          "of a similarity graph.")
+
+    n = len(adjacency_list)
+    density = _np.asarray(density)
+
+    if len(density) != n:
+        raise ValueError("Inputs 'adjacency_list' and 'density' must have " +
+                         "the same length.")
+
+    ## Collect each undirected edge once, without self-loops.
+    sizes = [len(neighbors) for neighbors in adjacency_list]
+    rows = _np.repeat(_np.arange(n), sizes)
+    cols = _np.concatenate([_np.asarray(neighbors, dtype=_np.int64)
+                            for neighbors in adjacency_list] +
+                           [_np.array([], dtype=_np.int64)])
+
+    lo = _np.minimum(rows, cols)
+    hi = _np.maximum(rows, cols)
+    edges = _np.unique(lo[lo != hi] * n + hi[lo != hi])
+    lo, hi = edges // n, edges % n
+
+    ## Heavier edges join higher-density points, so they are cheaper in the
+    #  *minimum* spanning forest.
+    rank = _np.empty(n, dtype=_np.int64)
+    rank[_np.argsort(density, kind='mergesort')] = _np.arange(n)
+    weight = n - _np.minimum(rank[lo], rank[hi])
+
+    graph = _sps.coo_matrix((weight.astype(_np.float), (lo, hi)),
+                            shape=(n, n)).tocsr()
+    forest = _csgraph.minimum_spanning_tree(graph).tocoo()
+
+    ## Convert back to a symmetric adjacency list.
+    src = _np.concatenate((forest.row, forest.col))
+    dst = _np.concatenate((forest.col, forest.row))
+    order = _np.argsort(src, kind='mergesort')
+    breaks = _np.searchsorted(src[order], _np.arange(1, n))
+    neighbors = _np.split(dst[order], breaks)
+
+    return neighbors
+
+
+def bin_data(X, bin_width):
+    """
+    Aggregate data points into the cells of a regular histogram grid.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array
+        Data points, with each row as an observation.
+
+    bin_width : float or numpy array[float]
+        Width of the grid cells, either the same in every dimension or one
+        value for each column of 'X'.
+
+    Returns
+    -------
+    cells : 2-dimensional numpy array[int]
+        Integer grid coordinates of each occupied cell, with cells sorted in
+        lexicographic order. The lower corner of cell 'c' is at
+        `X.min(axis=0) + c * bin_width`.
+
+    counts : numpy array[int]
+        Number of points in each occupied cell.
+
+    assignment : numpy array[int]
+        For each row of 'X', the index of its cell in 'cells'.
+
+    See Also
+    --------
+    cell_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> cells, counts, assignment = debacl.utils.bin_data(X, bin_width=0.1)
+    """
+
+    if not isinstance(X, _np.ndarray) or X.ndim != 2:
+        raise TypeError("Input 'X' must be a 2-dimensional numpy array.")
+
+    bin_width = _np.asarray(bin_width, dtype=_np.float)
+
+    if _np.any(bin_width <= 0):
+        raise ValueError("Input 'bin_width' must be positive.")
+
+    coords = _np.floor((X - X.min(axis=0)) / bin_width).astype(_np.int64)
+    shape = coords.max(axis=0) + 1
+    keys = _np.ravel_multi_index(coords.T, shape)
+
+    keys, assignment, counts = _np.unique(keys, return_inverse=True,
+                                          return_counts=True)
+    cells = _np.vstack(_np.unravel_index(keys, shape)).T
+
+    return cells, counts, assignment
+
+
+def cell_graph(cells, connectivity=None):
+    """
+    Construct the similarity graph between occupied cells of a regular grid,
+    represented by an adjacency list. Two cells are connected by an edge if
+    they touch.
+
+    Parameters
+    ----------
+    cells : 2-dimensional numpy array[int]
+        Integer grid coordinates of each cell, as returned by `bin_data`.
+
+    connectivity : int, optional
+        Cells are neighbors if they differ by one step in at most
+        'connectivity' dimensions. If None (the default), cells that share at
+        least a corner are neighbors. In two dimensions, 1 gives the
+        4-neighbor stencil and 2 gives the 8-neighbor stencil.
+
+    Returns
+    -------
+    neighbors : list [numpy array]
+        Each entry contains the indices of the neighbors of the corresponding
+        row in 'cells', including the cell itself.
+
+    See Also
+    --------
+    bin_data, knn_graph
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> cells, counts, assignment = debacl.utils.bin_data(X, bin_width=0.1)
+    >>> neighbors = debacl.utils.cell_graph(cells)
+    """
+
+    m, p = cells.shape
+    offsets = _cell_stencil(p, connectivity)
+
+    ## Look up each shifted cell among the occupied cells.
+    shape = cells.max(axis=0) + 3
+    keys = _np.ravel_multi_index((cells + 1).T, shape)
+    order = _np.argsort(keys)
+    sorted_keys = keys[order]
+
+    rows = []
+    cols = []
+
+    for offset in offsets:
+        shifted = _np.ravel_multi_index((cells + 1 + offset).T, shape)
+        ix = _np.minimum(_np.searchsorted(sorted_keys, shifted), m - 1)
+        found = sorted_keys[ix] == shifted
+        rows.append(_np.where(found)[0])
+        cols.append(order[ix[found]])
+
+    rows = _np.concatenate(rows)
+    cols = _np.concatenate(cols)
+
+    order = _np.argsort(rows, kind='mergesort')
+    breaks = _np.searchsorted(rows[order], _np.arange(1, m))
+    neighbors = _np.split(cols[order], breaks)
+
+    return neighbors
+
+
+def _cell_stencil(p, connectivity=None):
+    """
+    Offsets from a grid cell to its neighbors, including the cell itself.
+
+    Parameters
+    ----------
+    p : int
+        Dimension of the grid.
+
+    connectivity : int, optional
+        Maximum number of dimensions in which a neighbor may differ. If None
+        (the default), all cells that share at least a corner are neighbors.
+
+    Returns
+    -------
+    offsets : 2-dimensional numpy array[int]
+        One row for each neighbor.
+    """
+
+    if connectivity is None:
+        connectivity = p
+
+    offsets = _np.indices((3,) * p).reshape((p, -1)).T - 1
+    offsets = offsets[_np.abs(offsets).sum(axis=1) <= connectivity]
+
+    return offsets
+
+
+def collapse_duplicates(X):
+    """
+    Collapse duplicate rows of a dataset into unique rows with counts.
+    Duplicate rows have a k'th nearest neighbor distance of zero, hence an
+    infinite kNN density estimate, so they should be collapsed before
+    building a similarity graph.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Data points, with each row as an observation.
+
+    Returns
+    -------
+    unique_X : 2-dimensional numpy array or scipy sparse matrix
+        The unique rows of 'X'. If 'X' has no duplicate rows, this is 'X'
+        itself, in the original order.
+
+    counts : numpy array[int]
+        Number of times each row of 'unique_X' occurs in 'X'.
+
+    assignment : numpy array[int]
+        For each row of 'X', the index of the matching row in 'unique_X'.
+
+    See Also
+    --------
+    knn_graph, knn_density
+
+    Examples
+    --------
+    >>> X = numpy.random.randint(5, size=(100, 2))
+    >>> unique_X, counts, assignment = debacl.utils.collapse_duplicates(X)
+    >>> numpy.all(unique_X[assignment] == X)
+    True
+    """
+
+    if _issparse(X):
+        return _collapse_sparse_duplicates(X)
+
+    if not isinstance(X, _np.ndarray) or X.ndim != 2:
+        raise TypeError("Input 'X' must be a 2-dimensional numpy array.")
+
+    unique_X, assignment, counts = _np.unique(X, axis=0, return_inverse=True,
+                                              return_counts=True)
+
+    if len(unique_X) == len(X):
+        n = len(X)
+        return X, _np.ones(n, dtype=_np.int), _np.arange(n)
+
+    return unique_X, counts, assignment
+
+
+def _collapse_sparse_duplicates(X):
+    """
+    Collapse duplicate rows of a scipy sparse matrix, by comparing the
+    non-zero entries of each row. This function is not meant to be called by
+    the user; it is a helper function for `collapse_duplicates`.
+    """
+
+    n = X.shape[0]
+    canonical = _sps.csr_matrix(X, copy=True)
+    canonical.sum_duplicates()
+    canonical.eliminate_zeros()
+    canonical.sort_indices()
+
+    rows = {}
+    assignment = _np.empty(n, dtype=_np.int)
+    indptr, indices, data = (canonical.indptr, canonical.indices,
+                             canonical.data)
+
+    for i in range(n):
+        row = slice(indptr[i], indptr[i + 1])
+        key = (indices[row].tostring(), data[row].tostring())
+        assignment[i] = rows.setdefault(key, len(rows))
+
+    counts = _np.bincount(assignment)
+
+    if len(rows) == n:
+        return X, counts, _np.arange(n)
+
+    first = _np.unique(assignment, return_index=True)[1]
+    return _sps.csr_matrix(X)[first], counts, assignment
+
+
+#########################
+### RESOURCE PLANNING ###
+#########################
+
+## Rough single-core costs for `plan_resources`, in seconds per operation,
+## and the memory of a networkx graph in bytes per edge.
+_PDIST_COST = 1.5e-9  # per pair of points and dimension, with pdist
+_PRODUCT_COST = 2e-10  # per pair of points and dimension, in blocks
+_INDEX_COST = 2e-9  # per distance in a KD-tree or ball tree search
+_INDEX_OVERHEAD = 0.05  # to build and query a KD-tree or ball tree
+_SORT_COST = 1e-8  # per element and comparison, sorting rows
+_SELECT_COST = 1e-8  # per element, partially sorting rows
+_LEVEL_COST = 2e-7  # per level, point, and neighbor, growing a tree
+_EDGE_BYTES = 700
+
+## Target memory for each block of brute force distances. Larger blocks are
+## no faster.
+_BLOCK_BYTES = 2 ** 28
+
+
+def plan_resources(n, p, k, memory_limit=None, num_levels=None, dtype=None,
+                   metric='euclidean', sparse=False, landmarks=None,
+                   sample_size=None, n_jobs=1):
+    """
+    Estimate the peak memory and running time of each way to compute the
+    similarity graph, the density estimate, and the level set tree for 'n'
+    points in 'p' dimensions, and choose a similarity graph method that fits
+    in memory. `debacl.construct_tree` uses this plan to choose the
+    neighbor search, and to fail early if the tree won't fit in memory.
+
+    Parameters
+    ----------
+    n : int
+        Number of (unique) observations.
+
+    p : int
+        Number of dimensions, or the average number of non-zero entries per
+        row for sparse data.
+
+    k : int
+        Number of neighbors of each point.
+
+    memory_limit : int, optional
+        Memory budget in bytes. If None (default), the memory available to
+        the process, from `/proc/meminfo` and the cgroup memory limit where
+        they exist. If that can't be determined, every method is feasible.
+
+    num_levels : int, optional
+        Number of density levels in the tree. If None (default), 'n'.
+
+    dtype : numpy dtype, optional
+        Precision of the distance computations. See `knn_graph`.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_query`.
+
+    sparse : bool, optional
+        If True, the data is a scipy sparse matrix.
+
+    landmarks : int, optional
+        Number of landmarks for `landmark_density`. If None (default), the
+        landmark option is estimated with 1,000 landmarks, and the plan uses
+        the k-nearest neighbor density estimate.
+
+    sample_size : int, optional
+        Sample size for `debacl.construct_tree_sampled`. If None (default),
+        10,000 or 'n', whichever is smaller.
+
+    n_jobs : int, optional
+        Number of threads for the neighbor search. See `knn_graph`.
+
+    Returns
+    -------
+    plan : dict
+        - 'graph', 'density', and 'engine': lists of options for the
+          similarity graph, the density estimate, and the tree
+          construction. Each option is a dict with the 'method', its
+          estimated peak 'memory' in bytes, its estimated 'time' in seconds,
+          and whether it is 'feasible' within the memory limit. Graph
+          options also have the 'block_size' argument for `knn_graph`;
+          'brute_force' appears both with the full distance matrix
+          ('block_size' None) and in blocks of rows.
+
+        - 'method' and 'block_size': the exact full distance matrix if it
+          fits in memory, otherwise the fastest feasible similarity graph
+          option, or None if none fits in memory.
+
+        - 'memory' and 'time': estimated totals for `construct_tree` with
+          that option, the chosen density estimate, and the full tree.
+
+        - 'memory_limit': the memory budget in bytes, or None.
+
+    Notes
+    -----
+    The estimates are rough models of the dominant array allocations and
+    operation counts, calibrated on a single core. Memory estimates are
+    meant to catch plans that are off by a large factor, such as the full
+    distance matrix for 100,000 points, not to predict the exact peak.
+
+    Examples
+    --------
+    >>> plan = debacl.utils.plan_resources(n=100000, p=3, k=10)
+    >>> plan['method'], plan['memory'] / 2.**30
+    ('kd_tree', 0.66...)
+    """
+
+    if memory_limit is None:
+        memory_limit = _available_memory()
+
+    itemsize = _np.dtype(_np.float64 if dtype is None else dtype).itemsize
+    low_precision = itemsize != 8
+    num_threads = _num_threads(n_jobs)
+    num_levels = n if num_levels is None else num_levels
+    log_n = _np.log2(max(n, 2))
+
+    if metric == 'mahalanobis':
+        metric = 'euclidean'
+
+    ## Data copy, neighbors, and neighbor distances.
+    base = n * p * 8 + n * k * 16
+
+    def option(method, memory, time, **extra):
+        extra.update(method=method, memory=int(memory), time=time,
+                     feasible=(memory_limit is None or
+                               base + memory <= memory_limit))
+        return extra
+
+    ## Similarity graph
+    graph = []
+    dense = not sparse and metric != 'precomputed' and not callable(metric)
+
+    if (dense and metric == 'euclidean' and not low_precision and
+            num_threads == 1):
+        graph.append(option(
+            'brute_force', 20. * n ** 2,
+            n ** 2 * (0.5 * p * _PDIST_COST + log_n * _SORT_COST),
+            block_size=None))
+
+    row_bytes = num_threads * n * (3 * itemsize + 8)
+    centered = low_precision or (dense and metric == 'euclidean')
+    copy_bytes = n * p * itemsize if centered else 0
+
+    block_size = _BLOCK_BYTES // row_bytes
+    if memory_limit is not None:
+        block_size = min(block_size,
+                         (memory_limit - base - copy_bytes) // row_bytes)
+    block_size = int(min(max(block_size, 1), 1000, n))
+
+    graph.append(option(
+        'brute_force', block_size * row_bytes + copy_bytes,
+        n ** 2 * (p * _PRODUCT_COST + _SELECT_COST) / num_threads,
+        block_size=block_size))
+
+    ## Ball trees visit fewer points than KD-trees in high dimensions, but
+    ## each visit costs more.
+    for method, metrics, factor, exponent in [
+            ('kd_tree', _KD_TREE_METRICS, 1., 2.),
+            ('ball_tree', _BALL_TREE_METRICS, 2., 3.)]:
+        if _HAS_SKLEARN and dense and metric in metrics and not low_precision:
+            visits = min(n, factor * (k + log_n) * 2 ** (p / exponent))
+            graph.append(option(
+                method, n * (2 * p + 1) * 8,
+                _INDEX_OVERHEAD + n * visits * p * _INDEX_COST / num_threads,
+                block_size=None))
+
+    ## Density estimate
+    num_landmarks = 1000 if landmarks is None else landmarks
+    density = [
+        option('knn', n * 16, n * _SELECT_COST),
+        option('landmarks',
+               1000 * num_landmarks * (3 * itemsize + 8) +
+               num_landmarks * p * 8,
+               n * num_landmarks * (p * _PRODUCT_COST + _SELECT_COST))]
+
+    ## Tree construction
+    sample_size = min(n, 10000) if sample_size is None else sample_size
+    sample_levels = min(num_levels, sample_size)
+    engine = [
+        option('construct_tree', n * k * _EDGE_BYTES,
+               num_levels * n * k * _LEVEL_COST),
+        option('construct_tree_sampled',
+               sample_size * k * _EDGE_BYTES + 1000 * sample_size * 16,
+               sample_size ** 2 * (p * _PRODUCT_COST + _SELECT_COST) +
+               sample_levels * sample_size * k * _LEVEL_COST +
+               n * sample_size * (p * _PRODUCT_COST + _SELECT_COST))]
+
+    ## Choose the exact full distance matrix if it fits in memory, otherwise
+    #  the fastest feasible similarity graph.
+    feasible = [opt for opt in graph if opt['feasible']]
+    full = [opt for opt in feasible if opt['method'] == 'brute_force' and
+            opt['block_size'] is None]
+    choice = full[0] if full else min(feasible or graph,
+                                      key=lambda opt: opt['time'])
+    stages = [choice, density[0 if landmarks is None else 1], engine[0]]
+
+    return {'graph': graph, 'density': density, 'engine': engine,
+            'method': choice['method'] if feasible else None,
+            'block_size': choice['block_size'] if feasible else None,
+            'memory': base + max(stage['memory'] for stage in stages),
+            'time': sum(stage['time'] for stage in stages),
+            'memory_limit': memory_limit}
+
+
+def _format_bytes(num_bytes):
+    """
+    Format a number of bytes in MB or GB, for messages. This function is not
+    meant to be called by the user.
+    """
+    if num_bytes < 2**30:
+        return "{:.1f} MB".format(num_bytes / 2.**20)
+    else:
+        return "{:.2f} GB".format(num_bytes / 2.**30)
+
+
+def _available_memory():
+    """
+    Estimate the memory available to the process in bytes, from
+    `/proc/meminfo` and the cgroup (container) memory limit, or return None
+    if neither exists. This function is not meant to be called by the user.
+    """
+    available = []
+
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    available.append(int(line.split()[1]) * 1024)
+    except (IOError, OSError, ValueError):
+        pass
+
+    ## cgroup v2, then v1.
+    for limit_file, usage_file in [
+            ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+            ('/sys/fs/cgroup/memory/memory.limit_in_bytes',
+             '/sys/fs/cgroup/memory/memory.usage_in_bytes')]:
+        try:
+            with open(limit_file) as f:
+                limit = f.read().strip()
+            with open(usage_file) as f:
+                usage = int(f.read().strip())
+        except (IOError, OSError, ValueError):
+            continue
+
+        if limit != 'max':
+            available.append(max(int(limit) - usage, 0))
+        break
+
+    return min(available) if available else None
+
+
+################################
+### DIMENSIONALITY REDUCTION ###
+################################
+def reduce_dimension(X, num_components, method='random_projection',
+                     random_state=None, chunk_size=10000):
+    """
+    Project a dataset onto fewer dimensions, to speed up neighbor search.
+    The data is read in chunks of rows, and sparse data is never densified.
 
     Parameters
     ----------
-    X : numpy array | list [numpy arrays]
+    X : 2-dimensional numpy array or scipy sparse matrix
         Data points, with each row as an observation.
 
-    k : int
-        The number of points to consider as neighbors of any given observation.
+    num_components : int
+        Number of dimensions of the projected data.
 
-    method : {'brute-force', 'kd-tree', 'ball-tree'}, optional
-        Computing method.
+    method : {'random_projection', 'pca'}, optional
+        Projection method.
 
-        - 'brute-force': computes the (Euclidean) distance between all O(n^2)
-          pairs of rows in 'X', then for every point finds the k-nearest. It is
-          limited to tens of thousands of observations (depending on available
-          RAM).
+        - 'random_projection': a sparse random projection, with about
+          sqrt(p) non-zero entries in each column, scaled so that distances
+          are preserved in expectation.
 
-        - 'kd-tree': partitions the data into axis-aligned rectangles to avoid
-          computing all O(n^2) pairwise distances. Much faster than
-          'brute-force', but only works for data in fewer than about 20
-          dimensions. Requires the scikit-learn library.
+        - 'pca': principal components, computed by randomized subspace
+          iteration, which needs only a few passes over the data.
 
-        - 'ball-tree': partitions the data into balls and uses the metric
-          property of euclidean distance to avoid computing all O(n^2)
-          distances. Typically much faster than 'brute-force', and works with
-          up to a few hundred dimensions. Requires the scikit-learn library.
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random number generator. If None, numpy's global random
+        number generator is used.
 
-    leaf_size : int, optional
-        For the 'kd-tree' and 'ball-tree' methods, the number of observations
-        in the leaf nodes. Leaves are not split further, so distance
-        computations within leaf nodes are done by brute force. 'leaf_size' is
-        ignored for the 'brute-force' method.
+    chunk_size : int, optional
+        Number of rows to project at once.
 
     Returns
     -------
-    neighbors : numpy array
-        Each row contains the nearest neighbors of the corresponding row in
-        'X', indicated by row indices.
+    X_reduced : 2-dimensional numpy array
+        Projected data, with 'num_components' columns.
 
-    radii : list[float]
-        For each row of 'X' the distance to its k'th nearest neighbor
-        (including itself).
+    components : numpy array or scipy sparse matrix
+        Projection matrix, with one row for each column of 'X'. For 'pca',
+        the data is centered before the projection.
 
     See Also
     --------
-    epsilon_graph
+    projection_distortion, refine_neighbors
 
     Examples
     --------
-    >>> X = numpy.random.rand(100, 2)
-    >>> knn, radii = debacl.utils.knn_graph(X, k=8, method='kd-tree')
+    >>> X = numpy.random.rand(1000, 100)
+    >>> X_reduced, components = debacl.utils.reduce_dimension(X, 10)
+    >>> mean_error, max_error = debacl.utils.projection_distortion(
+    ...     X, X_reduced)
     """
 
+    rng = _check_random_state(random_state)
     n, p = X.shape
 
-    if method == 'kd_tree':
-        if _HAS_SKLEARN:
-            kdtree = _sknbr.KDTree(X, leaf_size=leaf_size, metric='euclidean')
-            distances, neighbors = kdtree.query(X, k=k, return_distance=True,
-                                                sort_results=True)
-            radii = distances[:, -1]
-        else:
-            raise ImportError("The scikit-learn library could not be loaded." +
-                              " It is required for the 'kd-tree' method.")
+    if method == 'random_projection':
+        components = _random_projection_matrix(p, num_components, rng)
+        X_reduced = _chunked_dot(X, components, chunk_size)
 
-    if method == 'ball_tree':
-        if _HAS_SKLEARN:
-            btree = _sknbr.BallTree(X, leaf_size=leaf_size, metric='euclidean')
-            distances, neighbors = btree.query(X, k=k, return_distance=True,
-                                               sort_results=True)
-            radii = distances[:, -1]
-        else:
-            raise ImportError("The scikit-learn library could not be loaded." +
-                              " It is required for the 'ball-tree' method.")
+    elif method == 'pca':
+        X_reduced, components = _randomized_pca(X, num_components, rng,
+                                                chunk_size)
 
-    else:  # assume brute-force
-        if not _HAS_SCIPY:
-            raise ImportError("The 'scipy' module could not be loaded. " +
-                              "It is required for the 'brute_force' method " +
-                              "for building a knn similarity graph.")
+    else:
+        raise ValueError("Reduction method not understood. Please use " +
+                         "'random_projection' or 'pca'.")
 
-        d = _spd.pdist(X, metric='euclidean')
-        D = _spd.squareform(d)
-        rank = _np.argsort(D, axis=1)
-        neighbors = rank[:, 0:k]
+    return X_reduced, components
 
-        k_nbr = neighbors[:, -1]
-        radii = D[_np.arange(n), k_nbr]
 
-    return neighbors, radii
+def projection_distortion(X, X_reduced, sample_size=1000, random_state=None):
+    """
+    Measure how much a projection distorts the distances between pairs of
+    points, on a random sample of pairs.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Original data, with each row as an observation.
 
+    X_reduced : 2-dimensional numpy array
+        Projected data, with the same rows as 'X'.
 
-def epsilon_graph(X, epsilon=None, percentile=0.05):
+    sample_size : int, optional
+        Number of random pairs of distinct points.
+
+    random_state : int or numpy.random.RandomState, optional
+        Seed or random number generator. If None, numpy's global random
+        number generator is used.
+
+    Returns
+    -------
+    mean_error, max_error : float
+        Mean and maximum relative error of the projected distances, i.e.
+        `abs(d_reduced / d - 1)`, over the sampled pairs.
+
+    See Also
+    --------
+    reduce_dimension
     """
-    Construct an epsilon-neighborhood graph, represented by an adjacency list.
-    Two vertices are connected by an edge if they are within 'epsilon' distance
-    of each other, according to the Euclidean metric. The implementation is a
-    brute-force computation of all O(n^2) pairwise distances of the rows in X.
+
+    rng = _check_random_state(random_state)
+    n = X.shape[0]
+
+    i = rng.randint(n, size=sample_size)
+    j = rng.randint(n, size=sample_size)
+    i, j = i[i != j], j[i != j]
+
+    original = _np.sqrt(_squared_norms(X[i] - X[j]))
+    reduced = _np.sqrt(_squared_norms(X_reduced[i] - X_reduced[j]))
+
+    keep = original > 0
+    error = _np.abs(reduced[keep] / original[keep] - 1.)
+
+    if len(error) == 0:
+        return 0., 0.
+
+    return error.mean(), error.max()
+
+
+def refine_neighbors(X, candidates, k, chunk_size=2**20):
+    """
+    Find the k-nearest neighbors of each point among its candidate neighbors,
+    with exact Euclidean distances. The candidates can come from a search in
+    a projected space, for example.
 
     Parameters
     ----------
-    X : 2D numpy array
-        The rows of 'X' are the observations which become graph vertices.
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Data points, with each row as an observation.
 
-    epsilon : float, optional
-        The distance threshold for neighbors.
+    candidates : 2-dimensional numpy array[int]
+        Row indices of the candidate neighbors of each point, with at least
+        'k' columns.
 
-    percentile : float, optional
-        If 'epsilon' is unspecified, this determines the distance threshold.
-        'epsilon' is set to the desired percentile of all (n choose 2) pairwise
-        distances, where n is the number of rows in 'X'.
+    k : int
+        The number of neighbors to keep for each point.
+
+    chunk_size : int, optional
+        Maximum number of array elements in the distances computed at once.
 
     Returns
     -------
     neighbors : numpy array
-        Each row contains the nearest neighbors of the corresponding row in
-        'X', indicated by row indices.
+        Each row contains the 'k' nearest candidates of the corresponding
+        row of 'X', in increasing order of distance.
+
+    radii : numpy array
+        For each row of 'X', the distance to its k'th nearest candidate.
 
     See Also
     --------
-    knn_graph
+    reduce_dimension, knn_graph
+    """
 
-    Examples
-    --------
-    >>> X = numpy.random.rand(100, 2)
-    >>> neighbors = debacl.utils.epsilon_graph(X, epsilon=0.2)
+    if _issparse(X):
+        X = _sps.csr_matrix(X)
+        norms = _squared_norms(X)
+        dist = _np.empty(candidates.shape, dtype=_np.float)
+        step = max(1, chunk_size // candidates.shape[1])
+
+        for start in range(0, X.shape[0], step):
+            cands = candidates[start:start + step]
+            rows = _np.repeat(_np.arange(start, start + len(cands)),
+                              cands.shape[1])
+            dots = _sps.csr_matrix(X[rows].multiply(X[cands.ravel()]))
+            dots = dots.dot(_np.ones(X.shape[1])).reshape(cands.shape)
+            dist[start:start + step] = (norms[rows].reshape(cands.shape) +
+                                        norms[cands] - 2 * dots)
+
+        _np.maximum(dist, 0, out=dist)
+    else:
+        dist = _exact_distances(X, X, candidates, 'euclidean', chunk_size)
+
+    rows = _np.arange(len(candidates))[:, _np.newaxis]
+    order = _np.argsort(dist, axis=1, kind='mergesort')[:, :k]
+    neighbors = candidates[rows, order]
+    radii = _np.sqrt(dist[rows[:, 0], order[:, -1]])
+
+    return neighbors, radii
+
+
+def _check_random_state(random_state):
+    """
+    Turn a seed into a numpy random number generator. If 'random_state' is
+    None, return numpy's global generator. This function is not meant to be
+    called by the user.
     """
 
-    if not _HAS_SCIPY:
-        raise ImportError("The 'scipy' module could not be loaded. " +
-                          "It is required for constructing an epsilon " +
-                          "neighborhood similarity graph.")
+    if random_state is None:
+        return _np.random.mtrand._rand
 
-    d = _spd.pdist(X, metric='euclidean')
-    D = _spd.squareform(d)
+    if isinstance(random_state, _np.random.RandomState):
+        return random_state
 
-    if epsilon is None:
-        epsilon = _np.percentile(d, round(percentile * 100))
+    return _np.random.RandomState(random_state)
 
-    adjacency_matrix = D <= epsilon
-    neighbors = [_np.where(row)[0] for row in adjacency_matrix]
 
-    return neighbors
+def _random_projection_matrix(p, num_components, rng):
+    """
+    Draw a sparse random projection matrix, with entries
+    +/- sqrt(s / num_components) with probability 1 / (2s) each, and 0
+    otherwise, where s = sqrt(p). This function is not meant to be called by
+    the user; it is a helper function for `reduce_dimension`.
+    """
+
+    s = _np.sqrt(p)
+    scale = _np.sqrt(s / num_components)
+
+    signs = lambda size: rng.choice([-scale, scale], size=size)
+    components = _sps.random(p, num_components, density=min(1., 1. / s),
+                             format='csc', random_state=rng, data_rvs=signs)
+
+    return components
+
+
+def _randomized_pca(X, num_components, rng, chunk_size=10000,
+                    oversample=10, num_iter=2):
+    """
+    Compute the principal components of a dataset by randomized subspace
+    iteration, reading the data in chunks of rows. The data is centered
+    implicitly, so sparse data stays sparse. This function is not meant to
+    be called by the user; it is a helper function for `reduce_dimension`.
+
+    Returns
+    -------
+    X_reduced : 2-dimensional numpy array
+        Centered data projected onto the principal components.
+
+    components : 2-dimensional numpy array
+        Principal components, one in each column.
+    """
+
+    n, p = X.shape
+    width = min(num_components + oversample, n, p)
+    mean = X.T.dot(_np.ones(n)) / n
+
+    def centered_dot(M):
+        return _chunked_dot(X, M, chunk_size) - mean.dot(M)
+
+    def centered_tdot(Q):
+        product = _np.zeros((p, Q.shape[1]))
+        for start in range(0, n, chunk_size):
+            chunk = X[start:start + chunk_size]
+            product += _np.asarray(chunk.T.dot(Q[start:start + chunk_size]))
+        return product - _np.outer(mean, Q.sum(axis=0))
+
+    Q = _np.linalg.qr(centered_dot(rng.normal(size=(p, width))))[0]
+
+    for _ in range(num_iter):
+        Q = _np.linalg.qr(centered_dot(centered_tdot(Q)))[0]
+
+    B = centered_tdot(Q).T
+    components = _np.linalg.svd(B, full_matrices=False)[2][:num_components].T
+
+    return centered_dot(components), components
+
+
+def _chunked_dot(X, M, chunk_size=10000):
+    """
+    Multiply a numpy array or scipy sparse matrix by a dense or sparse
+    matrix, in chunks of rows, returning a dense numpy array. This function
+    is not meant to be called by the user.
+    """
+
+    n = X.shape[0]
+    product = _np.empty((n, M.shape[1]), dtype=_np.float)
+
+    for start in range(0, n, chunk_size):
+        chunk = X[start:start + chunk_size]
+
+        if _issparse(M) and not _issparse(chunk):
+            block = M.T.dot(chunk.T).T
+        else:
+            block = chunk.dot(M)
+
+        if _issparse(block):
+            block = block.toarray()
+
+        product[start:start + chunk_size] = block
+
+    return product
 
 
 ##########################
 ### DENSITY ESTIMATION ###
 ##########################
-def knn_density(k_radius, n, p, k):
+def knn_density(k_radius, n, p, k, metric='euclidean', metric_params=None):
     """
     Compute the kNN density estimate for a set of points.
 
@@ -205,14 +2129,26 @@ def knn_density(k_radius, n, p, k):
     k_radius : 1-dimensional numpy array of floats
         The distance to each points k'th nearest neighbor.
 
-    n : int
-        The number of points.
+    n : int or float
+        The number of points. For weighted observations, the total weight of
+        all points.
 
     p : int
         The dimension of the data.
 
-    k : int
-        The number of observations considered neighbors of each point.
+    k : int or numpy array
+        The number of observations considered neighbors of each point. For
+        weighted observations, the total weight of each point's neighbors
+        (including the point itself), as one value per point.
+
+    metric : str or callable, optional
+        Distance metric of the k'th neighbor radii, which determines the
+        volume of the neighborhood balls. See `knn_query`. For 'cosine',
+        'inner_product', and callable metrics, the Euclidean ball volume is
+        used, which preserves the relative order of the estimates.
+
+    metric_params : dict, optional
+        Parameters of the distance metric. See `knn_query`.
 
     Returns
     -------
@@ -251,6 +2187,14 @@ def knn_density(k_radius, n, p, k):
     but this does not matter for estimating the *shape* of a level set tree; on
     the relative order of the density estimates matters.
 
+    For other metrics, :math:`v_p` is the volume of the unit ball of the
+    metric: :math:`2^p / p!` for 'manhattan', :math:`2^p` for 'chebyshev',
+    and :math:`(2 \Gamma(1 + 1/q))^p / \Gamma(1 + p/q)` for 'minkowski'
+    with exponent :math:`q`. For 'mahalanobis', it is the Euclidean unit
+    ball volume divided by :math:`|\det W|`. For 'haversine', the volume
+    of the neighborhood is the area :math:`2 \pi (1 - \cos r_k(x))` of a
+    spherical cap on the unit sphere, and 'p' is ignored.
+
     References
     ----------
     - Kpotufe, S. and Luxburg, U. Von (2011) *Pruning Nearest Neighbor Cluster
@@ -273,8 +2217,7 @@ def knn_density(k_radius, n, p, k):
                         "numpy array.")
 
     ## Compute the numerically problematic stuff.
-    unit_vol = _np.pi**(p / 2.0) / _spspec.gamma(1 + p / 2.0)
-    volume_mult = k_radius**p
+    unit_vol, volume_mult = _ball_volume(k_radius, p, metric, metric_params)
 
     ## Check for numerical problems.
     max_multiplier = max(volume_mult)
@@ -290,20 +2233,252 @@ def knn_density(k_radius, n, p, k):
                                   dimension_msg)
 
         else:
-            _logging.warning("The dimension 'p' is too large; all density " +
-                             "estimates are infinite. " + dimension_msg)
+            _logger.warning("The dimension 'p' is too large; all density " +
+                            "estimates are infinite. " + dimension_msg)
 
     else:
         if max_multiplier == _np.inf:
-            _logging.warning("The dimension 'p' to too large for some " +
-                             "values of the k'th neighbor radius " +
-                             "'k_radius'; for these values, the density " +
-                             "estimate is 0.0. " + dimension_msg)
+            _logger.warning("The dimension 'p' to too large for some " +
+                            "values of the k'th neighbor radius " +
+                            "'k_radius'; for these values, the density " +
+                            "estimate is 0.0. " + dimension_msg)
 
     ## Finish the easy computation.
     with _np.errstate(all='ignore'):
         denom = n * unit_vol * volume_mult
-        fhat = float(k) / denom
+        fhat = _np.asarray(k, dtype=_np.float) / denom
+
+    return fhat
+
+
+def _ball_volume(radius, p, metric='euclidean', metric_params=None):
+    """
+    Compute the volume of balls of the given radii, as the volume of the unit
+    ball and the multiplier for each radius. This function is not meant to be
+    called by the user; it is a helper function for `knn_density`.
+
+    Parameters
+    ----------
+    radius : numpy array[float]
+        Radius of each ball.
+
+    p : int
+        The dimension of the data.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_density`.
+
+    metric_params : dict, optional
+        Parameters of the distance metric.
+
+    Returns
+    -------
+    unit_vol : float
+        Volume of the unit ball.
+
+    volume_mult : numpy array[float]
+        Ratio of the volume of each ball to 'unit_vol'.
+    """
+
+    metric, metric_params = _check_metric(metric, metric_params)
+
+    if metric == 'haversine':
+        return 2 * _np.pi, 1. - _np.cos(radius)
+
+    if metric == 'manhattan':
+        unit_vol = 2.0**p / _spspec.gamma(1 + p)
+
+    elif metric == 'chebyshev':
+        unit_vol = 2.0**p
+
+    elif metric == 'minkowski':
+        q = float(metric_params['p'])
+        unit_vol = ((2 * _spspec.gamma(1 + 1 / q))**p /
+                    _spspec.gamma(1 + p / q))
+
+    else:
+        unit_vol = _np.pi**(p / 2.0) / _spspec.gamma(1 + p / 2.0)
+
+    if metric == 'mahalanobis':
+        unit_vol /= abs(_np.linalg.det(_whitening_transform(metric_params)))
+
+    return unit_vol, radius**p
+
+
+def landmark_density(X, landmarks, k, weights=None, block_size=1000,
+                     dtype=None, metric='euclidean', metric_params=None):
+    """
+    Compute an approximate kNN density estimate for a set of points, from
+    their distances to a set of landmark points. The landmarks should be a
+    random sample of the data (or of the same distribution); the estimate
+    is then the kNN density estimate with the neighbor counts scaled up by
+    the sampling rate.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array
+        Points at which to estimate density, with each row as an observation.
+
+    landmarks : 2-dimensional numpy array
+        Landmark points, with the same number of columns as 'X'.
+
+    k : int
+        Number of landmarks to consider as neighbors of each point.
+
+    weights : numpy array, optional
+        Weight of each landmark, e.g. the inverse of its sampling
+        probability. If None (default), every landmark has weight 1.
+
+    block_size : int, optional
+        Number of points for which to compute landmark distances at once.
+
+    dtype : numpy dtype, optional
+        Precision of the landmark distance computations. See `knn_query`.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_query`. For the 'cosine', 'inner_product',
+        and callable metrics, the dimension in the density estimate is set
+        to 1, so the estimate is correct only up to its relative order.
+
+    metric_params : dict, optional
+        Parameters of the distance metric. See `knn_query`.
+
+    Returns
+    -------
+    fhat : 1D numpy array of floats
+        Estimated density for each row of 'X'.
+
+    See Also
+    --------
+    knn_density, knn_query
+
+    Notes
+    -----
+    With :math:`m` landmarks, the number of data points in the ball of radius
+    :math:`r_k(x)` is estimated by :math:`k \cdot n / m`, so the density
+    estimate is :math:`k / (m \cdot v_p \cdot r_k^p(x))`. The cost is
+    O(n * m) time and O(block_size * m) memory, instead of the O(n^2)
+    all-pairs neighbor search for `knn_density`. Points that are themselves
+    landmarks count themselves as a neighbor, like in `knn_graph`.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(10000, 2)
+    >>> landmarks = X[numpy.random.choice(10000, 500, replace=False)]
+    >>> density = debacl.utils.landmark_density(X, landmarks, k=8)
+    """
+
+    distances, neighbors = knn_query(X, landmarks, k, block_size=block_size,
+                                     dtype=dtype, metric=metric,
+                                     metric_params=metric_params)
+    p = density_dimension(X, metric)
+
+    if weights is None:
+        return knn_density(distances[:, -1], landmarks.shape[0], p,
+                           neighbors.shape[1], metric, metric_params)
+    else:
+        weights = _np.asarray(weights)
+        return knn_density(distances[:, -1], weights.sum(), p,
+                           weights[neighbors].sum(axis=1), metric,
+                           metric_params)
+
+
+def density_dimension(X, metric='euclidean'):
+    """
+    Choose the dimension 'p' to use in the kNN density estimate for a dataset
+    and distance metric. For the 'cosine', 'inner_product', and
+    'precomputed' metrics and for callable metrics, the volume of the
+    neighborhood balls is unknown,
+    so the dimension is set to 1, which preserves the relative order of the
+    density estimates and hence the shape of the level set tree.
+
+    Parameters
+    ----------
+    X : 2-dimensional numpy array or scipy sparse matrix
+        Data points, with each row as an observation.
+
+    metric : str or callable, optional
+        Distance metric. See `knn_query`.
+
+    Returns
+    -------
+    p : int
+        Dimension for `knn_density`.
+
+    See Also
+    --------
+    knn_density
+    """
+
+    if callable(metric) or metric in ('cosine', 'inner_product',
+                                      'precomputed'):
+        return 1
+
+    return X.shape[1]
+
+
+def cell_density(cells, counts, neighbors, bin_width, connectivity=None):
+    """
+    Compute a histogram density estimate for the occupied cells of a regular
+    grid, smoothed over each cell and its neighbors.
+
+    Parameters
+    ----------
+    cells : 2-dimensional numpy array[int]
+        Integer grid coordinates of each occupied cell, as returned by
+        `bin_data`.
+
+    counts : numpy array[int]
+        Number of points in each occupied cell.
+
+    neighbors : list [numpy array]
+        Adjacency list of the occupied cells, as returned by `cell_graph`.
+
+    bin_width : float or numpy array[float]
+        Width of the grid cells, either the same in every dimension or one
+        value for each dimension.
+
+    connectivity : int, optional
+        The connectivity used to construct 'neighbors'. Determines the volume
+        of the window around each cell.
+
+    Returns
+    -------
+    fhat : 1D numpy array of floats
+        Estimated density for each occupied cell.
+
+    See Also
+    --------
+    bin_data, cell_graph, knn_density
+
+    Notes
+    -----
+    The density of a cell is the fraction of all points that fall in the
+    cell or its neighbors, divided by the total volume of the window of
+    neighboring cells, whether or not they are occupied. This is a box
+    kernel density estimate evaluated at the cell centers.
+
+    Examples
+    --------
+    >>> X = numpy.random.rand(100, 2)
+    >>> cells, counts, assignment = debacl.utils.bin_data(X, bin_width=0.1)
+    >>> neighbors = debacl.utils.cell_graph(cells)
+    >>> density = debacl.utils.cell_density(cells, counts, neighbors,
+    ...                                     bin_width=0.1)
+    """
+
+    p = cells.shape[1]
+    n = float(_np.sum(counts))
+    window_size = len(_cell_stencil(p, connectivity))
+    cell_volume = _np.prod(_np.ones(p) * bin_width)
+
+    ## Sum the counts over each cell's neighbors.
+    sizes = _np.array([len(x) for x in neighbors])
+    starts = _np.concatenate(([0], _np.cumsum(sizes)[:-1]))
+    window_counts = _np.add.reduceat(counts[_np.concatenate(neighbors)],
+                                     starts)
+
+    fhat = window_counts / (n * window_size * cell_volume)
 
     return fhat
 
@@ -311,7 +2486,7 @@ def knn_density(k_radius, n, p, k):
 ##########################################
 ### LEVEL SET TREE CLUSTERING PIPELINE ###
 ##########################################
-def define_density_mass_grid(density, num_levels=None):
+def define_density_mass_grid(density, num_levels=None, weights=None):
     """
     Create a grid of density levels with a uniform number of points between
     each level.
@@ -325,6 +2500,11 @@ def define_density_mass_grid(density, num_levels=None):
         Number of density levels in the grid. This is essentially the vertical
         resolution of a level set tree built from the 'density' input.
 
+    weights : numpy array[float], optional
+        Weight of each observation, e.g. the number of duplicates of each
+        unique row. If specified, the grid has a uniform total *weight* of
+        points between each level.
+
     Returns
     -------
     levels : numpy array
@@ -359,15 +2539,30 @@ def define_density_mass_grid(density, num_levels=None):
     if len(density) < 1:
         raise ValueError("Input 'density' must contain at least one value.")
 
+    if weights is not None and len(weights) != len(density):
+        raise ValueError("Inputs 'density' and 'weights' must have the " +
+                         "same length.")
+
     ## Construct the grid
     n = len(density)
 
     if num_levels is None or num_levels > n:
         num_levels = n
 
-    idx = _np.linspace(0, n - 1, num_levels)
-    idx = idx.astype(int)
-    levels = _np.sort(density)[idx]
+    if weights is None:
+        idx = _np.linspace(0, n - 1, num_levels)
+        idx = idx.astype(int)
+        levels = _np.sort(density)[idx]
+
+    else:
+        ## Find the last point whose cumulative weight is within each step
+        #  of a uniform grid of weights.
+        order = _np.argsort(density, kind='mergesort')
+        mass = _np.cumsum(_np.asarray(weights)[order])
+        grid = _np.linspace(mass[0], mass[-1], num_levels)
+        idx = _np.searchsorted(mass, grid, side='right') - 1
+        levels = _np.asarray(density)[order][idx]
+
     levels = _np.unique(levels)
     return levels
 
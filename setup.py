@@ -18,5 +18,9 @@ setup(
         'Topic :: Scientific/Engineering :: Visualization'
         ],
     packages=find_packages(),
-    install_requires=["prettytable", "networkx"]
+    install_requires=["prettytable", "networkx",
+                      "futures; python_version < '3'"],
+    entry_points={
+        'console_scripts': ['debacl = debacl.cli:main']
+        }
 )